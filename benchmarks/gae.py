@@ -0,0 +1,68 @@
+"""
+get_advantages_and_returns (chunked discounted_reverse_cumsum) against the per-time-step loop it replaced, across
+response lengths.
+
+    python -m benchmarks.gae --batch_size 64 --lengths 64 256 1024 4096
+"""
+
+import argparse
+
+import torch
+
+from openrlhf.trainer.ppo_utils.experience_maker import NaiveExperienceMaker
+
+from .utils import time_fn
+
+
+def loop_advantages_and_returns(values, rewards, action_mask, gamma, lambd):
+    # the loop get_advantages_and_returns replaced
+    values = action_mask * values
+    rewards = action_mask * rewards
+    response_length = rewards.size(1)
+    lastgaelam = 0
+    advantages_reversed = []
+    for t in reversed(range(response_length)):
+        nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
+        delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        lastgaelam = delta + gamma * lambd * lastgaelam
+        advantages_reversed.append(lastgaelam)
+    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    return advantages.detach(), advantages + values
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+    print(f"batch_size={args.batch_size} gamma={args.gamma} lambd={args.lambd} ({device})")
+    print(f"{'length':>8} {'loop (ms)':>10} {'vectorized (ms)':>16} {'speedup':>8} {'max abs diff':>13}")
+    for length in args.lengths:
+        values = torch.randn(args.batch_size, length, device=device)
+        rewards = torch.randn(args.batch_size, length, device=device)
+        action_mask = torch.ones(args.batch_size, length, dtype=torch.bool, device=device)
+
+        def loop():
+            return loop_advantages_and_returns(values, rewards, action_mask, args.gamma, args.lambd)
+
+        def vectorized():
+            return NaiveExperienceMaker.get_advantages_and_returns(
+                None, values, rewards, action_mask, args.gamma, args.lambd
+            )
+
+        max_diff = (loop()[0] - vectorized()[0]).abs().max().item()
+        loop_seconds = time_fn(loop, n_repeats=args.n_repeats)
+        vectorized_seconds = time_fn(vectorized, n_repeats=args.n_repeats)
+        print(
+            f"{length:>8} {loop_seconds * 1e3:>10.2f} {vectorized_seconds * 1e3:>16.2f} "
+            f"{loop_seconds / vectorized_seconds:>7.1f}x {max_diff:>13.2e}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[16, 64, 256, 1024, 4096])
+    parser.add_argument("--gamma", type=float, default=1.0)
+    parser.add_argument("--lambd", type=float, default=0.95)
+    parser.add_argument("--n_repeats", type=int, default=10)
+    parser.add_argument("--cpu", action="store_true", default=False, help="Run on CPU even if CUDA is available")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,82 @@
+"""
+Token and attention mask bookkeeping of the custom_generate loop: the preallocated GenerationState buffers against the
+previous per-step torch.cat of the whole sequence and mask. Only the bookkeeping is run (no model), so the numbers
+isolate the allocator traffic and copies the buffers remove.
+
+    python -m benchmarks.generation_buffers --batch_size 64 --prompt_len 128 --max_new_tokens 256
+"""
+
+import argparse
+
+import torch
+
+from openrlhf.models.actor_custom import GenerationState
+
+from .utils import allocated_bytes, format_bytes, time_fn
+
+
+def cat_loop(input_ids, attention_mask, next_tokens, read_fn):
+    # the loop before GenerationState
+    sequences = input_ids.clone()
+    curr_attention_mask = attention_mask.clone()
+    unfinished_sequences = torch.ones_like(input_ids[:, 0])
+    for step in range(next_tokens.size(1)):
+        read_fn(sequences, curr_attention_mask)
+        sequences = torch.cat([sequences, next_tokens[:, step, None]], dim=-1)
+        curr_attention_mask = torch.cat([curr_attention_mask, unfinished_sequences[:, None]], dim=1)
+    return sequences
+
+
+def buffer_loop(input_ids, attention_mask, next_tokens, read_fn, pad_token_id=0):
+    state = GenerationState(input_ids, attention_mask, next_tokens.size(1), pad_token_id)
+    unfinished_sequences = torch.ones_like(input_ids[:, 0])
+    while not state.is_done():
+        read_fn(state.sequences, state.attention_mask)
+        state.append(next_tokens[:, state.cur_len - state.prompt_len], unfinished_sequences)
+    return state.sequences.contiguous()
+
+
+def read_last_token(sequences, attention_mask):
+    # what the KV-cached model step reads
+    return sequences[:, -1:], attention_mask
+
+
+def read_full_sequence(sequences, attention_mask):
+    # what the uncached model step reads; the embedding lookup gathers every position
+    return sequences.contiguous(), attention_mask.contiguous()
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+    input_ids = torch.randint(2, args.vocab_size, (args.batch_size, args.prompt_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    next_tokens = torch.randint(2, args.vocab_size, (args.batch_size, args.max_new_tokens), device=device)
+
+    assert torch.equal(
+        cat_loop(input_ids, attention_mask, next_tokens, read_last_token),
+        buffer_loop(input_ids, attention_mask, next_tokens, read_last_token),
+    )
+
+    print(f"batch_size={args.batch_size} prompt_len={args.prompt_len} max_new_tokens={args.max_new_tokens} ({device})")
+    print(f"{'reads':>14} {'loop':>8} {'time (ms)':>10} {'allocated':>12}")
+    for read_name, read_fn in (("last token", read_last_token), ("full sequence", read_full_sequence)):
+        for loop_name, loop in (("cat", cat_loop), ("buffer", buffer_loop)):
+
+            def run():
+                loop(input_ids, attention_mask, next_tokens, read_fn)
+
+            seconds = time_fn(run, n_repeats=args.n_repeats)
+            allocated = allocated_bytes(run) if device == "cpu" else float("nan")
+            print(f"{read_name:>14} {loop_name:>8} {seconds * 1e3:>10.2f} {format_bytes(allocated):>12}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--prompt_len", type=int, default=128)
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--n_repeats", type=int, default=10)
+    parser.add_argument("--cpu", action="store_true", default=False, help="Run on CPU even if CUDA is available")
+    args = parser.parse_args()
+    main(args)
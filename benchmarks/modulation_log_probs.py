@@ -0,0 +1,66 @@
+"""
+Twisted log probs, log_probs_from_logits_with_modulation (a single normalization of logits + modulation) against the
+previous double log_softmax(log_softmax(logits) + modulation), forward and backward.
+
+    python -m benchmarks.modulation_log_probs --batch_size 8 --num_actions 256 --vocab_size 32000
+"""
+
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from openrlhf.models.utils import log_probs_from_logits_with_modulation, return_or_gather_then_return
+
+from .utils import format_bytes, peak_resident_bytes, time_fn
+
+
+def double_log_softmax(logits, modulation, labels, return_type):
+    # the implementation before the fused normalization
+    log_probs_plus_modulation = F.log_softmax(logits, dim=-1) + modulation
+    return return_or_gather_then_return(labels, F.log_softmax(log_probs_plus_modulation, dim=-1), return_type)
+
+
+def main(args):
+    device = "cuda" if torch.cuda.is_available() and not args.cpu else "cpu"
+    dtype = getattr(torch, args.dtype)
+    shape = (args.batch_size, args.num_actions, args.vocab_size)
+    logits = torch.randn(shape, device=device, dtype=dtype)
+    modulation = torch.randn(shape, device=device, dtype=dtype, requires_grad=True)
+    labels = torch.randint(args.vocab_size, shape[:2], device=device)
+
+    print(f"logits {tuple(shape)} {args.dtype} ({device}); gradient w.r.t. the modulation")
+    print(f"{'return_type':>12} {'implementation':>15} {'time (ms)':>10} {'peak memory':>12} {'max abs diff':>13}")
+    for return_type in ("p", "all_vocab"):
+        outputs = {}
+        for name, fn in (("double", double_log_softmax), ("fused", log_probs_from_logits_with_modulation)):
+
+            def run():
+                out = fn(logits, modulation, labels, return_type=return_type)
+                out.float().sum().backward()
+                modulation.grad = None
+                return out
+
+            outputs[name] = run().detach().float()
+            seconds = time_fn(run, n_repeats=args.n_repeats)
+            if device == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+                baseline = torch.cuda.memory_allocated()
+                run()
+                peak = torch.cuda.max_memory_allocated() - baseline
+            else:
+                peak = peak_resident_bytes(run)
+            max_diff = (outputs[name] - outputs["double"]).abs().max().item()
+            print(f"{return_type:>12} {name:>15} {seconds * 1e3:>10.2f} {format_bytes(peak):>12} {max_diff:>13.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_actions", type=int, default=256)
+    parser.add_argument("--vocab_size", type=int, default=32000)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16"])
+    parser.add_argument("--n_repeats", type=int, default=5)
+    parser.add_argument("--cpu", action="store_true", default=False, help="Run on CPU even if CUDA is available")
+    args = parser.parse_args()
+    main(args)
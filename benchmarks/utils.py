@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from typing import Callable
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+
+def time_fn(fn: Callable, n_repeats: int = 10, n_warmup: int = 2) -> float:
+    """Median wall time of fn() in seconds"""
+    for _ in range(n_warmup):
+        fn()
+    times = []
+    for _ in range(n_repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def allocated_bytes(fn: Callable) -> int:
+    """Total bytes allocated by the CPU allocator during fn(), i.e. the allocator traffic rather than the peak"""
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(event.self_cpu_memory_usage for event in prof.events() if event.self_cpu_memory_usage > 0)
+
+
+def _resident_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_resident_bytes(fn: Callable, interval: float = 1e-4) -> int:
+    """
+    Increase of the resident set size at its peak during fn(), sampled from a background thread (Linux only). Large
+    tensors are mapped and unmapped individually by the allocator, so for the (B, T, V) buffers this tracks the peak
+    of the live tensors; small allocations may be served from memory already resident and not show up.
+    """
+    start = _resident_bytes()
+    peak = start
+    stop = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not stop.is_set():
+            peak = max(peak, _resident_bytes())
+            time.sleep(interval)
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        fn()
+    finally:
+        stop.set()
+        thread.join()
+    return max(peak, _resident_bytes()) - start
+
+
+def format_bytes(num_bytes: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GiB"
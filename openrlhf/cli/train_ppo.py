@@ -15,6 +15,7 @@ from openrlhf.trainer import PPOTrainer
 from openrlhf.trainer.harmlessness_trainer import HarmlessnessTrainer
 from openrlhf.utils import blending_datasets, get_strategy, get_tokenizer
 from openrlhf.models.model import _get_reward_model_custom
+from openrlhf.utils.estimator_store import EstimatorStoreReader
 from openrlhf.utils.utils import get_info_name_str
 
 
@@ -30,6 +31,7 @@ def train(args):
         bf16=args.bf16,
         load_in_4bit=args.load_in_4bit,
         ds_config=strategy.get_ds_eval_config(offload=False),
+        packing_samples=args.packing_samples,
     )
     static_initial_model = None
     if not args.do_harmlessness_training:
@@ -85,7 +87,8 @@ def train(args):
                 ds_config=strategy.get_ds_train_config(is_actor=True),
                 parameterization=args.parameterization,
                 additional_sd_divider=args.additional_sd_divider,
-                init_head_from_base=args.init_head_from_base
+                init_head_from_base=args.init_head_from_base,
+                packing_samples=args.packing_samples,
             )
         else:
             # configure model
@@ -100,6 +103,7 @@ def train(args):
                 target_modules=args.target_modules,
                 lora_dropout=args.lora_dropout,
                 ds_config=strategy.get_ds_train_config(is_actor=True),
+                packing_samples=args.packing_samples,
             )
 
         if args.no_critic:
@@ -120,6 +124,7 @@ def train(args):
                 ds_config=strategy.get_ds_train_config(is_actor=False),
                 value_head_prefix=args.value_head_prefix,
                 init_value_head=strategy.args.pretrain == strategy.args.critic_pretrain,
+                packing_samples=args.packing_samples,
             )
 
     if args.actor_init_on_gpu:
@@ -480,6 +485,9 @@ def train(args):
         top_k=args.top_k,
         pad_token_id=tokenizer.pad_token_id,
         eos_token_id=tokenizer.eos_token_id,
+        use_kv_cache=args.generate_use_kv_cache,
+        compact_finished_sequences=args.generate_compact_finished,
+        share_prompt_prefix=args.share_prompt_prefix,
         # remote reward model
         remote_rm_url=args.remote_rm_url,
         shared_actorcritic=args.shared_actorcritic,
@@ -538,7 +546,7 @@ def train(args):
             lambd=args.lambd,
             init_kl_coef=0,
             kl_target=args.kl_target,
-            target_dist_beta=args.target_dist_beta, # TODO later check to make sure this is desired
+            target_dist_beta=args.target_dist_beta,  # TODO later check to make sure this is desired
             ema_beta=0.992,
             ptx_coef=args.ptx_coef,
             max_norm=args.max_norm,
@@ -551,6 +559,9 @@ def train(args):
             top_k=args.top_k,
             pad_token_id=base_tokenizer.pad_token_id,
             eos_token_id=base_tokenizer.eos_token_id,
+            use_kv_cache=args.generate_use_kv_cache,
+            compact_finished_sequences=args.generate_compact_finished,
+            share_prompt_prefix=args.share_prompt_prefix,
             # remote reward model
             remote_rm_url=args.remote_rm_url,
             shared_actorcritic=args.shared_actorcritic,
@@ -580,13 +591,17 @@ def train(args):
         # print(base_model.model.device)
         # print(static_initial_model.model.device)
 
-        estimates_list = None
+        estimator_store = None
         for i in range(args.harmlessness_training_num_episodes):
 
             if args.num_episodes > 0:
-                estimates_list = trainer.fit(
-                    args, prompts_dataloader, pretrain_dataloader, consumed_samples,
-                    num_update_steps_per_episodes, true_posterior_samples
+                estimator_store = trainer.fit(
+                    args,
+                    prompts_dataloader,
+                    pretrain_dataloader,
+                    consumed_samples,
+                    num_update_steps_per_episodes,
+                    true_posterior_samples,
                 )
 
             # TODO Update the initial model, and check that the trainer is now using the updated model version.
@@ -597,50 +612,39 @@ def train(args):
 
 
     else:
-        estimates_list = trainer.fit(
-            args, prompts_dataloader, pretrain_dataloader, consumed_samples,
-            num_update_steps_per_episodes, true_posterior_samples
+        estimator_store = trainer.fit(
+            args,
+            prompts_dataloader,
+            pretrain_dataloader,
+            consumed_samples,
+            num_update_steps_per_episodes,
+            true_posterior_samples,
         )
 
     info_name_str = get_info_name_str(args)
 
-    if estimates_list is not None:
+    if estimator_store is not None:
+        # the estimates were written to the store during training; see EstimatorStoreReader
+        estimates = EstimatorStoreReader(estimator_store.path)
         if args.custom_single_prompt:
-            iwae_lbs_list, iwae_ubs_list, f_q_estimates_list, g_q_estimates_list = estimates_list
             print("FINAL RESULTS IWAE LB LIST", flush=True)
-            print(iwae_lbs_list)
+            print(estimates.load_all("iwae_lbs"))
             print("FINAL RESULTS IWAE UB LIST", flush=True)
-            print(iwae_ubs_list)
+            print(estimates.load_all("iwae_ubs"))
             print("FINAL RESULTS F_Q", flush=True)
-            print(f_q_estimates_list)
+            print(estimates.load_all("f_q_estimates"))
             print("FINAL RESULTS G_Q", flush=True)
-            print(g_q_estimates_list)
-
-            print("SAVING RESULTS", flush=True)
-
-            target_to_save = (
-                f_q_estimates_list, g_q_estimates_list, iwae_lbs_list, iwae_ubs_list
-            )
-            save_str = f"{args.save_info_path}/f_q_g_q_iwae_bounds_OpenRLHF_{info_name_str}"
-            torch.save(target_to_save, save_str)
-
+            print(estimates.load_all("g_q_estimates"))
         else:
-            f_q_estimates_list, rewards_list, kl_vals_list, entropy_list = estimates_list
             print("FINAL RESULTS F_Q", flush=True)
-            print(f_q_estimates_list)
+            print(estimates.load_all("f_q_estimates"))
             print("FINAL RESULTS REWARD", flush=True)
-            print(rewards_list)
+            print(estimates.load_all("rewards"))
             print("FINAL RESULTS KL TO PRIOR", flush=True)
-            print(kl_vals_list)
+            print(estimates.load_all("kl_vals"))
             print("FINAL RESULTS ENTROPY", flush=True)
-            print(entropy_list)
-            print("SAVING RESULTS", flush=True)
-
-            target_to_save = (
-                f_q_estimates_list, rewards_list, kl_vals_list, entropy_list
-            )
-            save_str = f"{args.save_info_path}/f_q_rew_kltoprior_ent_{info_name_str}"
-            torch.save(target_to_save, save_str)
+            print(estimates.load_all("entropy"))
+        print(f"RESULTS SAVED TO {estimator_store.path}", flush=True)
 
 
     if args.save_negdata:
@@ -713,6 +717,143 @@ if __name__ == "__main__":
     parser.add_argument("--top_k", type=int, default=0)
 
     parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument(
+        "--generate_use_kv_cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Use past key values for incremental decoding in the custom (twisted) generation loop, instead of "
+            "re-running the full sequence at every step"
+        ),
+    )
+    parser.add_argument(
+        "--use_generation_log_probs",
+        action="store_true",
+        default=False,
+        help=(
+            "Use the log probs of the sampled tokens computed during generation as the action log probs, instead of "
+            "re-running the actor on the generated sequences"
+        ),
+    )
+    parser.add_argument(
+        "--generate_compact_finished",
+        action="store_true",
+        default=False,
+        help=(
+            "In the custom (twisted) generation loop, drop sequences that have emitted EOS (and their KV cache "
+            "entries) from the batch the model runs on"
+        ),
+    )
+    parser.add_argument(
+        "--share_prompt_prefix",
+        action="store_true",
+        default=False,
+        help=(
+            "Encode each distinct prompt once and expand its KV cache across the samples for that prompt, both in the "
+            "custom (twisted) generation loop (requires --generate_use_kv_cache) and in the scoring passes over the "
+            "generated sequences"
+        ),
+    )
+    parser.add_argument(
+        "--dpg_streaming",
+        action="store_true",
+        default=False,
+        help=(
+            "For the DPG loss, compute the expectation over the vocabulary in checkpointed time chunks from the final "
+            "hidden states, instead of materializing all-vocab base log probs and log psi (not supported for "
+            "policy_psi_q_p_s_1_to_t)"
+        ),
+    )
+    parser.add_argument(
+        "--sixo_cache_base_samples",
+        action="store_true",
+        default=False,
+        help=(
+            "For the SIXO loss, draw the base model negative samples once per rollout in make_experience and keep "
+            "them in the replay buffer, instead of generating them in every training micro-batch"
+        ),
+    )
+    parser.add_argument(
+        "--sixo_base_samples_refresh_every",
+        type=int,
+        default=1,
+        help=(
+            "With --sixo_cache_base_samples, reuse the base samples for up to this many rollouts while the prompts "
+            "are unchanged"
+        ),
+    )
+    parser.add_argument(
+        "--columnar_replay_buffer",
+        action="store_true",
+        default=False,
+        help=(
+            "Store the replay buffer as contiguous per-field columns with offsets instead of per-sample items; "
+            "batches are gathered and padded in one shot"
+        ),
+    )
+    parser.add_argument(
+        "--rollout_reuse_k",
+        type=int,
+        default=1,
+        help=(
+            "Keep each rollout (with its sampling log q) for up to this many ppo_train calls instead of discarding it "
+            "after one; 1 disables reuse"
+        ),
+    )
+    parser.add_argument(
+        "--rollout_reuse_min_ess",
+        type=float,
+        default=0.0,
+        help=(
+            "Evict a reused rollout once the ESS fraction of its importance weights under the current proposal falls "
+            "below this"
+        ),
+    )
+    parser.add_argument(
+        "--prefetch_micro_batches",
+        action="store_true",
+        default=False,
+        help=(
+            "Collate and pin the next training micro-batch in a background thread and copy it to the GPU on a side "
+            "stream while the current one trains (also for the harmlessness paired loaders)"
+        ),
+    )
+    parser.add_argument(
+        "--replay_buffer_scratch_dir",
+        type=str,
+        default=None,
+        help=(
+            "Keep the replay buffer in memory-mapped files under this directory instead of host RAM; training "
+            "micro-batches are gathered from the maps in a background thread"
+        ),
+    )
+    parser.add_argument(
+        "--packing_samples",
+        action="store_true",
+        default=False,
+        help=(
+            "Pack each training micro-batch from the replay buffer into a single row (varlen, needs --flash_attn) "
+            "instead of padding it"
+        ),
+    )
+    parser.add_argument(
+        "--length_grouped_sampling",
+        action="store_true",
+        default=False,
+        help=(
+            "Group replay buffer samples of similar length into the same training micro-batch to reduce padding "
+            "(prompt groups are kept intact for the non-PPO losses)"
+        ),
+    )
+    parser.add_argument(
+        "--cache_base_hidden_states",
+        action="store_true",
+        default=False,
+        help=(
+            "Store the base model's final hidden states on the action tokens in the replay buffer, so losses needing "
+            "all-vocab base log probs (DPG) or a modulation head do not re-run the base model every epoch"
+        ),
+    )
     parser.add_argument("--freezing_actor_steps", type=int, default=-1, help="Used for critic initialization")
     parser.add_argument(
         "--n_samples_per_prompt", type=int, default=1, help="number of responses for each prompt in generation. THIS DUPLICATION HAPPENS AT THE DATASET LEVEL"
@@ -820,7 +961,36 @@ if __name__ == "__main__":
     parser.add_argument("--save_info_path", type=str, default="./info")
     parser.add_argument("--n_samples_for_f_q", type=int, default=500, help="Number of samples to use for f_q (only for custom_single_prompt)")
     parser.add_argument("--n_seeds_f_q", type=int, default=4, help="Number of seeds to use for f_q")
-
+    parser.add_argument(
+        "--f_q_eval_batch_size",
+        type=int,
+        default=None,
+        help=(
+            "Max number of sequences generated at once in the F_q/IWAE evaluations; seeds are batched together, or "
+            "split into chunks, to fit this budget (default: one whole seed at a time)"
+        ),
+    )
+    parser.add_argument(
+        "--f_q_eval_tolerance",
+        type=float,
+        default=None,
+        help=(
+            "Adaptive F_q/IWAE evaluation: draw chunks of samples until the standard errors of F_q and of the IWAE "
+            "lower bound are below this (default: always draw n_samples_for_f_q)"
+        ),
+    )
+    parser.add_argument(
+        "--f_q_eval_max_samples",
+        type=int,
+        default=None,
+        help="Sample budget per seed of the adaptive evaluation (default: n_samples_for_f_q)",
+    )
+    parser.add_argument(
+        "--f_q_eval_adaptive_chunk_size",
+        type=int,
+        default=None,
+        help="Samples per seed drawn between the checks of the adaptive evaluation (default: n_samples_for_f_q // 10)",
+    )
 
     parser.add_argument("--update_steps_per_episode", type=int, default=1, help="Number of gradient updates (PPO loss outer loop) per episode")
     parser.add_argument("--exp_num_twist_updates", action="store_true", help="Use an exponentially increasing power of twist updates (base 2) instead of a set number of twist updates per epoch")
@@ -927,4 +1097,13 @@ if __name__ == "__main__":
     if args.rm_type == "indicator_below_threshold":
         assert args.target_dist_beta == 1 # otherwise multiply by beta screws things up
 
+    if args.rollout_reuse_k > 1:
+        assert not args.shared_actorcritic  # the reuse ESS needs the log q alone
+
+    if args.packing_samples:
+        assert args.flash_attn, "Only support `--packing_samples` with Flash Attention 2."
+        assert not args.shared_actorcritic  # not yet implemented for packed experiences
+        if args.actor_loss_type == "sixo":
+            assert args.sixo_cache_base_samples  # the base samples are packed alongside the experience
+
     train(args)
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import deepspeed
 import torch
@@ -11,7 +11,15 @@ from transformers import AutoModelForCausalLM, BitsAndBytesConfig, PreTrainedMod
 from transformers.deepspeed import HfDeepSpeedConfig
 
 from .packing_utils import patch_for_block_diag_attn
-from .utils import log_probs_from_logits, reset_position_ids
+from .utils import (
+    forward_with_shared_prefix,
+    gather_action_labels,
+    gather_action_outputs,
+    get_packed_seq_lens,
+    get_trunk_and_lm_head,
+    log_probs_from_logits,
+    reset_position_ids,
+)
 
 
 class Actor(nn.Module):
@@ -140,9 +148,6 @@ class Actor(nn.Module):
         if kwargs.get("max_length", None):
             generate_args["max_length"] = kwargs.get("max_length")
 
-        # Call generate
-        sequences = self.model.generate(**generate_args)
-
         # Prepare mask tensor
         eos_token_id = generate_args["eos_token_id"]
         pad_token_id = generate_args["pad_token_id"]
@@ -150,6 +155,27 @@ class Actor(nn.Module):
         # print(eos_token_id)
         # print(pad_token_id)
 
+        if kwargs.get("return_log_probs", False):
+            # Also return the log probs of the sampled tokens (and the entropy at each step) under the model,
+            # computed from the raw (unprocessed) logits of each generation step, so no re-forward is needed
+            output = self.model.generate(**generate_args, return_dict_in_generate=True, output_logits=True)
+            sequences, attention_mask, action_mask = self.process_sequences(
+                output.sequences, input_ids.size(1), eos_token_id, pad_token_id
+            )
+            action_log_probs, action_entropy = [], []
+            for t, step_logits in enumerate(output.logits):
+                step_log_probs = F.log_softmax(step_logits, dim=-1)
+                action_log_probs.append(
+                    step_log_probs.gather(dim=-1, index=sequences[:, input_ids.size(1) + t].unsqueeze(-1)).squeeze(-1)
+                )
+                action_entropy.append(torch.special.entr(step_log_probs.exp()).sum(dim=-1))
+            action_log_probs = torch.stack(action_log_probs, dim=1) * action_mask
+            action_entropy = torch.stack(action_entropy, dim=1) * action_mask
+            return sequences, attention_mask, action_mask, action_log_probs, action_entropy
+
+        # Call generate
+        sequences = self.model.generate(**generate_args)
+
         return self.process_sequences(sequences, input_ids.size(1), eos_token_id, pad_token_id)
 
     def process_sequences(self, sequences: torch.Tensor, input_len, eos_token_id, pad_token_id):
@@ -221,14 +247,19 @@ class Actor(nn.Module):
     def forward(
         self,
         sequences: torch.LongTensor,
-        num_actions: int = None,
+        num_actions: Optional[Union[int, List[int]]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         return_output: bool = False,
-        return_type: str = 'p',
+        return_type: str = "p",
         return_unnormalized: bool = False,
+        share_prompt_prefix: bool = False,
     ) -> torch.Tensor:
 
-        """Returns action log probs"""
+        """
+        Returns action log probs. With share_prompt_prefix, each distinct prompt is only encoded once (no-grad
+        scoring). For packed samples (a single row with a segment id attention mask), num_actions is the per-sample
+        list and the log probs come back left padded to [B, max(num_actions)].
+        """
         if not self.packing_samples:
             # https://github.com/OpenRLHF/OpenRLHF/issues/217
             position_ids = attention_mask.long().cumsum(-1) - 1
@@ -241,14 +272,36 @@ class Actor(nn.Module):
         # print(sequences.shape)
         # print(sequences)
 
-        output = self.model(sequences, attention_mask=attention_mask, position_ids=position_ids)
+        if share_prompt_prefix:
+            assert not return_output
+            # logits from the last prompt position onwards
+            logits = forward_with_shared_prefix(
+                self.model, sequences, attention_mask, position_ids, sequences.size(1) - num_actions
+            )
+        else:
+            output = self.model(sequences, attention_mask=attention_mask, position_ids=position_ids)
+            logits = output["logits"]
+        if isinstance(num_actions, list):
+            # packed samples: only the positions predicting each sample's actions, as a left padded [B, A] batch
+            assert not share_prompt_prefix
+            packed_seq_lens = get_packed_seq_lens(attention_mask)
+            action_logits = gather_action_outputs(logits, num_actions, packed_seq_lens)
+            labels = gather_action_labels(sequences, num_actions, packed_seq_lens)
+            num_actions = labels.size(1)
+        else:
+            action_logits = logits[:, :-1, :]
+            labels = sequences[:, -(logits.size(1) - 1) :]
 
         if return_type == "both":
             assert not return_output
-            log_probs_all, log_probs = log_probs_from_logits(output["logits"][:, :-1, :], sequences[:, 1:], return_type=return_type, return_unnormalized=return_unnormalized)
+            log_probs_all, log_probs = log_probs_from_logits(
+                action_logits, labels, return_type=return_type, return_unnormalized=return_unnormalized
+            )
             return log_probs_all[:, -num_actions:], log_probs[:, -num_actions:]
 
-        log_probs = log_probs_from_logits(output["logits"][:, :-1, :], sequences[:, 1:], return_type=return_type, return_unnormalized=return_unnormalized)
+        log_probs = log_probs_from_logits(
+            action_logits, labels, return_type=return_type, return_unnormalized=return_unnormalized
+        )
 
         # print("inspection of log probs - does no attention give 0 or something?")
         # print(log_probs)
@@ -272,6 +325,30 @@ class Actor(nn.Module):
         else:
             return log_probs[:, -num_actions:]
 
+    def action_hidden_states(
+        self, sequences: torch.LongTensor, num_actions: Union[int, List[int]], attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        """Final hidden states at the positions predicting the action tokens, (B, A, H). This is a compact form of the
+        all-vocab log probs, see log_probs_from_hidden_states"""
+        if not self.packing_samples:
+            position_ids = attention_mask.long().cumsum(-1) - 1
+        else:
+            position_ids = reset_position_ids(attention_mask)
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        trunk, _ = get_trunk_and_lm_head(self.model)
+        last_hidden_state = trunk(sequences, attention_mask=attention_mask, position_ids=position_ids)[
+            "last_hidden_state"
+        ]
+        packed_seq_lens = get_packed_seq_lens(attention_mask) if isinstance(num_actions, list) else None
+        return gather_action_outputs(last_hidden_state, num_actions, packed_seq_lens)
+
+    def log_probs_from_hidden_states(
+        self, hidden_states: torch.Tensor, labels: Optional[torch.LongTensor] = None, return_type: str = "p"
+    ):
+        """Applies the lm_head to hidden states from action_hidden_states and returns the log probs"""
+        _, lm_head = get_trunk_and_lm_head(self.model)
+        return log_probs_from_logits(lm_head(hidden_states), labels, return_type=return_type)
+
     def gradient_checkpointing_enable(self, gradient_checkpointing_kwargs={"use_reentrant": False}):
         self.model.gradient_checkpointing_enable(gradient_checkpointing_kwargs=gradient_checkpointing_kwargs)
 
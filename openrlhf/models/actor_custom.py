@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import deepspeed
 import torch
@@ -11,7 +11,19 @@ from transformers import AutoModelForCausalLM, BitsAndBytesConfig, PreTrainedMod
 from transformers.deepspeed import HfDeepSpeedConfig
 
 from .packing_utils import patch_for_block_diag_attn
-from .utils import log_probs_from_logits, log_probs_from_logits_with_modulation, reset_position_ids, return_or_gather_then_return
+from .utils import (
+    forward_with_shared_prefix,
+    gather_action_labels,
+    gather_action_outputs,
+    get_packed_seq_lens,
+    get_trunk_and_lm_head,
+    index_select_past_key_values,
+    log_probs_from_logits,
+    log_probs_from_logits_with_modulation,
+    reset_position_ids,
+    return_or_gather_then_return,
+    unique_prompt_rows,
+)
 from openrlhf.models.actor import Actor
 
 from transformers import LogitsProcessor
@@ -55,6 +67,59 @@ class NNHead(nn.Module):
 
 
 
+class GenerationState:
+    r"""
+    Preallocated [B, prompt_len + max_new_tokens] token and attention mask buffers for the custom generation loop.
+    New tokens are written in place and the model is given views of the filled prefix, instead of growing
+    the tensors with torch.cat (and copying everything so far) at every step.
+    """
+
+    def __init__(self, input_ids, attention_mask, max_new_tokens, pad_token_id):
+        batch_size, prompt_len = input_ids.shape
+        self.prompt_len = prompt_len
+        self.max_len = prompt_len + max_new_tokens
+        self.cur_len = prompt_len
+        # Per-step log q of the sampled tokens and entropy of the sampling distribution; allocated on first use
+        self.log_prob_buffer = None
+        self.entropy_buffer = None
+
+        self.token_buffer = input_ids.new_full((batch_size, self.max_len), pad_token_id)
+        self.token_buffer[:, :prompt_len] = input_ids
+        self.mask_buffer = attention_mask.new_zeros((batch_size, self.max_len))
+        self.mask_buffer[:, :prompt_len] = attention_mask
+
+    @property
+    def sequences(self):
+        return self.token_buffer[:, : self.cur_len]
+
+    @property
+    def attention_mask(self):
+        return self.mask_buffer[:, : self.cur_len]
+
+    def is_done(self):
+        return self.cur_len >= self.max_len
+
+    @property
+    def action_log_probs(self):
+        return None if self.log_prob_buffer is None else self.log_prob_buffer[:, : self.cur_len - self.prompt_len]
+
+    @property
+    def action_entropy(self):
+        return None if self.entropy_buffer is None else self.entropy_buffer[:, : self.cur_len - self.prompt_len]
+
+    def append(self, next_tokens, new_mask, log_probs=None, entropy=None):
+        if log_probs is not None:
+            if self.log_prob_buffer is None:
+                shape = (self.token_buffer.shape[0], self.max_len - self.prompt_len)
+                self.log_prob_buffer = log_probs.new_zeros(shape)
+                self.entropy_buffer = entropy.new_zeros(shape)
+            self.log_prob_buffer[:, self.cur_len - self.prompt_len] = log_probs
+            self.entropy_buffer[:, self.cur_len - self.prompt_len] = entropy
+        self.token_buffer[:, self.cur_len] = next_tokens
+        self.mask_buffer[:, self.cur_len] = new_mask
+        self.cur_len += 1
+
+
 class ActorCustom(nn.Module):
     """
     Modification of Actor model to also be able to output a modifier to the base model
@@ -126,9 +191,9 @@ class ActorCustom(nn.Module):
             self.packing_samples = packing_samples
             if packing_samples:
                 assert use_flash_attention_2, "Only support `--packing_samples` with Flash Attention 2."
-                model_type = getattr(self.model.config, "model_type", None)
+                # the head sits on the frozen base trunk, so patch the base model's attention
+                model_type = getattr(self.initial_model.model.config, "model_type", None)
                 patch_for_block_diag_attn(model_type)
-                raise NotImplementedError # Not yet tested for the head parameterization
 
         else:
 
@@ -252,6 +317,8 @@ class ActorCustom(nn.Module):
                  condition_twist_on_tokens=None, **kwargs):
         r"""
         CUSTOM. Only sample available right now.
+        With return_log_probs=True, also returns the log q of each sampled token and the entropy of the
+        sampling distribution at each step (both zero after EOS), so callers need not re-run the actor.
         """
         generate_args = {
             "input_ids": input_ids,
@@ -279,8 +346,9 @@ class ActorCustom(nn.Module):
         # sequences, attention_mask, action_mask = self.process_sequences(sequences, input_ids.size(1), eos_token_id, pad_token_id)
 
 
-        action_mask, attention_mask, sequences = self.custom_generate(
-            attention_mask, generate_args, input_ids, **kwargs)
+        action_mask, attention_mask, sequences, action_log_probs, action_entropy = self.custom_generate(
+            attention_mask, generate_args, input_ids, **kwargs
+        )
 
         # sequences, attention_mask, action_mask = self.process_sequences(sequences, input_ids.size(1), eos_token_id, pad_token_id)
 
@@ -289,53 +357,97 @@ class ActorCustom(nn.Module):
         # print("SEQ SHAPE")
         # print(sequences.shape)
 
+        if kwargs.get("return_log_probs", False):
+            return sequences, attention_mask, action_mask, action_log_probs, action_entropy
         return sequences, attention_mask, action_mask
 
     def custom_generate(self, attention_mask, generate_args, input_ids, **kwargs):
         max_new_tokens = kwargs.get("max_new_tokens")
-        max_len = max_new_tokens + input_ids.shape[-1]
         print(input_ids.shape)
-        sequences = input_ids.clone()
         eos_token_id = generate_args["eos_token_id"]
         pad_token_id = generate_args["pad_token_id"]
         
         # Initialize unfinished_sequences - a mask indicating which sequences are not finished
-        unfinished_sequences = torch.ones(sequences.shape[0], dtype=torch.long, device=sequences.device)
+        unfinished_sequences = torch.ones(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
         
         # Initialize attention mask for the full sequence length
         if attention_mask is None:
-            attention_mask = torch.ones_like(sequences, dtype=torch.long, device=sequences.device)
-        curr_attention_mask = attention_mask.clone()
-        
-        while sequences.shape[-1] < max_len:
+            attention_mask = torch.ones_like(input_ids, dtype=torch.long, device=input_ids.device)
+        state = GenerationState(input_ids, attention_mask, max_new_tokens, pad_token_id)
+
+        # With use_kv_cache, only the newly sampled token is run through the model(s) at each step,
+        # attending to the cached keys/values of the prompt and the previously sampled tokens
+        use_kv_cache = kwargs.get("use_kv_cache", False)
+        base_past_key_values, modulation_past_key_values = None, None
+        # With share_prompt_prefix (and use_kv_cache), each distinct prompt is prefilled once and its caches are
+        # expanded to all the rows sampling from it
+        share_prompt_prefix = kwargs.get("share_prompt_prefix", False)
+
+        # With compact_finished_sequences, rows that have emitted EOS are dropped from the batch the model runs on
+        # (along with their cache entries); their remaining positions are filled with padding in the full output
+        compact_finished_sequences = kwargs.get("compact_finished_sequences", False)
+        return_log_probs = kwargs.get("return_log_probs", False)
+        active_indices = torch.arange(input_ids.shape[0], device=input_ids.device)
+
+        while not state.is_done():
             # with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
             #                           profile_memory=True, record_shapes=True) as prof:
-            lm_logits = self.forward(
-                sequences,
-                num_actions=max_new_tokens,
+            if compact_finished_sequences:
+                active_sequences = state.sequences[active_indices]
+                active_attention_mask = state.attention_mask[active_indices]
+            else:
+                active_sequences = state.sequences
+                active_attention_mask = state.attention_mask
+
+            if use_kv_cache and share_prompt_prefix and base_past_key_values is None:
+                next_token_logits, base_past_key_values, modulation_past_key_values = self.prefill_shared_prompts(
+                    active_sequences, active_attention_mask
+                )
+            elif use_kv_cache:
+                new_input_ids = active_sequences if base_past_key_values is None else active_sequences[:, -1:]
+                next_token_logits, base_past_key_values, modulation_past_key_values = self.next_token_log_probs(
+                    new_input_ids,
+                    active_attention_mask,
+                    base_past_key_values=base_past_key_values,
+                    modulation_past_key_values=modulation_past_key_values,
+                )
+            else:
                 # TODO: note this might cause some issues; keeping it simple for now
                 # attention_mask=attention_mask,
-                attention_mask=curr_attention_mask,
-                # condition_twist_on_tokens=condition_twist_on_tokens
-                return_type="all_vocab",
-                use_for_generation=True
-            )
-
-            next_token_logits = lm_logits[:, -1, :]
+                next_token_logits, _, _ = self.next_token_log_probs(
+                    active_sequences, active_attention_mask, use_cache=False
+                )
 
             # sample
             probs = F.softmax(next_token_logits, dim=-1)
             next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
 
+            next_log_probs, next_entropy = None, None
+            if return_log_probs:
+                next_log_probs = next_token_logits.gather(dim=-1, index=next_tokens.unsqueeze(-1)).squeeze(-1)
+                next_entropy = torch.special.entr(probs).sum(dim=-1)
+
+            if compact_finished_sequences:
+                # scatter back into the full (padded) batch layout
+                active_next_tokens = next_tokens
+                next_tokens = torch.full_like(unfinished_sequences, pad_token_id)
+                next_tokens[active_indices] = active_next_tokens
+                if return_log_probs:
+                    active_log_probs, active_entropy = next_log_probs, next_entropy
+                    next_log_probs = active_log_probs.new_zeros(unfinished_sequences.shape)
+                    next_log_probs[active_indices] = active_log_probs
+                    next_entropy = active_entropy.new_zeros(unfinished_sequences.shape)
+                    next_entropy[active_indices] = active_entropy
+
             # finished sequences should have their next token be a padding token
             next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
+            if return_log_probs:
+                next_log_probs = next_log_probs * unfinished_sequences
+                next_entropy = next_entropy * unfinished_sequences
 
-            # update generated ids and model inputs
-            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
-
-            # update attention mask - new token is attended to if sequence is unfinished
-            new_mask = unfinished_sequences[:, None]
-            curr_attention_mask = torch.cat([curr_attention_mask, new_mask], dim=1)
+            # update generated ids and model inputs, and attention mask - new token is attended to if sequence is
+            # unfinished
+            state.append(next_tokens, unfinished_sequences, next_log_probs, next_entropy)
 
             # if eos_token was found in one sentence, set sentence to finished
             unfinished_sequences = unfinished_sequences.mul((next_tokens != eos_token_id).long())
@@ -344,14 +456,83 @@ class ActorCustom(nn.Module):
             if unfinished_sequences.max() == 0:
                 break
 
+            if compact_finished_sequences:
+                keep = unfinished_sequences[active_indices].nonzero().squeeze(-1)
+                if keep.numel() < active_indices.numel():
+                    active_indices = active_indices[keep]
+                    base_past_key_values = index_select_past_key_values(base_past_key_values, keep)
+                    modulation_past_key_values = index_select_past_key_values(modulation_past_key_values, keep)
+
             # print("PROFILE")
             # print(prof.key_averages().table(sort_by="self_cuda_memory_usage"))
 
         # Get final masks using process_sequences only once at the end
         sequences, attention_mask, action_mask = self.process_sequences(
-            sequences, input_ids.size(1), eos_token_id, pad_token_id)
-            
-        return action_mask, attention_mask, sequences
+            state.sequences.contiguous(), input_ids.size(1), eos_token_id, pad_token_id
+        )
+
+        action_log_probs, action_entropy = state.action_log_probs, state.action_entropy
+        if action_log_probs is not None:
+            # zero off the action mask, as in Actor.generate
+            action_log_probs, action_entropy = action_log_probs * action_mask, action_entropy * action_mask
+        return action_mask, attention_mask, sequences, action_log_probs, action_entropy
+
+    @torch.no_grad()
+    def prefill_shared_prompts(self, input_ids, attention_mask):
+        """
+        First cached generation step with each distinct prompt run only once. The next token log probs and the base
+        and modulation caches are then expanded back to the full batch.
+        """
+        first_indices, inverse = unique_prompt_rows(input_ids, attention_mask)
+        log_probs, base_past_key_values, modulation_past_key_values = self.next_token_log_probs(
+            input_ids[first_indices], attention_mask[first_indices]
+        )
+        return (
+            log_probs[inverse],
+            index_select_past_key_values(base_past_key_values, inverse),
+            index_select_past_key_values(modulation_past_key_values, inverse),
+        )
+
+    @torch.no_grad()
+    def next_token_log_probs(
+        self, input_ids, attention_mask, base_past_key_values=None, modulation_past_key_values=None, use_cache=True
+    ):
+        """
+        Forward for generation. input_ids holds only the tokens not yet in the caches (the whole sequence on the first
+        step or without caching, then just the last sampled token), while attention_mask covers the full sequence so
+        far. lm_head, modulation head and the normalization are applied to the final hidden state only, so this is
+        O(V) rather than O(T V) per step. Returns the twisted log probs (all vocab) for the next token, and the updated
+        base and modulation caches.
+        """
+        position_ids = self.get_position_ids(attention_mask)[:, -input_ids.shape[-1] :]
+
+        base_trunk, base_lm_head = get_trunk_and_lm_head(self.initial_model.model)
+        base_output = base_trunk(
+            input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=base_past_key_values,
+            use_cache=use_cache,
+        )
+        last_hidden_state = base_output["last_hidden_state"][:, -1, :]
+        base_logits = base_lm_head(last_hidden_state)
+
+        if self.use_modulation_head:
+            modulation_logits = self.modulation_head(last_hidden_state)
+        else:
+            modulation_trunk, modulation_lm_head = get_trunk_and_lm_head(self.model)
+            modulation = modulation_trunk(
+                input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=modulation_past_key_values,
+                use_cache=use_cache,
+            )
+            modulation_logits = modulation_lm_head(modulation["last_hidden_state"][:, -1, :])
+            modulation_past_key_values = modulation.get("past_key_values")
+
+        log_probs = log_probs_from_logits_with_modulation(base_logits, modulation_logits, return_type="all_vocab")
+        return log_probs, base_output.get("past_key_values"), modulation_past_key_values
 
     @torch.no_grad()
     def smc_procedure(self, input_ids: torch.Tensor, resample: bool = False, **kwargs) -> Union[
@@ -416,108 +597,155 @@ class ActorCustom(nn.Module):
     def forward(
         self,
         sequences: torch.LongTensor,
-        num_actions: int = None,
+        num_actions: Optional[Union[int, List[int]]] = None,
         attention_mask: Optional[torch.Tensor] = None,
         return_output=False,
-        return_type: str = 'p',
+        return_type: str = "p",
         return_only_modulation=False,
         use_for_generation=False,
+        share_prompt_prefix=False,
     ) -> torch.Tensor:
-        """Returns action log probs"""
-        position_ids = self.get_position_ids(attention_mask)
+        """
+        Returns action log probs. With share_prompt_prefix, each distinct prompt is only encoded once (no-grad
+        scoring). For packed samples, num_actions is the per-sample list (see Actor.forward).
+        """
+        if use_for_generation:
+            # In generation, do not shift by one; we only need the log probs of the next token after the last one
+            assert return_type == "all_vocab"
+            log_probs, _, _ = self.next_token_log_probs(sequences, attention_mask, use_cache=False)
+            return log_probs[:, None, :]
 
+        position_ids = self.get_position_ids(attention_mask)
+        # packed samples come back left padded to [B, max(num_actions)]
+        packed_seq_lens = get_packed_seq_lens(attention_mask) if isinstance(num_actions, list) else None
+        assert packed_seq_lens is None or not share_prompt_prefix
+        labels = gather_action_labels(sequences, num_actions, packed_seq_lens)
 
-        base_output = None
+        # Everything below only keeps the positions predicting the action tokens
         if self.use_modulation_head:
-            with torch.no_grad():
-                base_output = self.initial_model.model(sequences, attention_mask=attention_mask,
-                                                       position_ids=position_ids, output_hidden_states=True)
-            # Get the final hidden states from the base model
-            last_hidden_state = base_output.hidden_states[-1]
+            # Get the final hidden states from the base model (only the last layer is kept)
+            last_hidden_state = self.base_last_hidden_state(
+                sequences, attention_mask, position_ids, num_actions if share_prompt_prefix else None
+            )
+            last_hidden_state = gather_action_outputs(last_hidden_state, num_actions, packed_seq_lens)
             # Apply modulation head to get logits
             modulation_logits = self.modulation_head(last_hidden_state)
 
-            # print("last_hidden_state")
-            # print(last_hidden_state.shape)
-            # print(base_output.hidden_states[0].shape)
-            # print(base_output.hidden_states[1].shape)
-            # print(base_output.hidden_states[2].shape)
-            # print(base_output.hidden_states)
-
-
             # print("modulation_logits")
             # print(modulation_logits.shape)
             # print(modulation_logits.abs().mean())
             # 1/0
-            # print(self.initial_model.model.lm_head(last_hidden_state))
-            # print(base_output)
-            # print((self.initial_model.model.lm_head(last_hidden_state) - base_output.logits).abs().sum())
 
 
         else:
             # Use the full modulation model
-            modulation = self.model(sequences, attention_mask=attention_mask, position_ids=position_ids)
-            modulation_logits = modulation["logits"]
+            if share_prompt_prefix:
+                modulation_logits = forward_with_shared_prefix(
+                    self.model, sequences, attention_mask, position_ids, sequences.size(1) - num_actions
+                )
+            else:
+                modulation = self.model(sequences, attention_mask=attention_mask, position_ids=position_ids)
+                modulation_logits = modulation["logits"]
+            modulation_logits = gather_action_outputs(modulation_logits, num_actions, packed_seq_lens)
 
 
         if return_only_modulation:
-            assert not use_for_generation
-            modulation = modulation_logits[:, :-1, :][:, -num_actions:]
-            # labels = sequences[:, 1:]
-            labels = sequences[:, -num_actions:]
-            return return_or_gather_then_return(labels, modulation, return_type)
+            return return_or_gather_then_return(labels, modulation_logits, return_type)
 
             # modulation_on_selected_tokens = modulation.gather(dim=-1, index=labels.unsqueeze(-1))
             # return modulation_on_selected_tokens.squeeze(-1)[:, -num_actions:]
 
-        if base_output is None:
-            with torch.no_grad():
-                base_output = self.initial_model.model(sequences, attention_mask=attention_mask, position_ids=position_ids)
+        with torch.no_grad():
+            if self.use_modulation_head:
+                base_logits = self.initial_model.model.get_output_embeddings()(last_hidden_state)
+            else:
+                if share_prompt_prefix:
+                    base_logits = forward_with_shared_prefix(
+                        self.initial_model.model,
+                        sequences,
+                        attention_mask,
+                        position_ids,
+                        sequences.size(1) - num_actions,
+                    )
+                else:
+                    base_logits = self.initial_model.model(
+                        sequences, attention_mask=attention_mask, position_ids=position_ids
+                    )["logits"]
+                base_logits = gather_action_outputs(base_logits, num_actions, packed_seq_lens)
 
         if return_type == "all_vocab": # In the generation loop, need all logits for all vocab. Otherwise just need evaluation of the particular log_p
-            if use_for_generation: # In generation, do not shift by one; we need the final logits of the last token
-                log_probs = log_probs_from_logits_with_modulation(
-                    base_output["logits"],
-                    modulation_logits,
-                    return_type="all_vocab"
-                )
-
-            else: # Otherwise, not generating, do the same shift by one; this should only be used by DPG loss
-                # return_all_vocab = True
-                log_probs = log_probs_from_logits_with_modulation(
-                    base_output["logits"][:, :-1, :],
-                    modulation_logits[:, :-1, :],
-                    return_type="all_vocab"
-                )
-                # log_probs = log_probs_from_logits_with_modulation(
-                #     base_output["logits"], modulation_logits, sequences,
-                #     return_type="all_vocab"
-                # )
-            return log_probs[:, -num_actions:] # actually only need the very last one of this... [:, -1]
+            # Otherwise, not generating, do the same shift by one; this should only be used by DPG loss
+            # return_all_vocab = True
+            return log_probs_from_logits_with_modulation(base_logits, modulation_logits, return_type="all_vocab")
         elif return_type == "p":
             # return_all_vocab = False
             assert not return_output
             # if return_output:
             #     return output if num_actions is None else (log_probs[:, -num_actions:], output)
             # else:
-            log_probs = log_probs_from_logits_with_modulation(
-                base_output["logits"][:, :-1, :], 
-                modulation_logits[:, :-1, :], 
-                sequences[:, 1:], 
-                return_type='p'
-            )
-
-            return log_probs[:, -num_actions:]
+            return log_probs_from_logits_with_modulation(base_logits, modulation_logits, labels, return_type="p")
         elif return_type == "both":
-            log_probs_all, log_probs = log_probs_from_logits_with_modulation(
-                base_output["logits"][:, :-1, :],
-                modulation_logits[:, :-1, :],
-                sequences[:, 1:],
-                return_type="both"
-            )
+            return log_probs_from_logits_with_modulation(base_logits, modulation_logits, labels, return_type="both")
+
 
-            return log_probs_all[:, -num_actions:], log_probs[:, -num_actions:]
+    @torch.no_grad()
+    def base_last_hidden_state(self, sequences, attention_mask, position_ids, shared_prefix_num_actions=None):
+        """
+        Final (normed) hidden states of the frozen base model, without materializing every layer's hidden states.
+        With shared_prefix_num_actions, distinct prompts are encoded once and only the states from the last prompt
+        position onwards are returned.
+        """
+        base_trunk, _ = get_trunk_and_lm_head(self.initial_model.model)
+        if shared_prefix_num_actions is not None:
+            return forward_with_shared_prefix(
+                base_trunk,
+                sequences,
+                attention_mask,
+                position_ids,
+                sequences.size(1) - shared_prefix_num_actions,
+                output_key="last_hidden_state",
+            )
+        return base_trunk(sequences, attention_mask=attention_mask, position_ids=position_ids)["last_hidden_state"]
 
+    def forward_with_base(
+        self, sequences, num_actions, attention_mask, return_type="p", return_log_q=True, share_prompt_prefix=False
+    ):
+        """
+        Single frozen-trunk pass for the modulation head parameterizations. Returns the base log p, the modulation
+        (log psi) and, if return_log_q, the twisted log q on the action tokens. With return_type="both", each of these
+        is an (all_vocab, on_action_tokens) pair. Only the modulation carries gradients.
+        """
+        assert self.use_modulation_head
+        position_ids = self.get_position_ids(attention_mask)
+        packed_seq_lens = get_packed_seq_lens(attention_mask) if isinstance(num_actions, list) else None
+        labels = gather_action_labels(sequences, num_actions, packed_seq_lens)
+
+        last_hidden_state = self.base_last_hidden_state(
+            sequences, attention_mask, position_ids, num_actions if share_prompt_prefix else None
+        )
+        last_hidden_state = gather_action_outputs(last_hidden_state, num_actions, packed_seq_lens)
+        with torch.no_grad():
+            base_logits = self.initial_model.model.get_output_embeddings()(last_hidden_state)
+            base_log_probs = log_probs_from_logits(base_logits, labels, return_type=return_type)
+        modulation_logits = self.modulation_head(last_hidden_state)
+        modulation = return_or_gather_then_return(labels, modulation_logits, return_type)
+
+        if not return_log_q:
+            return base_log_probs, modulation
+        log_probs = log_probs_from_logits_with_modulation(
+            base_logits, modulation_logits, labels, return_type=return_type
+        )
+        return base_log_probs, modulation, log_probs
+
+    def action_hidden_states(self, sequences, num_actions, attention_mask):
+        """Final hidden states of the modulation model at the positions predicting the action tokens, (B, A, H)"""
+        assert not self.use_modulation_head
+        modulation_trunk, _ = get_trunk_and_lm_head(self.model)
+        last_hidden_state = modulation_trunk(
+            sequences, attention_mask=attention_mask, position_ids=self.get_position_ids(attention_mask)
+        )["last_hidden_state"]
+        packed_seq_lens = get_packed_seq_lens(attention_mask) if isinstance(num_actions, list) else None
+        return gather_action_outputs(last_hidden_state, num_actions, packed_seq_lens)
 
     def get_position_ids(self, attention_mask):
         if not self.packing_samples:
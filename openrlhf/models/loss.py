@@ -4,6 +4,7 @@ import torch
 import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from .utils import masked_mean
 
@@ -253,39 +254,6 @@ class ValueLoss(nn.Module):
         return 0.5 * loss
 
 
-def get_positive_and_negative_weights_detached(base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples):
-
-    # Now let's just do the standard CTL loss... all we have is just the p * phi / q for reweighting here...
-    # Sum across the t dimension to ensure we have the log prob of the FULL SEQUENCE
-    log_w_t_approx_sigma_samples = get_positive_weights_detached(base_action_log_probs, curr_log_probs, final_reward)
-    # print(log_psi_t_eval_list_proposal_samples)
-    # print(log_psi_t_eval_list_proposal_samples.shape)
-    # print(base_action_log_probs.cumsum(dim=1).shape)
-    # print(curr_log_probs.cumsum(dim=1).shape)
-    log_w_t_approx_pi_samples = base_action_log_probs.cumsum(
-        dim=1) + log_psi_t_eval_list_proposal_samples - curr_log_probs.cumsum(
-        dim=1)  # because here our IS weights are p * psi in numerator, as in our previous paper, divided by q. And with values = log psi, and us working in log space, this is what we get. Note that we are reweighting according to p(s_1:t) psi_t(s_1:t) / q(s_1:t) which is why we have cumsum
-    log_w_t_approx_pi_samples = log_w_t_approx_pi_samples.detach()
-    # print(log_psi_t_eval_list_proposal_samples.shape) # EXPECTED: (batch_size, seq_len)
-    # print("Log Wgt shapes")
-    # print(log_w_t_approx_sigma_samples.shape) # Expected: (batch_size)
-    # print(log_w_t_approx_pi_samples.shape) # Expected: (batch_size, seq_len)
-    # normalized_w_t_sigma_samples = F.softmax(
-    #     log_w_t_approx_sigma_samples.detach())
-    # log_psi_on_truncated_proposal_samples = values
-    # print("Wgt shapes")
-    if len(log_w_t_approx_sigma_samples.shape) > 1:
-        raise NotImplementedError # dim 0 will be wrong if you use this with batch over diff prompts.
-
-    normalized_w_t_approx_sigma_samples = F.softmax(log_w_t_approx_sigma_samples,
-                                                    dim=0)  # do softmax along the batch dimension, which is -1
-    # print(normalized_w_t_approx_sigma_samples.shape)
-    # EXPECTED: above has shape (batch_size)
-
-
-    return log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples
-
-
 def get_positive_weights_detached(base_action_log_probs, curr_log_probs, final_reward):
     log_w_t_approx_sigma_samples = base_action_log_probs.sum(dim=-1) + final_reward - curr_log_probs.sum(
         dim=-1)  # why this: well, the target is base * phi, then denom for IS is q.
@@ -304,43 +272,19 @@ def get_normalized_positive_weights_detached(base_action_log_probs, curr_log_pro
 
 
 def get_positive_and_negative_weights_detached_incremental(base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples):
-    log_p_1_to_t_psi_1_to_t = base_action_log_probs.cumsum(dim=1) + log_psi_t_eval_list_proposal_samples
-    log_w_t = 0
-    negative_weights = []
-
-    # log_w_t_approx_pi_samples_ref = base_action_log_probs.cumsum(
-    #     dim=1) + log_psi_t_eval_list_proposal_samples - curr_log_probs.cumsum(
-    #     dim=1)
-
-    for i in range(base_action_log_probs.shape[-1]):
-        if i == 0:
-            incremental_w_t = log_p_1_to_t_psi_1_to_t[:, 0] - curr_log_probs[:, 0]
-            log_w_t += incremental_w_t # BE CAREFUL - THIS IN-PLACE OPERATION MODIFIES MUTABLE STRUCTURES LIKE LISTS; THIS IS WHY JAX DOESN'T ALLOW THIS KIND OF STUFF
-        elif i == base_action_log_probs.shape[-1] - 1:
-            incremental_w_t = base_action_log_probs.cumsum(dim=1)[:, -1] + final_reward - curr_log_probs[:, i] - log_p_1_to_t_psi_1_to_t[:, i - 1]
-            positive_total_weight = incremental_w_t + log_w_t
-            negative_incremental_w_t = log_p_1_to_t_psi_1_to_t[:, i] - curr_log_probs[:, i] - log_p_1_to_t_psi_1_to_t[:, i - 1]
-            log_w_t += negative_incremental_w_t # BE CAREFUL - THIS IN-PLACE OPERATION MODIFIES MUTABLE STRUCTURES LIKE LISTS; THIS IS WHY JAX DOESN'T ALLOW THIS KIND OF STUFF
-        else:
-            incremental_w_t = log_p_1_to_t_psi_1_to_t[:, i] - curr_log_probs[:, i] - log_p_1_to_t_psi_1_to_t[:, i - 1]
-            log_w_t += incremental_w_t # BE CAREFUL - THIS IN-PLACE OPERATION MODIFIES MUTABLE STRUCTURES LIKE LISTS; THIS IS WHY JAX DOESN'T ALLOW THIS KIND OF STUFF
-
-        # print(f'iter {i}')
-        # print(log_w_t)
-        # print(log_w_t_approx_pi_samples_ref[:, i])
-        # print(torch.abs(log_w_t_approx_pi_samples_ref[:, i] - log_w_t).mean())
-
-        negative_weights.append(log_w_t.detach().clone()) # CLONE IS VERY IMPORTANT HERE
-    normalized_w_t_approx_sigma_samples = F.softmax(positive_total_weight, dim=0).detach()  # do softmax along the batch dimension
-
-    # # DETACH ON WEIGHTS IS IMPORTANT FOR THE RIGHT GRADIENTS
-    # print("final comparison")
-    negative_weights = torch.stack(negative_weights, dim=1).detach()
-    # print(negative_weights - log_w_t_approx_pi_samples_ref)
-    # print(torch.abs(negative_weights - log_w_t_approx_pi_samples_ref).mean())
-
-    # print("Final val 2")
-    # print(negative_weights)
+    """
+    Incremental importance weights for samples laid out as (batch, seq_len) or (prompts, batch, seq_len).
+    The increments log p(s_t | s_1:t-1) + log psi_t - log psi_t-1 - log q(s_t | s_1:t-1) telescope, so the running
+    weight at t is log p(s_1:t) + log psi_t(s_1:t) - log q(s_1:t), and the final (positive) weight swaps psi_T for phi.
+    Returns the detached negative log weights and the positive weights normalized over the batch dim.
+    """
+    # Equivalent to accumulating the increments one time step at a time (tests/test_ctl_weights.py keeps that loop)
+    negative_weights = (
+        base_action_log_probs.cumsum(dim=-1) + log_psi_t_eval_list_proposal_samples - curr_log_probs.cumsum(dim=-1)
+    ).detach()
+    positive_total_weight = get_positive_weights_detached(base_action_log_probs, curr_log_probs, final_reward)
+    # do softmax along the batch dimension
+    normalized_w_t_approx_sigma_samples = F.softmax(positive_total_weight, dim=-1)
 
     return negative_weights, normalized_w_t_approx_sigma_samples
 
@@ -405,13 +349,11 @@ class CTLLoss(nn.Module):
 
         if reduce_mean_per_prompt:
             # This version is for batching over different prompts
-            # Use vmap to compute weights for all prompts at once
-            batched_get_weights = torch.func.vmap(get_positive_and_negative_weights_detached, in_dims=0)
-            log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = batched_get_weights(
-                base_action_log_probs,
-                curr_log_probs,
-                final_reward,
-                values
+            # The weights are computed for all prompts at once, normalizing within each prompt's samples
+            log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = (
+                get_positive_and_negative_weights_detached_incremental(
+                    base_action_log_probs, curr_log_probs, final_reward, values
+                )
             )
 
             # Compute terms using the vectorized weights
@@ -471,12 +413,11 @@ class CTLLoss(nn.Module):
 
         # print("CTL LOSS STUFF")
         log_psi_t_eval_list_proposal_samples = values
-        log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = get_positive_and_negative_weights_detached(
-            base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples)
-
-        # log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = get_positive_and_negative_weights_detached_incremental(
-        #     base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples)
-        # TODO REMOVE ABOVE LATER COMPARISON ONLY
+        log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = (
+            get_positive_and_negative_weights_detached_incremental(
+                base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples
+            )
+        )
         # print("FINAL")
         # print(torch.abs(log_w_t_approx_pi_samples2 - log_w_t_approx_pi_samples))
         # print(torch.abs(log_w_t_approx_pi_samples2 - log_w_t_approx_pi_samples).mean())
@@ -617,19 +558,11 @@ class SIXOLoss(nn.Module):
 
         if reduce_mean_per_prompt:
             # This version is for batching over different prompts
-            # Use vmap to compute weights for all prompts at once
-            batched_get_weights = torch.func.vmap(get_normalized_positive_weights_detached, in_dims=0)
-            # log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = batched_get_weights(
-            #     base_action_log_probs,
-            #     curr_log_probs,
-            #     final_reward,
-            #     values
-            # )
-            normalized_w_t_approx_sigma_samples = batched_get_weights(
+            # The weights are computed for all prompts at once, normalizing within each prompt's samples
+            normalized_w_t_approx_sigma_samples = get_normalized_positive_weights_detached(
                 base_action_log_probs,
                 curr_log_probs,
                 final_reward,
-                # values
             )
 
             # Compute positive term with batched weights
@@ -688,8 +621,6 @@ class SIXOLoss(nn.Module):
         # print(base_action_log_probs.sum(dim=-1).shape)
 
         log_psi_t_eval_list_proposal_samples = values
-        # log_w_t_approx_pi_samples, normalized_w_t_approx_sigma_samples = get_positive_and_negative_weights_detached(
-        #     base_action_log_probs, curr_log_probs, final_reward, log_psi_t_eval_list_proposal_samples)
         normalized_w_t_approx_sigma_samples = get_normalized_positive_weights_detached(
             base_action_log_probs, curr_log_probs, final_reward)
 
@@ -780,6 +711,37 @@ class SIXOLoss(nn.Module):
         return loss.float()
 
 
+def _dpg_terms_chunk(log_p_and_log_psi_fn, labels, *hidden_states):
+    log_p_all, log_psi_all = log_p_and_log_psi_fn(*hidden_states)
+    normalized_p_psi_all = torch.softmax(log_p_all + log_psi_all, dim=-1).detach()  # no gradient through the weights
+    expected_log_psi = (normalized_p_psi_all * log_psi_all).sum(dim=-1)
+    log_psi = log_psi_all.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+    log_p = log_p_all.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1).detach()
+    return expected_log_psi, log_psi, log_p
+
+
+def get_dpg_terms_chunked(log_p_and_log_psi_fn, labels, *hidden_states, chunk_size: int = 16):
+    """
+    Per-token DPG terms without holding any (B, T, V) tensor for the backward. log_p_and_log_psi_fn maps time chunks
+    of the hidden states (B, T, H) to the all-vocab (log p, log psi) for those positions. Each chunk is checkpointed,
+    so the heads are re-applied to the chunk in the backward and only per-token values are kept.
+    Returns E_{p psi}[log psi], log psi and log p (detached) on the labels, each of shape (B, T).
+    """
+    expected_log_psi, log_psi, log_p = [], [], []
+    for start in range(0, labels.size(1), chunk_size):
+        outputs = checkpoint(
+            _dpg_terms_chunk,
+            log_p_and_log_psi_fn,
+            labels[:, start : start + chunk_size],
+            *[hidden[:, start : start + chunk_size] for hidden in hidden_states],
+            use_reentrant=False,
+        )
+        expected_log_psi.append(outputs[0])
+        log_psi.append(outputs[1])
+        log_p.append(outputs[2])
+    return torch.cat(expected_log_psi, dim=1), torch.cat(log_psi, dim=1), torch.cat(log_p, dim=1)
+
+
 class DPGLoss(nn.Module):
     """
     DPG policy learning loss
@@ -796,9 +758,14 @@ class DPGLoss(nn.Module):
         action_mask: torch.Tensor,
         curr_log_probs: torch.Tensor,
         base_action_log_probs: torch.Tensor,
-        log_psi_all_vocab: torch.Tensor,
-        base_action_log_probs_all_vocab: torch.Tensor,
+        log_psi_all_vocab: Optional[torch.Tensor] = None,
+        base_action_log_probs_all_vocab: Optional[torch.Tensor] = None,
+        expected_log_psi: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
+        """
+        Either the all-vocab base log probs and log psi, or expected_log_psi = E_{p psi}[log psi] per token
+        (see get_dpg_terms_chunked), must be given.
+        """
         if len(values.shape) == 3:
             reduce_mean_per_prompt = True
         elif len(values.shape) == 2:
@@ -819,14 +786,11 @@ class DPGLoss(nn.Module):
 
         if reduce_mean_per_prompt:
             # This version is for batching over different prompts
-            # Use vmap to compute weights for all prompts at once
-            batched_get_weights = torch.func.vmap(get_normalized_positive_weights_detached, in_dims=0)
-            normalized_w_t_approx_sigma_samples = batched_get_weights(
+            # The weights are computed for all prompts at once, normalizing within each prompt's samples
+            normalized_w_t_approx_sigma_samples = get_normalized_positive_weights_detached(
                 base_action_log_probs,
                 curr_log_probs,
                 final_reward,
-                # values
-                return_normalized=True
             )
 
             # # Compute terms using the vectorized weights
@@ -857,12 +821,17 @@ class DPGLoss(nn.Module):
         positive_samples_term = log_psi_t_eval_list_proposal_samples
 
 
-        normalized_p_psi_all_vocab = torch.softmax(base_action_log_probs_all_vocab + log_psi_all_vocab, dim=-1).detach() # IMPORTANT: need not to propagate through weights
-
-        # get all logits - a bit annoying since you have to modify the forward calls in both actor and actor_custom to produce all logits, and then do the sum/reduce over them
-        negative_samples_term = (
-            normalized_p_psi_all_vocab * log_psi_all_vocab).sum(
-            axis=-1)  # The log psi is where we'll get the gradient (grad Q), and then the sum does the expectation over q(s_t | s_1:t-1)
+        if expected_log_psi is not None:
+            negative_samples_term = expected_log_psi
+        else:
+            normalized_p_psi_all_vocab = torch.softmax(
+                base_action_log_probs_all_vocab + log_psi_all_vocab, dim=-1
+            ).detach()  # IMPORTANT: need not to propagate through weights
+
+            # get all logits - a bit annoying since you have to modify the forward calls in both actor and actor_custom to produce all logits, and then do the sum/reduce over them
+            negative_samples_term = (normalized_p_psi_all_vocab * log_psi_all_vocab).sum(
+                axis=-1
+            )  # The log psi is where we'll get the gradient (grad Q), and then the sum does the expectation over q(s_t | s_1:t-1)
         # Mean along the time dimension, again we can debate if we want to use sum. Just be consistent, that's the most important.
 
 
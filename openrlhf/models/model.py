@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 
 import deepspeed
 import torch
@@ -10,7 +10,7 @@ from transformers.deepspeed import HfDeepSpeedConfig
 from transformers.dynamic_module_utils import get_class_from_dynamic_module
 
 from .packing_utils import patch_for_block_diag_attn
-from .utils import reset_position_ids
+from .utils import forward_with_shared_prefix, gather_action_outputs, get_packed_seq_lens, reset_position_ids
 from openrlhf.utils.logging_utils import init_logger
 
 logger = init_logger(__name__)
@@ -397,7 +397,11 @@ def _get_critic_model(base_pretrained_model, base_llm_model, value_head_prefix="
             action_mask: Optional[torch.Tensor] = None,
             attention_mask: Optional[torch.Tensor] = None,
             return_output=False,
+            share_prompt_prefix=False,
+            num_actions: Optional[List[int]] = None,
         ) -> torch.Tensor:
+            """Values on the action positions. For packed samples, num_actions is the per-sample list and the values
+            come back left padded like action_mask"""
             if not self.packing_samples:
                 # https://github.com/OpenRLHF/OpenRLHF/issues/217
                 position_ids = attention_mask.long().cumsum(-1) - 1
@@ -406,12 +410,36 @@ def _get_critic_model(base_pretrained_model, base_llm_model, value_head_prefix="
                 position_ids = reset_position_ids(attention_mask)
             position_ids.masked_fill_(attention_mask == 0, 1)
 
-            outputs = getattr(self, self.base_model_prefix)(
-                input_ids, attention_mask=attention_mask, position_ids=position_ids
-            )
-            last_hidden_states = outputs["last_hidden_state"]
-            values = getattr(self, self.value_head_prefix)(last_hidden_states).squeeze(-1)[:, :-1] # Ok here it is, this part is ok then
-            num_actions = action_mask.size(1)
+            if num_actions is None:
+                num_actions = action_mask.size(1)
+            if share_prompt_prefix:
+                # each distinct prompt is encoded once; hidden states start at the last prompt position
+                assert not return_output
+                last_hidden_states = forward_with_shared_prefix(
+                    getattr(self, self.base_model_prefix),
+                    input_ids,
+                    attention_mask,
+                    position_ids,
+                    input_ids.size(1) - num_actions,
+                    output_key="last_hidden_state",
+                )
+            else:
+                outputs = getattr(self, self.base_model_prefix)(
+                    input_ids, attention_mask=attention_mask, position_ids=position_ids
+                )
+                last_hidden_states = outputs["last_hidden_state"]
+            if isinstance(num_actions, list):
+                # packed samples: only run the value head on the action positions
+                assert not share_prompt_prefix
+                last_hidden_states = gather_action_outputs(
+                    last_hidden_states, num_actions, get_packed_seq_lens(attention_mask)
+                )
+                values = getattr(self, self.value_head_prefix)(last_hidden_states).squeeze(-1)
+                num_actions = values.size(1)
+            else:
+                values = getattr(self, self.value_head_prefix)(last_hidden_states).squeeze(-1)[
+                    :, :-1
+                ]  # Ok here it is, this part is ok then
 
             # normalize reward
             if self.normalize_reward:
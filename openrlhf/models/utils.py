@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import bitsandbytes as bnb
 import deepspeed
@@ -122,9 +122,69 @@ def compute_reward(
     return reward, kl
 
 
+class _ChunkedLabelLogProbs(torch.autograd.Function):
+    """
+    log_softmax(logits + modulation)[..., label] computed as z[label] - logsumexp(z), z = logits + modulation, over
+    chunks of the time dim (dim 1), in fp32. Only the per-position logsumexp is saved, and the backward
+    (onehot - softmax(z), shared by both inputs) is rebuilt chunk by chunk, so no [B, T, V] log-softmax or softmax
+    buffer is ever allocated besides the gradients themselves. modulation may be None.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, modulation, labels, chunk_size):
+        log_probs = torch.empty(labels.shape, dtype=torch.float32, device=logits.device)
+        logsumexp = torch.empty(labels.shape, dtype=torch.float32, device=logits.device)
+        for start in range(0, logits.size(1), chunk_size):
+            z = logits[:, start : start + chunk_size].float()
+            if modulation is not None:
+                z = z + modulation[:, start : start + chunk_size].float()
+            labels_chunk = labels[:, start : start + chunk_size]
+            logsumexp_chunk = torch.logsumexp(z, dim=-1)
+            logsumexp[:, start : start + chunk_size] = logsumexp_chunk
+            log_probs[:, start : start + chunk_size] = (
+                z.gather(dim=-1, index=labels_chunk.unsqueeze(-1)).squeeze(-1) - logsumexp_chunk
+            )
+        ctx.save_for_backward(logits, modulation, labels, logsumexp)
+        ctx.chunk_size = chunk_size
+        return log_probs.to(logits.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, modulation, labels, logsumexp = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        logits_needs_grad, modulation_needs_grad = ctx.needs_input_grad[0], ctx.needs_input_grad[1]
+        grad_logits = torch.empty_like(logits) if logits_needs_grad else None
+        grad_modulation = torch.empty_like(modulation) if modulation_needs_grad else None
+        for start in range(0, logits.size(1), chunk_size):
+            grad_chunk = grad_output[:, start : start + chunk_size].float().unsqueeze(-1)
+            z = logits[:, start : start + chunk_size].float()
+            if modulation is not None:
+                z = z + modulation[:, start : start + chunk_size].float()
+            grad = -grad_chunk * torch.exp(z - logsumexp[:, start : start + chunk_size, None])
+            grad.scatter_add_(-1, labels[:, start : start + chunk_size].unsqueeze(-1), grad_chunk)
+            if logits_needs_grad:
+                grad_logits[:, start : start + chunk_size] = grad
+            if modulation_needs_grad:
+                grad_modulation[:, start : start + chunk_size] = grad
+        return grad_logits, grad_modulation, None, None
+
+
+def chunked_log_probs_from_logits(
+    logits: torch.Tensor, labels: torch.Tensor, chunk_size: int = 64, modulation: Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Log probs of labels (B, T) under logits (B, T, V) without materializing the (B, T, V) log-softmax. With a
+    modulation, these are the twisted log q = log_softmax(log_softmax(logits) + modulation)
+    = log_softmax(logits + modulation).
+    """
+    return _ChunkedLabelLogProbs.apply(logits, modulation, labels, chunk_size)
+
+
 def log_probs_from_logits(logits: torch.Tensor, labels: torch.Tensor, return_type: str = 'p', return_unnormalized=False) -> torch.Tensor:
     if return_unnormalized:
         return return_or_gather_then_return(labels, logits, return_type)
+    if return_type == "p":
+        return chunked_log_probs_from_logits(logits, labels)
 
     log_probs_all_vocab = F.log_softmax(logits, dim=-1)
     # print("log probs full")
@@ -148,21 +208,115 @@ def return_or_gather_then_return(labels, log_probs_all_vocab, return_type):
 def log_probs_from_logits_with_modulation(
     logits: torch.Tensor, modulation: torch.Tensor, labels: Optional[torch.Tensor] = None, return_type: str = 'p'
 ) -> torch.Tensor:
-
-    log_probs_base = F.log_softmax(logits, dim=-1)
-    log_probs_plus_modulation = log_probs_base + modulation
-    # print("MODULATION")
-    # print(modulation)
-    new_log_probs = F.log_softmax(log_probs_plus_modulation, dim=-1)
+    # log_softmax(log_softmax(logits) + modulation) == log_softmax(logits + modulation): the base normalizer is a
+    # per-position constant, so a single normalization over logits + modulation is enough
+    if return_type == "p":
+        return chunked_log_probs_from_logits(logits, labels, modulation=modulation)
+    new_log_probs = F.log_softmax(logits + modulation, dim=-1)
 
     return return_or_gather_then_return(labels, new_log_probs, return_type)
-    # log_probs_all_vocab = F.log_softmax(log_probs_plus_modulation, dim=-1)
-    # if return_type == "all_vocab":
-    #     return log_probs_all_vocab
-    # log_probs_labels = log_probs_all_vocab.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
-    # if return_type == "both":
-    #     return log_probs_all_vocab, log_probs_labels
-    # return log_probs_labels
+
+
+def get_trunk_and_lm_head(model: nn.Module) -> Tuple[nn.Module, nn.Module]:
+    """
+    Split a HF causal LM into its transformer trunk (outputs last_hidden_state, already final-normed)
+    and its lm_head, so that heads can be applied to only the hidden states that are actually needed.
+    """
+    return getattr(model, model.base_model_prefix), model.get_output_embeddings()
+
+
+def index_select_past_key_values(past_key_values, index: torch.Tensor):
+    """
+    Select (or repeat) batch rows of a KV cache, either in the legacy tuple-of-tuples format
+    or as a transformers Cache object.
+    """
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "to_legacy_cache"):
+        legacy_cache = index_select_past_key_values(past_key_values.to_legacy_cache(), index)
+        return type(past_key_values).from_legacy_cache(legacy_cache)
+    return tuple(tuple(tensor.index_select(0, index) for tensor in layer_past) for layer_past in past_key_values)
+
+
+def unique_prompt_rows(input_ids: torch.Tensor, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Finds the distinct rows of a (left padded) prompt batch, e.g. the copies made by tile_prompts. Returns the index
+    of the first occurrence of each distinct row and, for every row, the position of its distinct row in that index.
+    """
+    rows = torch.cat([input_ids, attention_mask.to(input_ids.dtype)], dim=-1)
+    _, inverse = torch.unique(rows, dim=0, return_inverse=True)
+    batch_index = torch.arange(rows.size(0), device=rows.device)
+    first_indices = torch.full((int(inverse.max()) + 1,), rows.size(0), dtype=batch_index.dtype, device=rows.device)
+    first_indices = first_indices.scatter_reduce(0, inverse, batch_index, reduce="amin")
+    return first_indices, inverse
+
+
+def forward_with_shared_prefix(
+    model: nn.Module,
+    sequences: torch.LongTensor,
+    attention_mask: torch.Tensor,
+    position_ids: torch.Tensor,
+    prefix_len: int,
+    output_key: str = "logits",
+) -> torch.Tensor:
+    """
+    Runs a HF model (or its trunk) on sequences whose first prefix_len tokens (the prompts) repeat across rows. Each
+    distinct prompt is prefilled once and its KV cache is expanded to the rows sharing it, then only the remaining
+    tokens are run. Returns output[output_key] for positions prefix_len - 1 onwards, i.e. the positions that predict
+    the tokens after the prompt. Meant for no-grad scoring passes.
+    """
+    first_indices, inverse = unique_prompt_rows(sequences[:, :prefix_len], attention_mask[:, :prefix_len])
+    if first_indices.numel() == sequences.size(0):
+        output = model(sequences, attention_mask=attention_mask, position_ids=position_ids)
+        return output[output_key][:, prefix_len - 1 :]
+
+    prefix_output = model(
+        sequences[first_indices, :prefix_len],
+        attention_mask=attention_mask[first_indices, :prefix_len],
+        position_ids=position_ids[first_indices, :prefix_len],
+        use_cache=True,
+    )
+    past_key_values = index_select_past_key_values(prefix_output["past_key_values"], inverse)
+    suffix_output = model(
+        sequences[:, prefix_len:],
+        attention_mask=attention_mask,
+        position_ids=position_ids[:, prefix_len:],
+        past_key_values=past_key_values,
+        use_cache=False,
+    )
+    return torch.cat([prefix_output[output_key][inverse, -1:], suffix_output[output_key]], dim=1)
+
+
+def discounted_reverse_cumsum(x: torch.Tensor, discount: float, chunk_size: int = 128) -> torch.Tensor:
+    """
+    y[:, t] = x[:, t] + discount * y[:, t + 1] along the last dim, without a Python loop over time steps.
+    Within a chunk this is a matmul with the (discount^(j - i))_{j >= i} power matrix; chunks are scanned from the end,
+    carrying y at the start of the later chunk. chunk_size bounds both the matrix size and the powers of discount.
+    """
+    length = x.size(-1)
+    chunk_size = min(chunk_size, length)
+    steps = torch.arange(chunk_size, device=x.device)
+    exponents = steps[None, :] - steps[:, None]
+    power_matrix = torch.where(
+        exponents >= 0,
+        torch.full_like(exponents, discount, dtype=x.dtype).pow(exponents.clamp(min=0)),
+        torch.zeros((), dtype=x.dtype, device=x.device),
+    )
+    # discount^(chunk length - i), applied to the carry
+    carry_powers = torch.full((chunk_size,), discount, dtype=x.dtype, device=x.device).pow(chunk_size - steps)
+
+    out = torch.empty_like(x)
+    carry = None
+    for end in range(length, 0, -chunk_size):
+        start = max(end - chunk_size, 0)
+        n = end - start
+        y = x[..., start:end] @ power_matrix[:n, :n].T
+        if carry is not None:
+            y = y + carry[..., None] * carry_powers[chunk_size - n :]
+        out[..., start:end] = y
+        carry = y[..., 0]
+    return out
+
 
 def masked_mean(tensor: torch.Tensor, mask: torch.Tensor, dim: int = None) -> torch.Tensor:
     if dim is not None:
@@ -184,12 +338,58 @@ def masked_normalize(tensor: torch.Tensor, mask: torch.Tensor, dim: int = 1, eps
 # Input: attention_mask = torch.tensor([[1, 1, 1, 2, 2, 2, 3, 3, 0]])
 # Output: position_ids  = torch.tensor([[0, 1, 2, 0, 1, 2, 0, 1, 0]])
 def reset_position_ids(attention_mask):
-    position_ids = torch.zeros_like(attention_mask, dtype=torch.long)
-    for i in range(attention_mask.size(0)):
-        mask = attention_mask[i]
-        seq_num = mask.max().item()
-        for index in range(1, seq_num + 1):
-            sample_mask = mask == index
-            sample_length = sample_mask.sum().item()
-            position_ids[i, sample_mask] = torch.arange(sample_length, device=mask.device)
-    return position_ids
+    # The following code is equivalent to:
+    #
+    # position_ids = torch.zeros_like(attention_mask, dtype=torch.long)
+    # for i in range(attention_mask.size(0)):
+    #     mask = attention_mask[i]
+    #     seq_num = mask.max().item()
+    #     for index in range(1, seq_num + 1):
+    #         sample_mask = mask == index
+    #         sample_length = sample_mask.sum().item()
+    #         position_ids[i, sample_mask] = torch.arange(sample_length, device=mask.device)
+    #
+    not_padding = attention_mask.ne(0)
+    token_counts = not_padding.long().cumsum(-1)
+    segment_starts = attention_mask.ne(F.pad(attention_mask[:, :-1], (1, 0)))
+    # number of tokens before the segment each position belongs to
+    start_counts = torch.where(segment_starts, token_counts - 1, torch.zeros_like(token_counts)).cummax(dim=-1).values
+    return (token_counts - 1 - start_counts) * not_padding
+
+
+def get_packed_seq_lens(attention_mask: torch.Tensor) -> List[int]:
+    """Lengths of the samples packed in a segment id attention mask, e.g. [[1, 1, 2, 2, 2, 3, 0]] -> [2, 3, 1]"""
+    return torch.bincount(attention_mask.flatten().long())[1:].tolist()
+
+
+def packed_action_index(packed_seq_lens: List[int], num_actions: List[int], device=None) -> torch.Tensor:
+    """
+    For samples packed into one row, the position predicting each action token, as a [B, max(num_actions)] index
+    that is left padded like the replay buffer batches (the padding entries point at earlier, unused positions).
+    """
+    ends = torch.tensor(packed_seq_lens, device=device).cumsum(0)
+    max_actions = max(num_actions)
+    index = (ends - 1 - max_actions).unsqueeze(1) + torch.arange(max_actions, device=device)
+    return index.clamp(min=0)
+
+
+def gather_action_outputs(
+    values: torch.Tensor, num_actions: Union[int, List[int]], packed_seq_lens: Optional[List[int]] = None
+) -> torch.Tensor:
+    """
+    Outputs (logits, hidden states, values) at the positions predicting the action tokens, i.e.
+    values[:, :-1][:, -num_actions:]. For packed samples (values of shape [1, T, ...], num_actions a list), the
+    positions of every sample are gathered into a left padded [B, max(num_actions), ...] tensor.
+    """
+    if not isinstance(num_actions, list):
+        return values[:, :-1][:, -num_actions:]
+    return values[0][packed_action_index(packed_seq_lens, num_actions, values.device)]
+
+
+def gather_action_labels(
+    sequences: torch.Tensor, num_actions: Union[int, List[int]], packed_seq_lens: Optional[List[int]] = None
+) -> torch.Tensor:
+    """The action tokens, sequences[:, -num_actions:], laid out like gather_action_outputs"""
+    if not isinstance(num_actions, list):
+        return sequences[:, -num_actions:]
+    return sequences[0][packed_action_index(packed_seq_lens, num_actions, sequences.device) + 1]
@@ -8,6 +8,7 @@ from torch.optim import Optimizer
 from tqdm import tqdm
 
 from openrlhf.models import DPOLoss
+from openrlhf.models.utils import chunked_log_probs_from_logits
 from openrlhf.utils.distributed_sampler import DistributedSampler
 
 
@@ -355,7 +356,7 @@ class DPOTrainer(ABC):
 
         # dummy token; we'll ignore the losses on these tokens later
         labels[loss_masks == False] = 0
-        per_token_logps = torch.gather(logits.log_softmax(-1), dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = chunked_log_probs_from_logits(logits, labels)
 
         logprobs_sums = (per_token_logps * loss_masks).sum(-1)
         logprobs_means = (per_token_logps * loss_masks).sum(-1) / loss_masks.sum(-1)
@@ -401,7 +402,7 @@ class DPOTrainer(ABC):
         loss_masks = loss_masks[:, 1:]
         labels[loss_masks == False] = 0
 
-        per_token_logps = torch.gather(logits.log_softmax(-1), dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = chunked_log_probs_from_logits(logits, labels)
 
         logprobs_sums = []
         logprobs_means = []
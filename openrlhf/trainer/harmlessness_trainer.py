@@ -22,7 +22,14 @@ from openrlhf.models.utils import masked_mean, compute_approx_kl
 from openrlhf.utils.distributed_sampler import DistributedSampler
 from openrlhf.utils.utils import get_info_name_str, tile_prompts
 
-from .ppo_utils import AdaptiveKLController, Experience, FixedKLController, NaiveExperienceMaker, NaiveReplayBuffer
+from .ppo_utils import (
+    AdaptiveKLController,
+    DevicePrefetcher,
+    Experience,
+    FixedKLController,
+    NaiveExperienceMaker,
+    NaiveReplayBuffer,
+)
 
 
 class HarmlessnessTrainer(ABC):
@@ -569,16 +576,21 @@ class HarmlessnessTrainer(ABC):
             collate_fn=self.replay_buffer_neg_sampling.collate_fn,
         )
         device = torch.cuda.current_device()
+        # Collate and copy the next pair of micro-batches to the GPU in the background
+        prefetch_micro_batches = getattr(self.args, "prefetch_micro_batches", False)
 
         status_list = []
         status_mean = {}
         for epoch in range(self.max_epochs):
             assert len(dataloader) == len(dataloader_neg)
+            paired_batches = zip(dataloader, dataloader_neg)  # Zip both dataloaders
+            if prefetch_micro_batches:
+                paired_batches = DevicePrefetcher(paired_batches, device)
             pbar = tqdm(
-                zip(dataloader, dataloader_neg),  # Zip both dataloaders
+                paired_batches,
                 desc=f"Train epoch [{epoch + 1}/{self.max_epochs}]",
                 disable=not self.strategy.is_rank_0(),
-                total=min(len(dataloader), len(dataloader_neg))  # Ensure tqdm gets a proper length
+                total=min(len(dataloader), len(dataloader_neg)),  # Ensure tqdm gets a proper length
             )
 
             # pbar = tqdm(
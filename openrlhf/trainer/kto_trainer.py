@@ -6,6 +6,7 @@ from torch.optim import Optimizer
 from tqdm import tqdm
 
 from openrlhf.models import KTOLoss
+from openrlhf.models.utils import chunked_log_probs_from_logits
 from openrlhf.utils.distributed_sampler import DistributedSampler
 
 
@@ -304,7 +305,7 @@ class KTOTrainer(ABC):
 
         # dummy token; we'll ignore the losses on these tokens later
         labels[~loss_masks] = 0
-        per_token_logps = torch.gather(logits.log_softmax(-1), dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        per_token_logps = chunked_log_probs_from_logits(logits, labels)
 
         if average_log_prob:
             return (per_token_logps * loss_masks).sum(-1) / loss_masks.sum(-1)
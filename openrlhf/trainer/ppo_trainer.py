@@ -1,4 +1,3 @@
-import math
 import os.path
 from abc import ABC
 from typing import Any, Callable, Dict, List, Optional, Union
@@ -16,12 +15,33 @@ import torch.nn.functional as F
 
 
 from openrlhf.models import Actor, GPTLMLoss, PolicyLoss, ValueLoss
-from openrlhf.models.loss import CTLLoss, MixedCTLValueLoss, SIXOLoss, DPGLoss
-from openrlhf.models.utils import masked_mean, compute_approx_kl
+from openrlhf.models.loss import CTLLoss, DPGLoss, MixedCTLValueLoss, SIXOLoss, get_dpg_terms_chunked
+from openrlhf.models.utils import (
+    compute_approx_kl,
+    gather_action_labels,
+    get_trunk_and_lm_head,
+    masked_mean,
+    return_or_gather_then_return,
+)
 from openrlhf.utils.distributed_sampler import DistributedSampler
+from openrlhf.utils.estimator_store import EstimatorStore
 from openrlhf.utils.utils import get_info_name_str, tile_prompts
 
-from .ppo_utils import AdaptiveKLController, Experience, FixedKLController, NaiveExperienceMaker, NaiveReplayBuffer
+from .ppo_utils import (
+    AdaptiveKLController,
+    BackgroundPrefetcher,
+    ColumnarReplayBuffer,
+    DevicePrefetcher,
+    Experience,
+    FixedKLController,
+    LengthGroupedBatchSampler,
+    MemmapReplayBuffer,
+    NaiveExperienceMaker,
+    NaiveReplayBuffer,
+    RolloutReusePool,
+    StreamingIWAEEstimator,
+    rollout_ess,
+)
 
 
 class PPOTrainer(ABC):
@@ -176,6 +196,14 @@ class PPOTrainer(ABC):
         self.ptx_loss_fn = GPTLMLoss()
 
         self.freezing_actor_steps = getattr(self.args, "freezing_actor_steps", -1)
+        # Compute the DPG expectation term in checkpointed time chunks instead of from all-vocab tensors
+        self.dpg_streaming = getattr(self.args, "dpg_streaming", False)
+        # Put samples of similar length in the same training micro-batch
+        self.length_grouped_sampling = getattr(self.args, "length_grouped_sampling", False)
+        # Pack each training micro-batch into a single row instead of padding it
+        self.packing_samples = getattr(self.args, "packing_samples", False)
+        # Collate and copy the next training micro-batch to the GPU in the background
+        self.prefetch_micro_batches = getattr(self.args, "prefetch_micro_batches", False)
 
         self.vf_coef = vf_coef
         self.bc_coef = bc_coef
@@ -183,6 +211,8 @@ class PPOTrainer(ABC):
         self.bc_steps = bc_steps
 
         self.true_posterior_samples = true_posterior_samples
+        # (samples, num_actions, log p + log phi) of the true posterior samples evaluated in f_q_g_q_evaluation
+        self.true_posterior_log_tilde_sigma = None
 
         self.model_eval = model_eval
 
@@ -215,11 +245,37 @@ class PPOTrainer(ABC):
             target_dist_beta,
             rm_type,
             actor_loss_type,
-            self.generate_kwargs['max_new_tokens'],
+            self.generate_kwargs["max_new_tokens"],
             save_negdata=save_negdata,
             save_negdata_threshold=save_negdata_threshold,
+            use_generation_log_probs=getattr(self.args, "use_generation_log_probs", False),
+            cache_base_hidden_states=getattr(self.args, "cache_base_hidden_states", False),
+            share_prompt_prefix=getattr(self.args, "share_prompt_prefix", False),
+            generate_base_samples=actor_loss_type == "sixo" and getattr(self.args, "sixo_cache_base_samples", False),
+            base_samples_refresh_every=getattr(self.args, "sixo_base_samples_refresh_every", 1),
         )
-        self.replay_buffer = NaiveReplayBuffer(micro_train_batch_size, buffer_limit, buffer_cpu_offload)
+        replay_buffer_kwargs = {"packing_samples": getattr(self.args, "packing_samples", False)}
+        # Spill the replay buffer to memory-mapped files instead of host RAM
+        self.replay_buffer_scratch_dir = getattr(self.args, "replay_buffer_scratch_dir", None)
+        if self.replay_buffer_scratch_dir is not None:
+            replay_buffer_cls = MemmapReplayBuffer
+            replay_buffer_kwargs["scratch_dir"] = self.replay_buffer_scratch_dir
+        elif getattr(self.args, "columnar_replay_buffer", False):
+            replay_buffer_cls = ColumnarReplayBuffer
+        else:
+            replay_buffer_cls = NaiveReplayBuffer
+        self.replay_buffer = replay_buffer_cls(
+            micro_train_batch_size, buffer_limit, buffer_cpu_offload, **replay_buffer_kwargs
+        )
+        # Train on the samples of each rollout in up to rollout_reuse_k ppo_train calls
+        rollout_reuse_k = getattr(self.args, "rollout_reuse_k", 1)
+        self.rollout_reuse_pool = None
+        if rollout_reuse_k > 1:
+            self.rollout_reuse_pool = RolloutReusePool(
+                rollout_reuse_k,
+                self.args.duplicate_rollout_batch_by,
+                getattr(self.args, "rollout_reuse_min_ess", 0.0),
+            )
 
         from collections import defaultdict
         self.gradient_history = defaultdict(list)
@@ -298,13 +354,11 @@ class PPOTrainer(ABC):
         print(consumed_samples)
 
 
-        iwae_lbs_list = []
-        iwae_ubs_list = []
-        f_q_estimates_list = []
-        g_q_estimates_list = []
-        rewards_list = []
-        kl_vals_list = []
-        entropy_list = []
+        # the estimates of each evaluation are written to disk as soon as it finishes
+        estimator_store = None
+        if self.strategy.is_rank_0():
+            store_prefix = "f_q_g_q_iwae_bounds_OpenRLHF" if args.custom_single_prompt else "f_q_rew_kltoprior_ent"
+            estimator_store = EstimatorStore(f"{args.save_info_path}/{store_prefix}_{get_info_name_str(args)}")
 
 
         # if true_posterior_samples is not None:
@@ -313,7 +367,6 @@ class PPOTrainer(ABC):
         # rewards_list = []
         # kl_to_prior_list = []
 
-        estimates_list = (f_q_estimates_list, rewards_list, kl_vals_list, entropy_list)
 
         custom_prompt = None
         if args.custom_single_prompt:
@@ -336,10 +389,7 @@ class PPOTrainer(ABC):
 
 
             if not args.no_test_info:
-                self.f_q_g_q_evaluation(args, f_q_estimates_list,
-                                        g_q_estimates_list, iwae_lbs_list,
-                                        iwae_ubs_list, prompt_text,
-                                        true_posterior_samples)
+                self.f_q_g_q_evaluation(args, estimator_store, prompt_text, true_posterior_samples)
 
 
 
@@ -389,9 +439,10 @@ class PPOTrainer(ABC):
                                 skip_special_tokens=True)
                             self.strategy.print(output[0])
 
-                        self.replay_buffer.append(experience)
+                        self.append_experience(experience)
 
                         torch.cuda.empty_cache()
+                        reuse_status = self.add_reused_rollouts()
                         # print("REPLAY BUFFER BEFORE NORMALIZATION")
                         # print(self.replay_buffer.items)
                         self.replay_buffer.normalize("advantages", self.strategy)
@@ -399,7 +450,10 @@ class PPOTrainer(ABC):
                         # print(self.replay_buffer.items)
 
                         status = self.ppo_train(global_steps, custom_prompt=custom_prompt)
+                        status.update(reuse_status)
                         self.replay_buffer.clear()
+                        if self.rollout_reuse_pool is not None:
+                            self.rollout_reuse_pool.step()
                         torch.cuda.empty_cache()
 
                         if "kl" in status:
@@ -417,10 +471,7 @@ class PPOTrainer(ABC):
                                                    status, client_states)
 
                 if not args.no_test_info:
-                    self.f_q_g_q_evaluation(args, f_q_estimates_list,
-                                            g_q_estimates_list, iwae_lbs_list,
-                                            iwae_ubs_list, prompt_text,
-                                            true_posterior_samples)
+                    self.f_q_g_q_evaluation(args, estimator_store, prompt_text, true_posterior_samples)
 
                 pbar.update()
 
@@ -447,7 +498,7 @@ class PPOTrainer(ABC):
 
                     if not args.no_test_info:
                         if steps == 1: # do some test at the very beginning
-                            self.test_info_multiprompt(args, rand_prompts, estimates_list)
+                            self.test_info_multiprompt(args, rand_prompts, estimator_store)
 
                     # with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
                     #              profile_memory=True, record_shapes=True) as prof:
@@ -466,7 +517,7 @@ class PPOTrainer(ABC):
                     if steps % update_timesteps == 0:
                         output = self.tokenizer.batch_decode(experience.sequences, skip_special_tokens=True)
                         self.strategy.print(output[0])
-                    self.replay_buffer.append(experience)
+                    self.append_experience(experience)
 
                     # with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
                     #              profile_memory=True, record_shapes=True) as prof:
@@ -475,10 +526,14 @@ class PPOTrainer(ABC):
                         global_steps = steps // update_timesteps
 
                         torch.cuda.empty_cache()
+                        reuse_status = self.add_reused_rollouts()
                         self.replay_buffer.normalize("advantages", self.strategy)
                         assert custom_prompt is None
                         status = self.ppo_train(global_steps, custom_prompt=custom_prompt)
+                        status.update(reuse_status)
                         self.replay_buffer.clear()
+                        if self.rollout_reuse_pool is not None:
+                            self.rollout_reuse_pool.step()
                         torch.cuda.empty_cache()
 
                         if "kl" in status:
@@ -491,7 +546,7 @@ class PPOTrainer(ABC):
 
                         if not args.no_test_info:
                             if steps % args.test_info_every == 0:
-                                self.test_info_multiprompt(args, rand_prompts, estimates_list)
+                                self.test_info_multiprompt(args, rand_prompts, estimator_store)
 
                     # print("PROFILE2")
                     # print(prof.key_averages().table(sort_by="self_cuda_memory_usage"))
@@ -499,217 +554,184 @@ class PPOTrainer(ABC):
 
                     pbar.update()
                     steps = steps + 1
-        if args.custom_single_prompt:
-            return iwae_lbs_list, iwae_ubs_list, f_q_estimates_list, g_q_estimates_list
-        else:
-            return estimates_list
+        return estimator_store
 
-    def test_info_multiprompt(self, args, rand_prompts, estimates_lists):
+    def test_info_multiprompt(self, args, rand_prompts, estimator_store):
         print("prompts")
         print(rand_prompts)
         # expanded_prompts = tile_prompts(rand_prompts, samples_per_prompt) # this is done within the f_q estimate...
 
-        total_f_qs, total_rewards, total_kl_vals, total_entropy = None, None, None, None
-
-        for i in range(self.n_seeds_f_q):
-            f_qs, attention_mask, num_actions, q_seqs, log_p, log_phi, log_q, action_mask = self.f_q_estimate(
-                args, rand_prompts)
-
-            output = self.tokenizer.batch_decode(
-                q_seqs,
-                skip_special_tokens=True)
-            print("seqs")
-            print(output)
-            print("seqs2")
-            self.strategy.print(output[0])
-
-            # print("Shapes")
-            # print(log_q.shape)
-            # print(log_p.shape)
-            # print(log_phi.shape)
-            # print(f_qs.shape)
-
-            kl_vals = log_q - log_p # No action mask here; that needs to be dealt with elsewhere
-            # log_q and log_p here have already been summed over the time dimension, so this is just simply reduce
-
-            rewards = log_phi / args.target_dist_beta
+        # The following code is equivalent to (up to sampling noise):
+        #
+        # for i in range(self.n_seeds_f_q):
+        #     f_qs, attention_mask, num_actions, q_seqs, log_p, log_phi, log_q, action_mask = self.f_q_estimate(
+        #         args, rand_prompts)
+        #     ... then torch.cat of f_qs, rewards, kl_vals and entropy over the seeds
+        #
+        estimates, q_seqs, _ = self.batched_f_q_estimates(args, rand_prompts, self.n_seeds_f_q)
+
+        output = self.tokenizer.batch_decode(q_seqs, skip_special_tokens=True)
+        print("seqs")
+        print(output)
+        print("seqs2")
+        self.strategy.print(output[0])
+
+        # [n_seeds, samples_per_seed]
+        f_qs = estimates["f_qs"]
+        kl_vals = estimates["log_q"] - estimates["log_p"]  # No action mask here; that needs to be dealt with elsewhere
+        # log_q and log_p here have already been summed over the time dimension, so this is just simply reduce
+        rewards = estimates["log_phi"] / args.target_dist_beta
+        entropy = -estimates["log_q"]
+
+        print(f"Avg F_q per seed: {f_qs.mean(dim=1)}")
+        print(f"Avg F_q: {f_qs.mean()}")
+        print(f"Avg Rew: {rewards.mean()}")
+        print(f"Avg KL to Prior: {kl_vals.mean()}")
+        print(f"Avg Ent: {entropy.mean()}")
+
+        if estimator_store is not None:
+            estimator_store.append(
+                f_q_estimates=f_qs.flatten(),
+                rewards=rewards.flatten(),
+                kl_vals=kl_vals.flatten(),
+                entropy=entropy.flatten(),
+            )
 
-            entropy = - log_q
 
-            print(kl_vals.shape)
-            print(rewards.shape)
-            print(entropy.shape)
+    def f_q_g_q_evaluation(self, args, estimator_store, prompt_text, true_posterior_samples):
+        # This function appends the F_q and G_q estimates and the IWAE bounds to estimator_store
+        # The samples are drawn in chunks and only running accumulators are kept on the device, so
+        # n_samples_for_f_q is not limited by memory. The per-sample f_qs and g_qs are still logged, on the CPU.
+        # With args.f_q_eval_tolerance set, chunks are drawn until the standard errors of F_q and of the IWAE lower
+        # bound are within the tolerance, or args.f_q_eval_max_samples samples per seed have been drawn.
+        tolerance = getattr(args, "f_q_eval_tolerance", None)
+        if tolerance is None:
+            chunk_sizes = self.f_q_eval_chunk_sizes(args, args.n_samples_for_f_q)
+        else:
+            max_samples = getattr(args, "f_q_eval_max_samples", None) or args.n_samples_for_f_q
+            adaptive_chunk_size = getattr(args, "f_q_eval_adaptive_chunk_size", None)
+            adaptive_chunk_size = adaptive_chunk_size or max(2, args.n_samples_for_f_q // 10)
+            chunk_sizes = self.f_q_eval_chunk_sizes(args, max_samples, adaptive_chunk_size)
+
+        estimator = StreamingIWAEEstimator(self.n_seeds_f_q)
+        f_q_chunks = []
+        for chunk_samples in chunk_sizes:
+            custom_prompt_for_f_q = [prompt_text] * chunk_samples
+            estimates, _, _ = self.batched_f_q_estimates(args, custom_prompt_for_f_q, self.n_seeds_f_q)
+            estimator.update_f_q(estimates["f_qs"])
+            f_q_chunks.append(estimates["f_qs"].cpu())
+            if tolerance is not None and estimator.converged(tolerance):
+                break
+        print(f"F_q samples used per seed: {estimator.f_q.count}")
+        if self._wandb is not None and self.strategy.is_rank_0():
+            self._wandb.log({"eval/f_q_samples_used": estimator.f_q.count})
+        print("Avg F_q Estimate (Learned Model)")
+        print(estimator.f_q.mean)
+        print("IWAE Lower Bound Estimate (Learned Model)")
+        print(estimator.iwae_lower_bound)
+
+        eos_token_id = self.generate_kwargs["eos_token_id"]
+        pad_token_id = self.generate_kwargs["pad_token_id"]
+
+        assert true_posterior_samples is not None
+        # log p + log phi of the fixed posterior samples is computed once, only log q is recomputed here. num_actions
+        # comes from the posterior samples, not from the f_q rollouts, whose length depends on when generation stopped
+        num_actions, true_posterior_log_tilde_sigma = self.get_true_posterior_log_tilde_sigma(
+            args, true_posterior_samples, prompt_text
+        )
+        g_q_chunks = []
+        for start in range(0, true_posterior_samples.size(0), args.n_samples_for_f_q):
+            samples = true_posterior_samples[start : start + args.n_samples_for_f_q]
+            print("G_q Estimates Learned Model")
+            attention_mask_g_q = (samples.ne(eos_token_id) & samples.ne(pad_token_id)).to(dtype=torch.long)
+            g_qs = self.g_q_estimate(
+                args,
+                samples,
+                num_actions,
+                attention_mask_g_q,  # using the f_q mask would be wrong here.
+                log_tilde_sigma=true_posterior_log_tilde_sigma[start : start + samples.size(0)],
+            )
+            print("Avg G_q Estimate (Learned Model)")
+            print(g_qs.mean())
+            estimator.update_g_q(g_qs)
+            g_q_chunks.append(g_qs.cpu())
+
+        # The IWAE upper bound of seed i uses its q samples with one of them swapped for the i-th posterior sample
+        # (to keep the conditioning tokens constant). The weights of the q samples are the f_qs, and the weight of
+        # posterior sample i is its g_q, so no further model passes are needed.
+        # The following code is equivalent to (with the swapped q sample being the first one instead of the i-th):
+        #
+        # iwae_mixture_with_one_post = q_seqs.detach().clone()
+        # iwae_mixture_with_one_post[i] = true_posterior_samples[i]
+        # attention_mask_g_q = (
+        #     iwae_mixture_with_one_post.ne(eos_token_id) & iwae_mixture_with_one_post.ne(pad_token_id)
+        # ).to(dtype=torch.long)
+        # iwae_ub_weights = self.g_q_estimate(args, iwae_mixture_with_one_post, num_actions, attention_mask_g_q)
+        #
+        summary = estimator.summary()
+        iwae_lbs, iwae_ubs = summary["iwae_lb"], summary["iwae_ub"]
+        print("IWAE Upper Bound Estimate (Learned Model)")
+        print(iwae_ubs)
 
-            if total_f_qs is None:
-                total_f_qs = f_qs
-                total_rewards = rewards
-                total_kl_vals = kl_vals
-                total_entropy = entropy
-            else:
-                total_f_qs = torch.cat((total_f_qs, f_qs), axis=0)
-                total_rewards = torch.cat((total_rewards, rewards), axis=0)
-                total_kl_vals = torch.cat((total_kl_vals, kl_vals), axis=0)
-                total_entropy = torch.cat((total_entropy, entropy), axis=0)
-
-                # print("Shapes 2")
-                # print(total_f_qs.shape)
-                # print(total_rewards.shape)
-                # print(total_kl_vals.shape)
-                # print(total_entropy.shape)
-
-        # print("f_qs")
-        # print(f_qs)
-        print(f"Avg F_q: {total_f_qs.mean()}")
-        print(f"Avg Rew: {total_rewards.mean()}")
-        print(f"Avg KL to Prior: {total_kl_vals.mean()}")
-        print(f"Avg Ent: {total_entropy.mean()}")
-
-        f_q_estimates_list, rewards_list, kl_vals_list, entropy_list = estimates_lists
-
-        f_q_estimates_list.append(total_f_qs.cpu())
-        rewards_list.append(total_rewards.cpu())
-        kl_vals_list.append(total_kl_vals.cpu())
-        entropy_list.append(total_entropy.cpu())
-
-
-    def f_q_g_q_evaluation(self, args, f_q_estimates_list, g_q_estimates_list,
-                           iwae_lbs_list, iwae_ubs_list,
-                           prompt_text, true_posterior_samples):
-        # This function appends to f_q_estimates_list and g_q_estimates_list
-        iwae_lbs = torch.zeros((self.n_seeds_f_q,))
-        iwae_ubs = torch.zeros((self.n_seeds_f_q,))
-        total_f_qs = None
-        total_g_qs = None
-        for i in range(self.n_seeds_f_q):
-            custom_prompt_for_f_q = [prompt_text] * args.n_samples_for_f_q
-
-            f_qs, attention_mask, num_actions, q_seqs, log_p, log_phi, log_q, action_mask = self.f_q_estimate(
-                args, custom_prompt_for_f_q)
-            print("Avg F_q Estimate (Learned Model)")
-            print(f_qs.mean())
-            print("IWAE Lower Bound Estimate (Learned Model)")
-            iwae_lower_bound_estimate = torch.logsumexp(f_qs,
-                                                        dim=0) - torch.log(
-                torch.tensor(f_qs.shape[0]))
-            print(iwae_lower_bound_estimate)
-            iwae_lbs[i] = iwae_lower_bound_estimate.item()
-            # # TODO load the posterior samples, pass through to get g_q estimate
-            # if true_posterior_samples is not None:
-            #     true_posterior_samples = true_posterior_samples.to(
-            #         q_seqs.device)
-            #     # TODO later account for the above possiblity
-            eos_token_id = self.generate_kwargs["eos_token_id"]
-            pad_token_id = self.generate_kwargs["pad_token_id"]
-
-            if i == 0:
-                assert true_posterior_samples is not None
-                range_val = (math.ceil(
-                    true_posterior_samples.shape[0] / args.n_samples_for_f_q))
-                print(range_val)
-                for j in range(range_val):
-                    samples = true_posterior_samples[
-                              j * args.n_samples_for_f_q: (j + 1) * args.n_samples_for_f_q]
-                    if samples.shape[0] != 0:
-                        print("G_q Estimates Learned Model")
-                        # print(samples.shape)
-                        # print(condition_twist_on_tokens.shape)
-                        # print(condition_twist_on_tokens[i * n_samples_f_q: (i+1) * n_samples_f_q].shape)
-                        attention_mask_g_q = (
-                                samples.ne(eos_token_id) & samples.ne(
-                                pad_token_id)).to(
-                            dtype=torch.long)
-
-                        g_qs = self.g_q_estimate(args, samples,
-                                                 num_actions, attention_mask_g_q) # using the f_q mask would be wrong here.
-                        # No attention mask could cause issues with padding TODO should investigate, but at least for my current experiments is not an issue
-
-                        print(g_qs)
-                        print("Avg G_q Estimate (Learned Model)")
-                        print(g_qs.mean())
-
-                        if total_g_qs is None:
-                            total_g_qs = g_qs
-                        else:
-                            total_g_qs = torch.cat((total_g_qs, g_qs),
-                                                   axis=0)
-                            print("Total G_qs shape")
-                            print(total_g_qs.shape)
-
-                # g_qs = self.g_q_estimate(args, true_posterior_samples[
-                #                                :q_seqs.shape[0]],
-                #                          num_actions, attention_mask)
-                # print("Avg G_q Estimate (Learned Model)")
-                # print(g_qs.mean())
-
-            if true_posterior_samples is not None:
-                iwae_mixture_with_one_post = q_seqs.detach().clone()
-                iwae_mixture_with_one_post[i] = true_posterior_samples[
-                    i]  # To keep the conditioning tokens constant
-                attention_mask_g_q = (
-                    iwae_mixture_with_one_post.ne(eos_token_id) & iwae_mixture_with_one_post.ne(
-                    pad_token_id)).to(
-                    dtype=torch.long)
-                iwae_ub_weights = self.g_q_estimate(args,
-                                                    iwae_mixture_with_one_post,
-                                                    num_actions,
-                                                    attention_mask_g_q
-                                                    )
-                # No attention mask - using the f_q mask would be wrong here.
-                # No attention mask could cause issues with padding TODO should investigate, but at least for my current experiments is not an issue
-
-                print("IWAE Upper Bound Estimate (Learned Model)")
-                iwae_upper_bound_estimate = torch.logsumexp(
-                    iwae_ub_weights, dim=0) - torch.log(
-                    torch.tensor(iwae_ub_weights.shape[0]))
-                print(iwae_upper_bound_estimate)
-
-                iwae_ubs[i] = iwae_upper_bound_estimate.item()
-
-            if total_f_qs is None:
-                total_f_qs = f_qs
-                # total_rewards = rewards
-                # total_kl_vals = kl_vals
-            else:
-                total_f_qs = torch.cat((total_f_qs, f_qs), axis=0)
-                print("F_Q Shape")
-                print(total_f_qs.shape)
-                # total_rewards = torch.cat((total_rewards, rewards),
-                #                           axis=0)
-                # print(total_rewards.shape)
-                # total_kl_vals = torch.cat((total_kl_vals, kl_vals),
-                #                           axis=0)
-                # print(total_kl_vals.shape)
-
-            # if total_g_qs is None:
-            #     total_g_qs = g_qs
-            # else:
-            #     total_g_qs = torch.cat((total_g_qs, g_qs),
-            #                            axis=0)
-            #     print("Total G_qs shape")
-            #     print(total_g_qs.shape)
-
-        iwae_lbs_list.append(iwae_lbs)
-        iwae_ubs_list.append(iwae_ubs)
-        # 1/0
         print("IWAE LB AND UB")
         print(iwae_lbs)
         print(iwae_ubs)
-        print("IWAE LB AND UB LISTS")
-        print(iwae_lbs_list)
-        print(iwae_ubs_list)
-        print("Shapes")
-        print(total_g_qs.shape)
-        print(total_f_qs.shape)
+        print("F_q, IWAE LB and G_q standard errors")
+        print(summary["f_q_std_err"])
+        print(summary["iwae_lb_std_err"])
+        print(summary["g_q_std_err"])
+
+        if estimator_store is not None:
+            estimator_store.append(
+                f_q_estimates=torch.cat(f_q_chunks, dim=1).flatten(),
+                g_q_estimates=torch.cat(g_q_chunks),  # Only one G_q estimate (over all the posterior samples)
+                iwae_lbs=iwae_lbs,
+                iwae_ubs=iwae_ubs,
+                samples_used=torch.tensor(estimator.f_q.count),
+            )
 
+        # return f_q_estimates_list, g_q_estimates_list
 
-        # print(total_rewards.shape)
-        # print(total_kl_vals.shape)
-        if total_g_qs is not None:
-            g_q_estimates_list.append(
-                total_g_qs.cpu())  # Only one G_q estimate (over all the posterior samples)
-        f_q_estimates_list.append(total_f_qs.cpu())
+    @staticmethod
+    def f_q_eval_chunk_sizes(args, n_samples, max_chunk_size=None):
+        """Splits the n_samples prompts of each seed of an evaluation into chunks of at most max_chunk_size, such that
+        one seed's chunk fits in args.f_q_eval_batch_size sequences (a single chunk if both are unset)"""
+        max_batch_size = getattr(args, "f_q_eval_batch_size", None)
+        chunk_size = min(n_samples, max_chunk_size or n_samples)
+        if max_batch_size:
+            chunk_size = max(1, min(chunk_size, max_batch_size // args.duplicate_rollout_batch_by))
+        for start in range(0, n_samples, chunk_size):
+            yield min(chunk_size, n_samples - start)
 
-        # return f_q_estimates_list, g_q_estimates_list
+    @torch.no_grad()
+    def batched_f_q_estimates(self, args, prompts, n_seeds):
+        """
+        f_q_estimate for n_seeds independent draws on the same prompts. The seeds are generated together in chunks of
+        up to args.f_q_eval_batch_size sequences (one seed per chunk if unset), and the per-sample terms are written
+        into preallocated [n_seeds, samples_per_seed] tensors under "f_qs", "log_p", "log_phi" and "log_q". Also
+        returns the sequences of the first seed and num_actions of the first chunk.
+        """
+        samples_per_seed = len(prompts) * args.duplicate_rollout_batch_by
+        max_batch_size = getattr(args, "f_q_eval_batch_size", None) or samples_per_seed
+        seeds_per_chunk = max(1, min(n_seeds, max_batch_size // samples_per_seed))
+
+        estimates, first_seqs, num_actions = None, None, None
+        for start in range(0, n_seeds, seeds_per_chunk):
+            chunk_seeds = min(seeds_per_chunk, n_seeds - start)
+            # prompts are tiled within each copy, so the samples stay grouped by seed
+            f_qs, _, chunk_num_actions, q_seqs, log_p, log_phi, log_q, _ = self.f_q_estimate(
+                args, prompts * chunk_seeds
+            )
+            chunk = {"f_qs": f_qs, "log_p": log_p, "log_phi": log_phi, "log_q": log_q}
+            if estimates is None:
+                estimates = {
+                    key: torch.empty((n_seeds, samples_per_seed), dtype=torch.float, device=value.device)
+                    for key, value in chunk.items()
+                }
+                first_seqs, num_actions = q_seqs[:samples_per_seed], chunk_num_actions
+            for key, value in chunk.items():
+                estimates[key][start : start + chunk_seeds] = value.view(chunk_seeds, samples_per_seed)
+        return estimates, first_seqs, num_actions
 
     def f_q_estimate(self, args, batch_prompt):
         self.experience_maker.set_all_eval()
@@ -717,11 +739,17 @@ class PPOTrainer(ABC):
 
         with torch.no_grad():
             if self.shared_actorcritic:
-                action_log_probs, action_mask, attention_mask, num_actions, sequences, value = self.experience_maker.generate_seqs_and_get_logprobs(
-                    batch_prompt, **self.generate_kwargs)
+                action_log_probs, action_mask, attention_mask, num_actions, sequences, value, base_action_log_probs = (
+                    self.experience_maker.generate_seqs_and_get_logprobs(
+                        batch_prompt, return_base_log_probs=True, **self.generate_kwargs
+                    )
+                )
             else:
-                action_log_probs, action_mask, attention_mask, num_actions, sequences = self.experience_maker.generate_seqs_and_get_logprobs(
-                    batch_prompt, **self.generate_kwargs)
+                action_log_probs, action_mask, attention_mask, num_actions, sequences, base_action_log_probs = (
+                    self.experience_maker.generate_seqs_and_get_logprobs(
+                        batch_prompt, return_base_log_probs=True, **self.generate_kwargs
+                    )
+                )
             action_log_probs = action_log_probs.float() * action_mask # more precision
             log_q = action_log_probs.sum(dim=-1)
             # print(log_q.shape)
@@ -733,7 +761,14 @@ class PPOTrainer(ABC):
             # 1/0
 
             log_tilde_sigma, log_p, log_phi = self.eval_log_p_plus_log_phi(
-                args, action_log_probs, attention_mask, action_mask, num_actions, sequences, return_extra_info=True
+                args,
+                action_log_probs,
+                attention_mask,
+                action_mask,
+                num_actions,
+                sequences,
+                return_extra_info=True,
+                base_action_log_probs=base_action_log_probs,
             )
 
             f_qs = log_tilde_sigma - log_q
@@ -749,8 +784,17 @@ class PPOTrainer(ABC):
         return f_qs, attention_mask, num_actions, sequences, log_p, log_phi, log_q, action_mask
 
     @torch.no_grad()
-    def eval_log_p_plus_log_phi(self, args, action_log_probs, attention_mask, action_mask,
-                                num_actions, sequences, return_extra_info=False):
+    def eval_log_p_plus_log_phi(
+        self,
+        args,
+        action_log_probs,
+        attention_mask,
+        action_mask,
+        num_actions,
+        sequences,
+        return_extra_info=False,
+        base_action_log_probs=None,
+    ):
         # rewards_no_kl = self.experience_maker.compute_reward_no_kl(sequences,
         #                                                            attention_mask, multiply_by_beta=True)
         # print("log p phi eval")
@@ -765,9 +809,8 @@ class PPOTrainer(ABC):
         # print(args.target_dist_beta)
         # print("log_phi")
         # print(log_phi)
-        base_action_log_probs = self.experience_maker.initial_model(sequences,
-                                                                    num_actions,
-                                                                    attention_mask)
+        if base_action_log_probs is None:
+            base_action_log_probs = self.experience_maker.initial_model(sequences, num_actions, attention_mask)
         base_action_log_probs = base_action_log_probs.float() * action_mask # more precision
 
         log_p = base_action_log_probs.sum(dim=-1)
@@ -780,39 +823,160 @@ class PPOTrainer(ABC):
         else:
             return log_tilde_sigma
 
-
-
-    def g_q_estimate(self, args, true_sigma_samples, num_actions, attention_mask, condition_twist_on_tokens=None):
+    def g_q_estimate(
+        self,
+        args,
+        true_sigma_samples,
+        num_actions,
+        attention_mask,
+        condition_twist_on_tokens=None,
+        log_tilde_sigma=None,
+    ):
+        """log tilde sigma - log q on samples from sigma. With log_tilde_sigma given (it does not change during
+        training, see get_true_posterior_log_tilde_sigma), only the proposal is run."""
         self.experience_maker.set_all_eval()
         sequences = true_sigma_samples
+        action_mask = self.get_sigma_samples_action_mask(sequences, num_actions)
         with torch.no_grad():
+            base_action_log_probs = None
             if self.shared_actorcritic:
                 action_log_probs, _ = self.experience_maker.actor(sequences,
                                                                num_actions,
                                                                attention_mask)
+            elif log_tilde_sigma is not None:
+                action_log_probs = self.experience_maker.actor(sequences, num_actions, attention_mask)
             else:
-                action_log_probs = self.experience_maker.actor(sequences, num_actions,
-                                              attention_mask)
-            action_log_probs = action_log_probs.float() # more precision
+                action_log_probs, base_action_log_probs = self.experience_maker.get_action_and_base_log_probs(
+                    sequences, num_actions, attention_mask
+                )
+            action_log_probs = action_log_probs.float() * action_mask  # more precision
             log_q = action_log_probs.sum(dim=-1)
-            log_tilde_sigma = self.eval_log_p_plus_log_phi(args, action_log_probs,
-                                    attention_mask, action_mask,
-                                    num_actions, sequences)
+            if log_tilde_sigma is None:
+                log_tilde_sigma = self.eval_log_p_plus_log_phi(
+                    args,
+                    action_log_probs,
+                    attention_mask,
+                    action_mask,
+                    num_actions,
+                    sequences,
+                    base_action_log_probs=base_action_log_probs,
+                )
             log_tilde_sigma = log_tilde_sigma.float() # more precision
 
         return log_tilde_sigma - log_q
 
+    def get_sigma_samples_action_mask(self, sequences, num_actions):
+        # same as Actor.process_sequences: an action is masked out once its state token is EOS/padding
+        state_seq = sequences[:, -num_actions - 1 : -1]
+        action_mask = state_seq.ne(self.generate_kwargs["eos_token_id"]) & state_seq.ne(
+            self.generate_kwargs["pad_token_id"]
+        )
+        action_mask[:, 0] = 1
+        return action_mask
+
+    def get_true_posterior_num_actions(self, true_posterior_samples, prompt_text):
+        """Number of action tokens of the true posterior samples: everything after the (unpadded) prompt"""
+        prompt_ids = self.experience_maker.tokenize_fn([prompt_text], self.prompt_max_len, device="cpu")["input_ids"]
+        return true_posterior_samples.size(1) - prompt_ids.size(1)
+
+    @torch.no_grad()
+    def get_true_posterior_log_tilde_sigma(self, args, true_posterior_samples, prompt_text):
+        """
+        num_actions and log p + log phi of the true posterior samples. The base model and the reward model are frozen,
+        so this is computed on the first call (in chunks of n_samples_for_f_q) and kept next to the samples afterwards.
+        """
+        num_actions = self.get_true_posterior_num_actions(true_posterior_samples, prompt_text)
+        if self.true_posterior_log_tilde_sigma is not None:
+            cached_samples, cached_num_actions, log_tilde_sigma = self.true_posterior_log_tilde_sigma
+            if cached_samples is true_posterior_samples and cached_num_actions == num_actions:
+                return num_actions, log_tilde_sigma
+        self.experience_maker.set_all_eval()
+        eos_token_id = self.generate_kwargs["eos_token_id"]
+        pad_token_id = self.generate_kwargs["pad_token_id"]
+        log_tilde_sigma = []
+        for samples in true_posterior_samples.split(args.n_samples_for_f_q):
+            attention_mask = (samples.ne(eos_token_id) & samples.ne(pad_token_id)).to(dtype=torch.long)
+            action_mask = self.get_sigma_samples_action_mask(samples, num_actions)
+            log_tilde_sigma.append(
+                self.eval_log_p_plus_log_phi(args, None, attention_mask, action_mask, num_actions, samples).float()
+            )
+        log_tilde_sigma = torch.cat(log_tilde_sigma)
+        self.true_posterior_log_tilde_sigma = (true_posterior_samples, num_actions, log_tilde_sigma)
+        return num_actions, log_tilde_sigma
+
+    def append_experience(self, experience: Experience) -> None:
+        self.replay_buffer.append(experience)
+        if self.rollout_reuse_pool is not None:
+            self.rollout_reuse_pool.add(experience)
+
+    def add_reused_rollouts(self) -> Dict[str, float]:
+        """Evicts the degenerate old rollouts of the reuse pool and adds the rest to the replay buffer"""
+        if self.rollout_reuse_pool is None:
+            return {}
+        ess_list = self.rollout_reuse_pool.reuse(self.get_rollout_ess)
+        old_rollouts = self.rollout_reuse_pool.old_rollouts()
+        for experience in old_rollouts:
+            self.replay_buffer.append(experience)
+        status = {"reused_rollouts": len(old_rollouts)}
+        if ess_list:
+            status["reuse_ess"] = sum(ess_list) / len(ess_list)
+        return status
+
+    @torch.no_grad()
+    def get_rollout_ess(self, experience: Experience) -> float:
+        """
+        ESS fraction of an old rollout as a sample from the current proposal (see rollout_ess), averaged over the ranks
+        so that all ranks evict the same rollouts.
+        """
+        self.actor.eval()
+        device = torch.cuda.current_device()
+        num_actions = experience.action_mask.size(1)
+        log_ratios = []
+        for rows in torch.arange(experience.sequences.size(0)).split(self.replay_buffer.sample_batch_size):
+            action_mask = experience.action_mask[rows].to(device)
+            log_q = self.experience_maker.actor(
+                experience.sequences[rows].to(device), num_actions, experience.attention_mask[rows].to(device)
+            )
+            log_ratio = (log_q.float() - experience.action_log_probs[rows].to(device).float()) * action_mask
+            log_ratios.append(log_ratio.sum(dim=-1))
+        ess = rollout_ess(torch.cat(log_ratios), self.args.duplicate_rollout_batch_by)
+        return self.strategy.all_reduce(ess, "mean")
+
     def ppo_train(self, global_steps=0, custom_prompt=None):
         # replay buffer may be empty at first, we should rebuild at each training
-        dataloader = DataLoader(
-            self.replay_buffer,
-            batch_size=self.replay_buffer.sample_batch_size,
-            shuffle=self.shuffle_replay_buffer_sample,
-            drop_last=True,
-            pin_memory=self.dataloader_pin_memory,
-            collate_fn=self.replay_buffer.collate_fn,
-        )
+        if self.length_grouped_sampling:
+            # the non-PPO losses reshape micro-batches to [num_prompts, samples_per_prompt, ...], so keep prompt
+            # groups intact
+            group_size = 1 if self.actor_loss_type == "ppo" else self.args.duplicate_rollout_batch_by
+            batch_sampler = LengthGroupedBatchSampler(
+                self.replay_buffer.sequence_lengths(),
+                self.replay_buffer.sample_batch_size,
+                group_size=group_size,
+                shuffle=self.shuffle_replay_buffer_sample,
+                seed=self.args.seed + global_steps,
+            )
+            dataloader = DataLoader(
+                self.replay_buffer,
+                batch_sampler=batch_sampler,
+                pin_memory=self.dataloader_pin_memory,
+                collate_fn=self.replay_buffer.collate_fn,
+            )
+        else:
+            dataloader = DataLoader(
+                self.replay_buffer,
+                batch_size=self.replay_buffer.sample_batch_size,
+                shuffle=self.shuffle_replay_buffer_sample,
+                drop_last=True,
+                pin_memory=self.dataloader_pin_memory,
+                collate_fn=self.replay_buffer.collate_fn,
+            )
         device = torch.cuda.current_device()
+        if self.prefetch_micro_batches:
+            # collate and copy the next micro-batch to the GPU while the current one trains
+            dataloader = DevicePrefetcher(dataloader, device)
+        elif self.replay_buffer_scratch_dir is not None:
+            # gather the next micro-batch from the maps while the current one trains
+            dataloader = BackgroundPrefetcher(dataloader)
 
         status_list = []
         status_mean = {}
@@ -842,6 +1006,8 @@ class PPOTrainer(ABC):
             for experience in pbar:
                 experience.to_device(device)
                 status = self.training_step(experience, global_steps, custom_prompt=custom_prompt)
+                # fraction of the micro-batch that is real tokens rather than padding
+                status["padding_efficiency"] = experience.attention_mask.ne(0).float().mean().item()
 
                 # for DP
                 # weighted mean for kl
@@ -1109,7 +1275,8 @@ class PPOTrainer(ABC):
         #     experience.sequences, num_actions, attention_mask=experience.attention_mask, return_output=True
         # )
         # num_actions = experience.action_mask.size(1)
-        batch_size = experience.sequences.size(0)
+        num_actions = self.get_num_actions(experience)
+        batch_size = experience.action_mask.size(0)
         samples_per_prompt = self.args.duplicate_rollout_batch_by
         num_prompts = batch_size // samples_per_prompt
 
@@ -1123,8 +1290,7 @@ class PPOTrainer(ABC):
 
         if self.actor_loss_type == "ppo":
             action_log_probs = self.actor(
-                experience.sequences, experience.action_mask.size(1),
-                attention_mask=experience.attention_mask, return_output=False
+                experience.sequences, num_actions, attention_mask=experience.attention_mask, return_output=False
             )  # TODO later revert this and fix the above (return_output=True)
 
             # print(action_log_probs)
@@ -1143,23 +1309,15 @@ class PPOTrainer(ABC):
             # Right now by using experience_maker sequences, this is essentially just twisted proposal samples
             # And we do CTL by reweighting those according to the twist values and tilde sigma values.
 
-            with torch.no_grad():
-                base_action_log_probs = self.experience_maker.initial_model(
-                    experience.sequences, experience.action_mask.size(1),
-                    experience.attention_mask)
-                # log_phi = self.experience_maker.compute_reward_no_kl(
-                #     experience.sequences, experience.attention_mask, multiply_by_beta=True # beta multiplied for non-PPO formulations
-                # )
-                log_phi = experience.info["reward"].to(base_action_log_probs.device)
+            base_action_log_probs, log_psi = self.get_base_log_probs_and_log_psi(experience, num_actions)
+            # log_phi = self.experience_maker.compute_reward_no_kl(
+            #     experience.sequences, experience.attention_mask, multiply_by_beta=True # beta multiplied for non-PPO formulations
+            # )
+            log_phi = experience.info["reward"].to(base_action_log_probs.device)
 
 
             # print("REWARD COMPARISON")
             # print(experience.returns[:, -1] - log_phi) # same
-            if "policy" in self.parameterization:
-                log_psi = self.get_log_psi_policy_parameterization(base_action_log_probs, experience, experience.action_mask.size(1), self.parameterization)
-            else:
-                log_psi = self.experience_maker.actor(experience.sequences, experience.action_mask.size(1), experience.attention_mask,
-                                                      return_only_modulation=True)
 
             # print("ACTOR LOSS STUFF")
             # print(experience.action_log_probs.shape)
@@ -1203,21 +1361,21 @@ class PPOTrainer(ABC):
                 # reduce_mean_per_prompt=True
             )
         elif self.actor_loss_type == "dpg":
-            with torch.no_grad():
-                base_action_log_probs_all_vocab, base_action_log_probs = self.experience_maker.initial_model(
-                    experience.sequences, experience.action_mask.size(1),
-                    experience.attention_mask, return_type="both")
-                # log_phi = self.experience_maker.compute_reward_no_kl(
-                #     experience.sequences, experience.attention_mask, multiply_by_beta=True
-                #     # beta multiplied for non-PPO formulations
-                # )
-                log_phi = experience.info["reward"].to(base_action_log_probs.device)
-            if "policy" in self.parameterization:
-                # TODO call actor with return_all_vocab=True
-                log_psi_all_vocab, log_psi = self.get_log_psi_policy_parameterization(base_action_log_probs, experience, experience.action_mask.size(1), self.parameterization, return_type="both", base_action_log_probs_all=base_action_log_probs_all_vocab)
+            expected_log_psi = None
+            if self.dpg_streaming:
+                expected_log_psi, log_psi, base_action_log_probs = self.get_dpg_terms_streaming(
+                    experience, num_actions
+                )
+                log_psi_all_vocab, base_action_log_probs_all_vocab = None, None
             else:
-                log_psi_all_vocab, log_psi = self.experience_maker.actor(experience.sequences, experience.action_mask.size(1), experience.attention_mask,
-                                                      return_only_modulation=True, return_type="both")
+                (base_action_log_probs_all_vocab, base_action_log_probs), (log_psi_all_vocab, log_psi) = (
+                    self.get_base_log_probs_and_log_psi(experience, num_actions, return_type="both")
+                )
+            # log_phi = self.experience_maker.compute_reward_no_kl(
+            #     experience.sequences, experience.attention_mask, multiply_by_beta=True
+            #     # beta multiplied for non-PPO formulations
+            # )
+            log_phi = experience.info["reward"].to(base_action_log_probs.device)
 
             # Reshape tensors to group samples by prompt
             log_psi = log_psi.view(num_prompts, samples_per_prompt, -1)
@@ -1226,8 +1384,18 @@ class PPOTrainer(ABC):
             exper_action_log_probs = experience.action_log_probs.view(num_prompts, samples_per_prompt, -1)
             base_action_log_probs = base_action_log_probs.view(num_prompts, samples_per_prompt, -1)
 
-            log_psi_all_vocab = log_psi_all_vocab.view(num_prompts, samples_per_prompt, log_psi_all_vocab.shape[1], log_psi_all_vocab.shape[2])
-            base_action_log_probs_all_vocab = base_action_log_probs_all_vocab.view(num_prompts, samples_per_prompt, base_action_log_probs_all_vocab.shape[1], base_action_log_probs_all_vocab.shape[2])
+            if expected_log_psi is not None:
+                expected_log_psi = expected_log_psi.view(num_prompts, samples_per_prompt, -1)
+            else:
+                log_psi_all_vocab = log_psi_all_vocab.view(
+                    num_prompts, samples_per_prompt, log_psi_all_vocab.shape[1], log_psi_all_vocab.shape[2]
+                )
+                base_action_log_probs_all_vocab = base_action_log_probs_all_vocab.view(
+                    num_prompts,
+                    samples_per_prompt,
+                    base_action_log_probs_all_vocab.shape[1],
+                    base_action_log_probs_all_vocab.shape[2],
+                )
 
             print("DPG INSPECTION")
             print(experience.sequences.shape)
@@ -1257,21 +1425,18 @@ class PPOTrainer(ABC):
                 # reduce_mean_per_prompt=True
                 log_psi_all_vocab,
                 base_action_log_probs_all_vocab,
+                expected_log_psi=expected_log_psi,
             )
 
 
         elif self.actor_loss_type in ["sixo", "sixo_approxneg"]:
-            num_actions = experience.action_mask.size(1)
             log_psi_on_base_samples = None
-            with torch.no_grad():
-                base_action_log_probs = self.experience_maker.initial_model(
-                    experience.sequences, num_actions,
-                    experience.attention_mask)
-                # log_phi = self.experience_maker.compute_reward_no_kl(
-                #     experience.sequences, experience.attention_mask, multiply_by_beta=True
-                #     # beta multiplied for non-PPO formulations
-                # )
-                log_phi = experience.info["reward"].to(base_action_log_probs.device)
+            base_action_log_probs, log_psi = self.get_base_log_probs_and_log_psi(experience, num_actions)
+            # log_phi = self.experience_maker.compute_reward_no_kl(
+            #     experience.sequences, experience.attention_mask, multiply_by_beta=True
+            #     # beta multiplied for non-PPO formulations
+            # )
+            log_phi = experience.info["reward"].to(base_action_log_probs.device)
 
 
             # print(experience.sequences)
@@ -1287,27 +1452,43 @@ class PPOTrainer(ABC):
 
             if self.actor_loss_type == "sixo":
 
-                base_action_mask, base_attention_mask, base_sequences = self.generate_base_seqs_from_torch_prompt(
-                    experience.sequences[:, :-num_actions],
-                    experience.attention_mask[:, :-num_actions],
-                )
+                if experience.base_sequences is not None:
+                    # base samples drawn once per rollout in make_experience
+                    base_action_mask, base_attention_mask, base_sequences = (
+                        experience.base_action_mask,
+                        experience.base_attention_mask,
+                        experience.base_sequences,
+                    )
+                else:
+                    assert (
+                        experience.num_actions is None
+                    ), "Packed experiences need the base samples drawn in make_experience"
+                    base_action_mask, base_attention_mask, base_sequences = self.generate_base_seqs_from_torch_prompt(
+                        experience.sequences[:, :-num_actions],
+                        experience.attention_mask[:, :-num_actions],
+                    )
                 # TODO not yet tested on multiple different prompts (though I expect it should work)
+                base_num_actions = (
+                    experience.base_num_actions
+                    if experience.base_num_actions is not None
+                    else base_action_mask.size(1)
+                )
 
                 if "policy" in self.parameterization:
                     with torch.no_grad():
-                        base_action_base_sample_log_probs = self.experience_maker.initial_model(base_sequences, base_action_mask.size(1), base_attention_mask)
-                    log_psi_on_base_samples = self.get_log_psi_policy_parameterization(base_action_base_sample_log_probs, experience, base_action_mask.size(1), self.parameterization)
+                        base_action_base_sample_log_probs = self.experience_maker.initial_model(
+                            base_sequences, base_num_actions, base_attention_mask
+                        )
+                    log_psi_on_base_samples = self.get_log_psi_policy_parameterization(
+                        base_action_base_sample_log_probs, experience, base_num_actions, self.parameterization
+                    )
                     raise Exception("Not yet tested")
                 else:
-                    log_psi_on_base_samples = self.experience_maker.actor(base_sequences, base_action_mask.size(1),
-                                                                          base_attention_mask,
-                                                                          return_only_modulation=True)
+                    log_psi_on_base_samples = self.experience_maker.actor(
+                        base_sequences, base_num_actions, base_attention_mask, return_only_modulation=True
+                    )
                     # log_psi_on_base_samples = log_psi_on_base_samples[:, -num_actions:]
 
-            if "policy" in self.parameterization:
-                log_psi = self.get_log_psi_policy_parameterization(base_action_log_probs, experience, num_actions, self.parameterization)
-            else:
-                log_psi = self.experience_maker.actor(experience.sequences, experience.action_mask.size(1), experience.attention_mask, return_only_modulation=True)
             # log_psi = log_psi[:, -num_actions:]
 
             # print("ACTOR LOSS STUFF")
@@ -1341,6 +1522,137 @@ class PPOTrainer(ABC):
 
         return actor_loss
 
+    @staticmethod
+    def get_num_actions(experience: Experience):
+        """num_actions for the model forwards: the per-sample counts for packed experiences"""
+        return experience.num_actions if experience.num_actions is not None else experience.action_mask.size(1)
+
+    def get_base_log_probs_and_log_psi(self, experience, num_actions, return_type: str = "p"):
+        """
+        Base log probs (no grad) and log psi on the action tokens of the experience. With return_type="both", each is
+        an (all_vocab, on_action_tokens) pair. The base log probs cached on the experience are reused when present; the
+        all-vocab ones are recovered from the cached base hidden states. Otherwise, for the modulation head
+        parameterizations both come from a single pass through the frozen base trunk, and the base model is run
+        separately for the rest.
+        """
+        actor = self.experience_maker.actor
+        initial_model = self.experience_maker.initial_model
+        base_hidden_states = experience.base_action_hidden_states
+
+        base_output = None
+        if experience.base_action_log_probs is not None:
+            if return_type == "p":
+                base_output = experience.base_action_log_probs
+            elif return_type == "both" and base_hidden_states is not None:
+                with torch.no_grad():
+                    base_action_log_probs_all = initial_model.log_probs_from_hidden_states(
+                        base_hidden_states, return_type="all_vocab"
+                    )
+                base_output = (base_action_log_probs_all, experience.base_action_log_probs)
+
+        if getattr(actor, "use_modulation_head", False):
+            if base_hidden_states is not None:
+                # the head sits on the frozen base trunk, so the cached hidden states are exactly its input
+                labels = gather_action_labels(experience.sequences, num_actions, experience.packed_seq_lens)
+                log_psi = return_or_gather_then_return(labels, actor.modulation_head(base_hidden_states), return_type)
+                if base_output is None:
+                    with torch.no_grad():
+                        base_output = initial_model.log_probs_from_hidden_states(
+                            base_hidden_states, labels, return_type=return_type
+                        )
+                return base_output, log_psi
+            if base_output is None:
+                return actor.forward_with_base(
+                    experience.sequences,
+                    num_actions,
+                    experience.attention_mask,
+                    return_type=return_type,
+                    return_log_q=False,
+                )
+
+        if base_output is None:
+            with torch.no_grad():
+                base_output = initial_model(
+                    experience.sequences, num_actions, experience.attention_mask, return_type=return_type
+                )
+        if "policy" in self.parameterization:
+            if return_type == "both":
+                base_action_log_probs_all, base_action_log_probs = base_output
+                log_psi = self.get_log_psi_policy_parameterization(
+                    base_action_log_probs,
+                    experience,
+                    num_actions,
+                    self.parameterization,
+                    return_type="both",
+                    base_action_log_probs_all=base_action_log_probs_all,
+                )
+            else:
+                log_psi = self.get_log_psi_policy_parameterization(
+                    base_output, experience, num_actions, self.parameterization
+                )
+        else:
+            log_psi = actor(
+                experience.sequences,
+                num_actions,
+                experience.attention_mask,
+                return_only_modulation=True,
+                return_type=return_type,
+            )
+        return base_output, log_psi
+
+
+    def get_dpg_terms_streaming(self, experience, num_actions):
+        """
+        E_{p psi}[log psi], log psi and base log p on the action tokens, computed from final hidden states in
+        checkpointed time chunks (get_dpg_terms_chunked) so that no all-vocab tensor is kept for the backward.
+        """
+        actor = self.experience_maker.actor
+        initial_model = self.experience_maker.initial_model
+
+        labels = gather_action_labels(experience.sequences, num_actions, experience.packed_seq_lens)
+
+
+        base_hidden_states = experience.base_action_hidden_states
+
+        if base_hidden_states is None:
+            with torch.no_grad():
+                base_hidden_states = initial_model.action_hidden_states(
+
+                    experience.sequences, num_actions, experience.attention_mask
+
+                )
+        _, base_lm_head = get_trunk_and_lm_head(initial_model.model)
+
+
+        def base_log_probs_all(hidden_states):
+            with torch.no_grad():
+                return F.log_softmax(base_lm_head(hidden_states).float(), dim=-1)
+
+        if getattr(actor, "use_modulation_head", False):
+            def log_p_and_log_psi(base_hidden):
+                return base_log_probs_all(base_hidden), actor.modulation_head(base_hidden).float()
+
+            return get_dpg_terms_chunked(log_p_and_log_psi, labels, base_hidden_states)
+
+        actor_hidden_states = actor.action_hidden_states(experience.sequences, num_actions, experience.attention_mask)
+        _, actor_lm_head = get_trunk_and_lm_head(actor.model)
+        if "policy" not in self.parameterization:
+            def log_p_and_log_psi(base_hidden, actor_hidden):
+                return base_log_probs_all(base_hidden), actor_lm_head(actor_hidden).float()
+        elif self.parameterization == "policy_psi_unnorm":
+            def log_p_and_log_psi(base_hidden, actor_hidden):
+                log_p_all = base_log_probs_all(base_hidden)
+                return log_p_all, actor_lm_head(actor_hidden).float() - log_p_all
+        elif self.parameterization == "policy_psi_q_p_s_t":
+            def log_p_and_log_psi(base_hidden, actor_hidden):
+                log_p_all = base_log_probs_all(base_hidden)
+                return log_p_all, F.log_softmax(actor_lm_head(actor_hidden).float(), dim=-1) - log_p_all
+        else:
+            # policy_psi_q_p_s_1_to_t sums over the time dim, which does not split into independent time chunks
+            raise NotImplementedError
+
+        return get_dpg_terms_chunked(log_p_and_log_psi, labels, base_hidden_states, actor_hidden_states)
+
     def get_log_psi_policy_parameterization(self, base_action_log_probs, experience, num_actions, parameterization, return_type: str = 'p', base_action_log_probs_all=None):
 
         if return_type == "both":
@@ -1348,13 +1660,13 @@ class PPOTrainer(ABC):
             assert base_action_log_probs_all is not None
 
             if parameterization == "policy_psi_unnorm":
-            # if log_psi_parameterization_type == "unnormalized_q_s_t_logits_minus_log_p_s_t":
+                # if log_psi_parameterization_type == "unnormalized_q_s_t_logits_minus_log_p_s_t":
                 log_p_psi_all, log_p_psi = self.experience_maker.actor(experience.sequences, num_actions,
                                                                        experience.attention_mask,
                                                                        return_type=return_type,
                                                                        return_unnormalized=True)
             elif parameterization in ["policy_psi_q_p_s_t", "policy_psi_q_p_s_1_to_t"]:
-            # elif log_psi_parameterization_type in ["log_q_s_t_minus_log_p_s_t", "log_q_s_1_to_t_minus_log_p_s_1_to_t"]:
+                # elif log_psi_parameterization_type in ["log_q_s_t_minus_log_p_s_t", "log_q_s_1_to_t_minus_log_p_s_1_to_t"]:
                 log_p_psi_all, log_p_psi = self.experience_maker.actor(experience.sequences, num_actions,
                                                                        experience.attention_mask,
                                                                        return_type=return_type)
@@ -1362,7 +1674,7 @@ class PPOTrainer(ABC):
                 raise NotImplementedError
 
             if parameterization == "policy_psi_q_p_s_1_to_t":
-            # if log_psi_parameterization_type == "log_q_s_1_to_t_minus_log_p_s_1_to_t":
+                # if log_psi_parameterization_type == "log_q_s_1_to_t_minus_log_p_s_1_to_t":
                 log_p_psi_all = torch.cumsum(log_p_psi_all, dim=1)
                 log_p_psi = torch.cumsum(log_p_psi, dim=1)
                 base_action_log_probs = torch.cumsum(base_action_log_probs, dim=1)
@@ -1383,13 +1695,13 @@ class PPOTrainer(ABC):
             return log_psi_all, log_psi
 
         if parameterization == "policy_psi_unnorm":
-        # if log_psi_parameterization_type == "unnormalized_q_s_t_logits_minus_log_p_s_t":
+            # if log_psi_parameterization_type == "unnormalized_q_s_t_logits_minus_log_p_s_t":
             log_p_psi = self.experience_maker.actor(experience.sequences, num_actions,
                                                                    experience.attention_mask,
                                                                    return_type=return_type,
                                                                    return_unnormalized=True)
         elif parameterization in ["policy_psi_q_p_s_t", "policy_psi_q_p_s_1_to_t"]:
-        # elif log_psi_parameterization_type in ["log_q_s_t_minus_log_p_s_t", "log_q_s_1_to_t_minus_log_p_s_1_to_t"]:
+            # elif log_psi_parameterization_type in ["log_q_s_t_minus_log_p_s_t", "log_q_s_1_to_t_minus_log_p_s_1_to_t"]:
             log_p_psi = self.experience_maker.actor(experience.sequences, num_actions,
                                                                    experience.attention_mask,
                                                                    return_type=return_type)
@@ -1397,7 +1709,7 @@ class PPOTrainer(ABC):
             raise NotImplementedError
 
         if parameterization == "policy_psi_q_p_s_1_to_t":
-        # if log_psi_parameterization_type == "log_q_s_1_to_t_minus_log_p_s_1_to_t":
+            # if log_psi_parameterization_type == "log_q_s_1_to_t_minus_log_p_s_1_to_t":
             log_p_psi = torch.cumsum(log_p_psi, dim=1)
             base_action_log_probs = torch.cumsum(base_action_log_probs, dim=1)
 
@@ -1421,6 +1733,7 @@ class PPOTrainer(ABC):
             action_mask=experience.action_mask,
             attention_mask=experience.attention_mask,
             return_output=True,
+            num_actions=experience.num_actions,
         )
         # loss function
         critic_loss = self.get_critic_loss(experience, values, custom_prompt=custom_prompt)
@@ -1,3 +1,6 @@
 from .experience_maker import Experience, NaiveExperienceMaker, RemoteExperienceMaker
 from .kl_controller import AdaptiveKLController, FixedKLController
-from .replay_buffer import NaiveReplayBuffer
+from .prefetcher import BackgroundPrefetcher, DevicePrefetcher
+from .replay_buffer import ColumnarReplayBuffer, LengthGroupedBatchSampler, MemmapReplayBuffer, NaiveReplayBuffer
+from .rollout_reuse import RolloutReusePool, rollout_ess
+from .streaming_estimator import StreamingIWAEEstimator, StreamingStats
@@ -9,10 +9,11 @@ from torch.profiler import profile, record_function, ProfilerActivity
 import ray
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from tqdm import tqdm
 
 from openrlhf.models.actor import Actor
-from openrlhf.models.utils import compute_reward, masked_mean
+from openrlhf.models.utils import compute_reward, discounted_reverse_cumsum, masked_mean
 from openrlhf.utils.logging_utils import init_logger
 from openrlhf.utils.remote_rm_utils import remote_rm_fn, remote_rm_fn_ray
 from openrlhf.utils.utils import tile_prompts
@@ -34,8 +35,23 @@ class Experience:
     advatanges: (B, A)
     attention_mask: (B, S)
     action_mask: (B, A)
-
-    "A" is the number of actions.
+    base_action_log_probs: (B, A)
+    base_action_hidden_states: (B, A, H)
+    base_sequences: (B, S')
+    base_attention_mask: (B, S')
+    base_action_mask: (B, A')
+
+    "A" is the number of actions, "H" the hidden size of the base model.
+    base_sequences/base_attention_mask/base_action_mask are an optional sample from the base model for the
+    same prompt as each row (used for the SIXO negative term), with their own lengths S' and A'.
+    base_action_log_probs and base_action_hidden_states are computed once when the
+    experience is made; the latter is the compact form of the all-vocab base log probs
+    (lm_head + log_softmax recovers them) and is only kept when requested.
+
+    Packed experiences (make_experience_batch with packing_samples) instead hold all the sequences in a single
+    (1, sum(packed_seq_lens) + 1) row, with sample i marked by i + 1 in attention_mask (0 for the trailing pad).
+    num_actions holds the per-sample action counts, and every action-level tensor keeps its left padded (B, A)
+    layout. Base samples are packed the same way, with base_num_actions.
     """
 
     sequences: torch.Tensor
@@ -46,19 +62,35 @@ class Experience:
     attention_mask: Optional[torch.LongTensor]
     action_mask: Optional[torch.BoolTensor]
     info: Optional[dict]
+    base_action_log_probs: Optional[torch.Tensor] = None
+    base_action_hidden_states: Optional[torch.Tensor] = None
+    base_sequences: Optional[torch.Tensor] = None
+    base_attention_mask: Optional[torch.LongTensor] = None
+    base_action_mask: Optional[torch.BoolTensor] = None
+    packed_seq_lens: Optional[List[int]] = None
+    num_actions: Optional[List[int]] = None
+    base_num_actions: Optional[List[int]] = None
 
     @torch.no_grad()
-    def to_device(self, device: torch.device) -> None:
-        self.sequences = self.sequences.to(device)
-        self.action_log_probs = self.action_log_probs.to(device)
-        self.values = self.values.to(device)
-        self.returns = self.returns.to(device)
+    def to_device(self, device: torch.device, non_blocking: bool = False) -> None:
+        self.sequences = self.sequences.to(device, non_blocking=non_blocking)
+        self.action_log_probs = self.action_log_probs.to(device, non_blocking=non_blocking)
+        self.values = self.values.to(device, non_blocking=non_blocking)
+        self.returns = self.returns.to(device, non_blocking=non_blocking)
         if self.advantages is not None:
-            self.advantages = self.advantages.to(device)
+            self.advantages = self.advantages.to(device, non_blocking=non_blocking)
         if self.attention_mask is not None:
-            self.attention_mask = self.attention_mask.to(device)
+            self.attention_mask = self.attention_mask.to(device, non_blocking=non_blocking)
         if self.action_mask is not None:
-            self.action_mask = self.action_mask.to(device)
+            self.action_mask = self.action_mask.to(device, non_blocking=non_blocking)
+        if self.base_action_log_probs is not None:
+            self.base_action_log_probs = self.base_action_log_probs.to(device, non_blocking=non_blocking)
+        if self.base_action_hidden_states is not None:
+            self.base_action_hidden_states = self.base_action_hidden_states.to(device, non_blocking=non_blocking)
+        if self.base_sequences is not None:
+            self.base_sequences = self.base_sequences.to(device, non_blocking=non_blocking)
+            self.base_attention_mask = self.base_attention_mask.to(device, non_blocking=non_blocking)
+            self.base_action_mask = self.base_action_mask.to(device, non_blocking=non_blocking)
 
     def pin_memory(self):
         self.sequences = self.sequences.pin_memory()
@@ -70,8 +102,22 @@ class Experience:
             self.attention_mask = self.attention_mask.pin_memory()
         if self.action_mask is not None:
             self.action_mask = self.action_mask.pin_memory()
+        if self.base_action_log_probs is not None:
+            self.base_action_log_probs = self.base_action_log_probs.pin_memory()
+        if self.base_action_hidden_states is not None:
+            self.base_action_hidden_states = self.base_action_hidden_states.pin_memory()
+        if self.base_sequences is not None:
+            self.base_sequences = self.base_sequences.pin_memory()
+            self.base_attention_mask = self.base_attention_mask.pin_memory()
+            self.base_action_mask = self.base_action_mask.pin_memory()
         return self
 
+    def record_stream(self, stream) -> None:
+        """Marks the (device) tensors as in use by stream, after they were copied to the device on another stream"""
+        for value in vars(self).values():
+            if isinstance(value, torch.Tensor):
+                value.record_stream(stream)
+
 
 class NaiveExperienceMaker(ABC):
     """
@@ -91,14 +137,19 @@ class NaiveExperienceMaker(ABC):
         remote_rm_url: str = None,
         reward_fn=None,
         shared_actorcritic=False,
-        threshold=-5.,
+        threshold=-5.0,
         reward_cap=4.5,
-        target_dist_beta=1.,
+        target_dist_beta=1.0,
         rm_type=None,
         actor_loss_type=None,
         max_new_tokens=None,
         save_negdata=False,
         save_negdata_threshold=-10000,
+        use_generation_log_probs=False,
+        cache_base_hidden_states=False,
+        share_prompt_prefix=False,
+        generate_base_samples=False,
+        base_samples_refresh_every=1,
     ) -> None:
         super().__init__()
         self.actor = actor
@@ -118,6 +169,20 @@ class NaiveExperienceMaker(ABC):
         self.rm_type = rm_type
         self.actor_loss_type = actor_loss_type
         self.max_new_tokens = max_new_tokens
+        # Take action log probs from the sampler instead of re-running the actor on the generated sequences
+        self.use_generation_log_probs = use_generation_log_probs
+        # Keep the base model's final hidden states on the actions so all-vocab losses (DPG) skip the base forward
+        self.cache_base_hidden_states = cache_base_hidden_states
+        # Encode each distinct prompt once in the no-grad scoring passes over the generated sequences
+        self.share_prompt_prefix = share_prompt_prefix
+        # Draw a base model sample per row in make_experience (SIXO negative samples), so the loss does not generate.
+        # The base model is frozen, so the pool stays valid for unchanged prompts and is only redrawn every
+        # base_samples_refresh_every rollouts
+        self.generate_base_samples = generate_base_samples
+        self.base_samples_refresh_every = base_samples_refresh_every
+        self.base_sample_pool = None
+        self.base_sample_pool_prompts = None
+        self.base_sample_pool_uses = 0
 
         assert actor_loss_type is not None
 
@@ -151,19 +216,33 @@ class NaiveExperienceMaker(ABC):
 
 
         if self.shared_actorcritic:
-            action_log_probs, action_mask, attention_mask, num_actions, sequences, value = self.generate_seqs_and_get_logprobs(
-                expanded_prompts, **generate_kwargs)
+            action_log_probs, action_mask, attention_mask, num_actions, sequences, value, base_action_log_probs = (
+                self.generate_seqs_and_get_logprobs(expanded_prompts, return_base_log_probs=True, **generate_kwargs)
+            )
         else:
-            action_log_probs, action_mask, attention_mask, num_actions, sequences = self.generate_seqs_and_get_logprobs(
-                expanded_prompts, **generate_kwargs)
+            action_log_probs, action_mask, attention_mask, num_actions, sequences, base_action_log_probs = (
+                self.generate_seqs_and_get_logprobs(expanded_prompts, return_base_log_probs=True, **generate_kwargs)
+            )
 
             if self.critic is not None:
                 # values
-                value = self.critic(sequences, action_mask, attention_mask)
+                value = self.critic(
+                    sequences, action_mask, attention_mask, share_prompt_prefix=self.share_prompt_prefix
+                )
 
             else:
                 value = None
 
+        base_action_hidden_states = None
+        if self.cache_base_hidden_states:
+            base_action_hidden_states = self.initial_model.action_hidden_states(sequences, num_actions, attention_mask)
+
+        base_sequences, base_attention_mask, base_action_mask = None, None, None
+        if self.generate_base_samples:
+            base_sequences, base_attention_mask, base_action_mask = self.get_base_samples(
+                expanded_prompts, **generate_kwargs
+            )
+
         print("MAKE EXPERIENCE INSPECTION")
         print(sequences)
         print(attention_mask)
@@ -204,9 +283,7 @@ class NaiveExperienceMaker(ABC):
         # print(attention_mask.device)
         # print(self.initial_model.model.device)
 
-        # init log probs
-        base_action_log_probs = self.initial_model(sequences, num_actions,
-                                                   attention_mask)
+        # init log probs (base_action_log_probs) come from generate_seqs_and_get_logprobs
         # print("--BASE ACTION LOG PROBS--")
         # print(base_action_log_probs.mean())
         # print(base_action_log_probs)
@@ -285,6 +362,11 @@ class NaiveExperienceMaker(ABC):
             attention_mask,
             action_mask,
             info,
+            base_action_log_probs=base_action_log_probs,
+            base_action_hidden_states=base_action_hidden_states,
+            base_sequences=base_sequences,
+            base_attention_mask=base_attention_mask,
+            base_action_mask=base_action_mask,
         )
 
 
@@ -398,6 +480,25 @@ class NaiveExperienceMaker(ABC):
             else:
                 return final_reward
 
+    @torch.no_grad()
+    def get_base_samples(self, prompts, **generate_kwargs):
+        """
+        Base model samples (sequences, attention_mask, action_mask), one per prompt in prompts. The pool is reused
+        while the prompts are unchanged, for up to base_samples_refresh_every calls.
+        """
+        if (
+            self.base_sample_pool is None
+            or self.base_sample_pool_prompts != prompts
+            or self.base_sample_pool_uses >= self.base_samples_refresh_every
+        ):
+            self.initial_model.eval()
+            inputs = self.tokenize_fn(prompts, self.prompt_max_len, device="cuda")
+            self.base_sample_pool = self.initial_model.generate(**inputs, **generate_kwargs)
+            self.base_sample_pool_prompts = list(prompts)
+            self.base_sample_pool_uses = 0
+        self.base_sample_pool_uses += 1
+        return self.base_sample_pool
+
     def set_all_eval(self):
         self.actor.eval()
         if self.critic is not None:
@@ -406,7 +507,38 @@ class NaiveExperienceMaker(ABC):
         if self.reward_model is not None:
             self.reward_model.eval()
 
-    def generate_seqs_and_get_logprobs(self, prompts, **generate_kwargs):
+    @torch.no_grad()
+    def get_action_and_base_log_probs(self, sequences, num_actions, attention_mask, action_log_probs=None):
+        """
+        Actor (proposal) and base log probs on the action tokens. For the modulation head parameterizations, both come
+        from a single pass through the frozen base trunk. action_log_probs, if already available (from generation), is
+        reused and log q is not recomputed. Generation log probs are zero off the action mask, where a forward pass
+        gives the log probs of the padding; only the action_mask positions are used downstream, and there the two
+        agree.
+        """
+        if getattr(self.actor, "use_modulation_head", False):
+            outputs = self.actor.forward_with_base(
+                sequences,
+                num_actions,
+                attention_mask,
+                return_log_q=action_log_probs is None,
+                share_prompt_prefix=self.share_prompt_prefix,
+            )
+            base_action_log_probs = outputs[0]
+            if action_log_probs is None:
+                action_log_probs = outputs[2]
+            return action_log_probs, base_action_log_probs
+
+        if action_log_probs is None:
+            action_log_probs = self.actor(
+                sequences, num_actions, attention_mask, share_prompt_prefix=self.share_prompt_prefix
+            )
+        base_action_log_probs = self.initial_model(
+            sequences, num_actions, attention_mask, share_prompt_prefix=self.share_prompt_prefix
+        )
+        return action_log_probs, base_action_log_probs
+
+    def generate_seqs_and_get_logprobs(self, prompts, return_base_log_probs=False, **generate_kwargs):
         self.set_all_eval()
         # generate seq
         inputs = self.tokenize_fn(prompts, self.prompt_max_len, device="cuda")
@@ -417,8 +549,13 @@ class NaiveExperienceMaker(ABC):
         # with profile(activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA],
         #              profile_memory=True, record_shapes=True) as prof:
 
-        sequences, attention_mask, action_mask = self.actor.generate(**inputs,
-                                                                     **generate_kwargs)
+        action_log_probs = None
+        if self.use_generation_log_probs and not self.shared_actorcritic:
+            sequences, attention_mask, action_mask, action_log_probs, _ = self.actor.generate(
+                **inputs, return_log_probs=True, **generate_kwargs
+            )
+        else:
+            sequences, attention_mask, action_mask = self.actor.generate(**inputs, **generate_kwargs)
         # print("PROFILE GENERATE")
         # print(prof.key_averages().table(sort_by="self_cuda_memory_usage"))
 
@@ -472,9 +609,28 @@ class NaiveExperienceMaker(ABC):
             # print(sequences.shape)
 
             action_log_probs, values = self.actor(sequences, num_actions, attention_mask)
+            if return_base_log_probs:
+                base_action_log_probs = self.initial_model(sequences, num_actions, attention_mask)
+                return (
+                    action_log_probs,
+                    action_mask,
+                    attention_mask,
+                    num_actions,
+                    sequences,
+                    values,
+                    base_action_log_probs,
+                )
             return action_log_probs, action_mask, attention_mask, num_actions, sequences, values
         else:
-            action_log_probs = self.actor(sequences, num_actions, attention_mask)
+            if return_base_log_probs:
+                action_log_probs, base_action_log_probs = self.get_action_and_base_log_probs(
+                    sequences, num_actions, attention_mask, action_log_probs
+                )
+                return action_log_probs, action_mask, attention_mask, num_actions, sequences, base_action_log_probs
+            if action_log_probs is None:
+                action_log_probs = self.actor(
+                    sequences, num_actions, attention_mask, share_prompt_prefix=self.share_prompt_prefix
+                )
             # print("--ACTION LOG PROBS--")
             # print(action_log_probs.mean())
             # print(action_log_probs)
@@ -509,20 +665,24 @@ class NaiveExperienceMaker(ABC):
         - advantages: Tensor of shape (batch_size, response_size)
         - returns: Tensor of shape (batch_size, response_size)
         """
-        lastgaelam = 0
-        advantages_reversed = []
-        response_length = rewards.size(1)
-
         # Mask invalid responses
         values = action_mask * values
         rewards = action_mask * rewards
 
-        for t in reversed(range(response_length)):
-            nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
-            delta = rewards[:, t] + gamma * nextvalues - values[:, t]
-            lastgaelam = delta + gamma * lambd * lastgaelam
-            advantages_reversed.append(lastgaelam)
-        advantages = torch.stack(advantages_reversed[::-1], dim=1)
+        # The following code is equivalent to:
+        #
+        # lastgaelam = 0
+        # advantages_reversed = []
+        # for t in reversed(range(response_length)):
+        #     nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
+        #     delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        #     lastgaelam = delta + gamma * lambd * lastgaelam
+        #     advantages_reversed.append(lastgaelam)
+        # advantages = torch.stack(advantages_reversed[::-1], dim=1)
+        #
+        next_values = F.pad(values[:, 1:], (0, 1))
+        deltas = rewards + gamma * next_values - values
+        advantages = discounted_reverse_cumsum(deltas, gamma * lambd)
         returns = advantages + values
         # print("ADV-RETURNS")
         # print(returns)
@@ -0,0 +1,118 @@
+import queue
+import threading
+from typing import Iterable
+
+import torch
+
+
+class BackgroundPrefetcher:
+    """Iterates over an iterable (e.g. a DataLoader over the replay buffer) in a background thread, keeping up to
+    num_prefetch items ready, so that gathering the next micro-batch overlaps with the current training step.
+
+    Exceptions raised by the iterable are re-raised in the consuming thread.
+
+    Args:
+        iterable (Iterable): The iterable to prefetch from.
+        num_prefetch (int, optional): Number of items to keep ready. Defaults to 1.
+    """
+
+    _END = object()
+
+    def __init__(self, iterable: Iterable, num_prefetch: int = 1) -> None:
+        self.iterable = iterable
+        self.num_prefetch = num_prefetch
+
+    @staticmethod
+    def _put(items: queue.Queue, item, stop: threading.Event) -> bool:
+        # give up once the consumer has stopped, instead of blocking on a full queue
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, items: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for item in self.iterable:
+                if not self._put(items, item, stop):
+                    return
+            self._put(items, self._END, stop)
+        except BaseException as e:
+            self._put(items, e, stop)
+
+    def __iter__(self):
+        items = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(items, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is self._END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # also reached when the consumer stops early
+            stop.set()
+            thread.join()
+
+    def __len__(self) -> int:
+        return len(self.iterable)
+
+
+class DevicePrefetcher:
+    """Iterates over the micro-batches of replay buffer loaders with collation and host-to-device copies off the
+    critical path. Batches (an Experience, or a tuple of them, e.g. from zipped loaders) are collated and pinned in a
+    background thread (BackgroundPrefetcher), and each one is copied to the device with non-blocking copies on a side
+    CUDA stream while the previous one is being trained on.
+
+    Args:
+        iterable (Iterable): The loader to prefetch from.
+        device: The device to copy the batches to.
+        num_prefetch (int, optional): Number of collated batches to keep ready on the host. Defaults to 1.
+    """
+
+    def __init__(self, iterable: Iterable, device, num_prefetch: int = 1) -> None:
+        self.iterable = iterable
+        self.device = device
+        self.num_prefetch = num_prefetch
+
+    @staticmethod
+    def _experiences(batch):
+        return batch if isinstance(batch, (tuple, list)) else (batch,)
+
+    def _pinned(self):
+        for batch in self.iterable:
+            for experience in self._experiences(batch):
+                # a no-op for the tensors already pinned by the DataLoader
+                experience.pin_memory()
+            yield batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(BackgroundPrefetcher(self._pinned(), self.num_prefetch))
+
+        def load(batch):
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    for experience in self._experiences(batch):
+                        experience.to_device(self.device, non_blocking=True)
+            return batch
+
+        next_batch = load(next(batches, None))
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for experience in self._experiences(batch):
+                # the copies were allocated on the side stream but are used on the current one
+                experience.record_stream(current_stream)
+            next_batch = load(next(batches, None))
+            yield batch
+
+    def __len__(self) -> int:
+        return len(self.iterable)
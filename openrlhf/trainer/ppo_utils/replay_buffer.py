@@ -1,10 +1,15 @@
+import math
+import os
 import random
+import shutil
+import tempfile
 from abc import ABC
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
+from torch.utils.data import Sampler
 
 from openrlhf.models.utils import masked_mean
 
@@ -23,6 +28,11 @@ class BufferItem:
     advatanges: (1)
     attention_mask: (S)
     action_mask: (A)
+    base_action_log_probs: (A)
+    base_action_hidden_states: (A, H)
+    base_sequences: (S')
+    base_attention_mask: (S')
+    base_action_mask: (A')
 
     "A" is the number of actions.
     """
@@ -35,22 +45,53 @@ class BufferItem:
     attention_mask: Optional[torch.LongTensor]
     action_mask: Optional[torch.BoolTensor]
     info: Optional[dict]
+    base_action_log_probs: Optional[torch.Tensor] = None
+    base_action_hidden_states: Optional[torch.Tensor] = None
+    base_sequences: Optional[torch.Tensor] = None
+    base_attention_mask: Optional[torch.LongTensor] = None
+    base_action_mask: Optional[torch.BoolTensor] = None
+
+
+# action-level fields that are only present for some experience makers / losses
+OPTIONAL_ACTION_KEYS = (
+    "base_action_log_probs",
+    "base_action_hidden_states",
+)
+# optional base model sample for the same prompt, padded independently of the main sequence
+BASE_SAMPLE_KEYS = (
+    "base_sequences",
+    "base_attention_mask",
+    "base_action_mask",
+)
+# fields concatenated into a single row for packed experiences; the action-level ones stay left padded
+PACKED_KEYS = (
+    "sequences",
+    "attention_mask",
+    "base_sequences",
+    "base_attention_mask",
+)
 
 
 def split_experience_batch(experience: Experience) -> List[BufferItem]:
     batch_size = experience.sequences.size(0)
     batch_kwargs = [{} for _ in range(batch_size)]
     keys = (
-        "sequences",
-        "action_log_probs",
-        "values",
-        "returns",
-        "advantages",
-        "attention_mask",
-        "action_mask",
+        (
+            "sequences",
+            "action_log_probs",
+            "values",
+            "returns",
+            "advantages",
+            "attention_mask",
+            "action_mask",
+        )
+        + OPTIONAL_ACTION_KEYS
+        + BASE_SAMPLE_KEYS
     )
     for key in keys:
         value = getattr(experience, key)
+        if value is None:
+            continue
         vals = torch.unbind(value)
         assert batch_size == len(vals)
         for i, v in enumerate(vals):
@@ -75,22 +116,40 @@ def zero_pad_sequences(sequences: List[torch.Tensor], side: str = "left") -> tor
     for seq in sequences:
         pad_len = max_len - seq.size(0)
         padding = (pad_len, 0) if side == "left" else (0, pad_len)
+        # F.pad pads from the last dim backwards, so skip the trailing dims of e.g. (A, H) hidden states
+        padding = (0, 0) * (seq.dim() - 1) + padding
         padded_sequences.append(F.pad(seq, padding))
     return torch.stack(padded_sequences, dim=0)
 
 
-def make_experience_batch(items: List[BufferItem]) -> Experience:
+def pack_sequences(sequences: torch.Tensor, seq_lens: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Packs concatenated unpadded sequences into a single row, with sample i marked by i + 1 in the attention mask.
+    Like the SFT packing_collate_fn, a trailing pad token (mask 0) is added so that the models keep the mask.
+    """
+    seq_lens = seq_lens.to(sequences.device)
+    segment_ids = torch.repeat_interleave(torch.arange(1, seq_lens.numel() + 1, device=sequences.device), seq_lens)
+    return F.pad(sequences, (0, 1)).unsqueeze(0), F.pad(segment_ids, (0, 1)).unsqueeze(0)
+
+
+def make_experience_batch(items: List[BufferItem], packing_samples: bool = False) -> Experience:
     kwargs = {}
     keys = (
-        "sequences",
-        "action_log_probs",
-        "values",
-        "returns",
-        "advantages",
-        "attention_mask",
-        "action_mask",
+        (
+            "sequences",
+            "action_log_probs",
+            "values",
+            "returns",
+            "advantages",
+            "attention_mask",
+            "action_mask",
+        )
+        + OPTIONAL_ACTION_KEYS
+        + BASE_SAMPLE_KEYS
     )
     for key in keys:
+        if getattr(items[0], key) is None or (packing_samples and key in PACKED_KEYS):
+            continue
         vals = [getattr(item, key) for item in items]
         batch_data = zero_pad_sequences(vals, "left")
         kwargs[key] = batch_data
@@ -99,6 +158,20 @@ def make_experience_batch(items: List[BufferItem]) -> Experience:
     for key in items[0].info.keys():
         vals = torch.tensor([item.info[key] for item in items])
         kwargs["info"][key] = vals
+
+    if packing_samples:
+        seq_lens = torch.tensor([item.sequences.numel() for item in items])
+        kwargs["sequences"], kwargs["attention_mask"] = pack_sequences(
+            torch.cat([item.sequences for item in items]), seq_lens
+        )
+        kwargs["packed_seq_lens"] = seq_lens.tolist()
+        kwargs["num_actions"] = [item.action_mask.numel() for item in items]
+        if items[0].base_sequences is not None:
+            base_seq_lens = torch.tensor([item.base_sequences.numel() for item in items])
+            kwargs["base_sequences"], kwargs["base_attention_mask"] = pack_sequences(
+                torch.cat([item.base_sequences for item in items]), base_seq_lens
+            )
+            kwargs["base_num_actions"] = [item.base_action_mask.numel() for item in items]
     return Experience(**kwargs)
 
 
@@ -135,6 +208,18 @@ def remove_padding_in_sequences(items):
             att_mask[left_pad:right_pad],
             act_mask[:right_pad],
         )
+        for key in OPTIONAL_ACTION_KEYS:
+            value = getattr(item, key)
+            if value is not None:
+                setattr(item, key, value[:right_pad])
+
+        if item.base_sequences is not None:
+            base_right_pad = (1 - item.base_action_mask.long()).sum()
+            base_right_pad = None if base_right_pad == 0 else -base_right_pad
+            base_left_pad = item.base_attention_mask.long().argmax()
+            item.base_sequences = item.base_sequences[base_left_pad:base_right_pad]
+            item.base_attention_mask = item.base_attention_mask[base_left_pad:base_right_pad]
+            item.base_action_mask = item.base_action_mask[:base_right_pad]
     return items
 
 
@@ -145,14 +230,18 @@ class NaiveReplayBuffer(ABC):
         sample_batch_size (int): Batch size when sampling.
         limit (int, optional): Limit of number of experience samples. A number <= 0 means unlimited. Defaults to 0.
         cpu_offload (bool, optional): Whether to offload experience to cpu when sampling. Defaults to True.
+        packing_samples (bool, optional): Whether to emit packed experiences (see Experience). Defaults to False.
     """
 
-    def __init__(self, sample_batch_size: int, limit: int = 0, cpu_offload: bool = True) -> None:
+    def __init__(
+        self, sample_batch_size: int, limit: int = 0, cpu_offload: bool = True, packing_samples: bool = False
+    ) -> None:
         super().__init__()
         self.sample_batch_size = sample_batch_size
         # limit <= 0 means unlimited
         self.limit = limit
         self.cpu_offload = cpu_offload
+        self.packing_samples = packing_samples
         self.target_device = torch.device(f"cuda:{torch.cuda.current_device()}")
         self.items: List[BufferItem] = []
 
@@ -174,7 +263,7 @@ class NaiveReplayBuffer(ABC):
     @torch.no_grad()
     def sample(self) -> Experience:
         items = random.sample(self.items, self.sample_batch_size)
-        experience = make_experience_batch(items)
+        experience = make_experience_batch(items, self.packing_samples)
         if self.cpu_offload:
             experience.to_device(self.target_device)
         return experience
@@ -185,8 +274,12 @@ class NaiveReplayBuffer(ABC):
     def __getitem__(self, idx: int) -> BufferItem:
         return self.items[idx]
 
+    def sequence_lengths(self) -> List[int]:
+        """Unpadded sequence length of each sample"""
+        return [item.sequences.numel() for item in self.items]
+
     def collate_fn(self, batch) -> Experience:
-        experience = make_experience_batch(batch)
+        experience = make_experience_batch(batch, self.packing_samples)
         return experience
 
     def normalize(self, attribute: str, strategy) -> None:
@@ -212,3 +305,330 @@ class NaiveReplayBuffer(ABC):
 
         for i, item in enumerate(self):
             setattr(item, attribute, (items[i] - mean) * rstd)
+
+
+# Columns of ColumnarReplayBuffer, grouped by the ragged dimension they share
+COLUMN_GROUPS = {
+    "sequence": ("sequences", "attention_mask"),
+    "action": ("action_log_probs", "values", "returns", "advantages", "action_mask") + OPTIONAL_ACTION_KEYS,
+    "base_sequence": ("base_sequences", "base_attention_mask"),
+    "base_action": ("base_action_mask",),
+}
+
+
+def unpad_rows(tensor: torch.Tensor, starts: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """Concatenates tensor[i, starts[i] : starts[i] + lengths[i]] over the rows i, along dim 0"""
+    positions = torch.arange(tensor.size(1), device=tensor.device)
+    keep = (positions[None, :] >= starts[:, None]) & (positions[None, :] < (starts + lengths)[:, None])
+    return tensor[keep]
+
+
+def left_pad_rows(flat: torch.Tensor, offsets: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """Gathers flat[offsets[i] : offsets[i] + lengths[i]] for each i into a new zero left-padded
+    (N, max(lengths), ...) tensor"""
+    max_len = int(lengths.max())
+    positions = torch.arange(max_len, device=flat.device)
+    pad_lens = max_len - lengths
+    index = (offsets[:, None] + positions[None, :] - pad_lens[:, None]).clamp(min=0)
+    padded = flat[index]
+    padded[positions[None, :] < pad_lens[:, None]] = 0
+    return padded
+
+
+def concat_rows(flat: torch.Tensor, offsets: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """Gathers flat[offsets[i] : offsets[i] + lengths[i]] for each i, concatenated along dim 0"""
+    starts = lengths.cumsum(dim=0) - lengths
+    index = torch.arange(int(lengths.sum()), device=flat.device) + torch.repeat_interleave(offsets - starts, lengths)
+    return flat[index]
+
+
+class ColumnarReplayBuffer(ABC):
+    """Replay buffer storing experience as columns instead of per-sample BufferItems.
+
+    Each field is one contiguous tensor of the unpadded samples concatenated along dim 0, with per-sample lengths and
+    offsets shared by the fields of a COLUMN_GROUPS group, and info entries are (N,) tensors. Indexing returns the
+    sample index, and collate_fn gathers and left-pads a whole batch at once, so it can be used in place of
+    NaiveReplayBuffer as a Dataset.
+
+    Args:
+        sample_batch_size (int): Batch size when sampling.
+        limit (int, optional): Limit of number of experience samples. A number <= 0 means unlimited. Defaults to 0.
+        cpu_offload (bool, optional): Whether to offload experience to cpu when sampling. Defaults to True.
+        packing_samples (bool, optional): Whether to emit packed experiences (see Experience). Defaults to False.
+    """
+
+    def __init__(
+        self, sample_batch_size: int, limit: int = 0, cpu_offload: bool = True, packing_samples: bool = False
+    ) -> None:
+        super().__init__()
+        self.sample_batch_size = sample_batch_size
+        # limit <= 0 means unlimited
+        self.limit = limit
+        self.cpu_offload = cpu_offload
+        self.packing_samples = packing_samples
+        self.target_device = torch.device(f"cuda:{torch.cuda.current_device()}")
+        self.clear()
+
+    @torch.no_grad()
+    def append(self, experience: Experience) -> None:
+        if self.cpu_offload:
+            experience.to_device(torch.device("cpu"))
+
+        # same padding layout as remove_padding_in_sequences, computed for all rows at once
+        right_pad = (1 - experience.action_mask.long()).sum(dim=-1)
+        left_pad = experience.attention_mask.long().argmax(dim=-1)
+        starts = {
+            "sequence": left_pad,
+            "action": torch.zeros_like(right_pad),
+        }
+        lengths = {
+            "sequence": experience.sequences.size(1) - left_pad - right_pad,
+            "action": experience.action_mask.size(1) - right_pad,
+        }
+        if experience.base_sequences is not None:
+            base_right_pad = (1 - experience.base_action_mask.long()).sum(dim=-1)
+            base_left_pad = experience.base_attention_mask.long().argmax(dim=-1)
+            starts["base_sequence"] = base_left_pad
+            starts["base_action"] = torch.zeros_like(base_right_pad)
+            lengths["base_sequence"] = experience.base_sequences.size(1) - base_left_pad - base_right_pad
+            lengths["base_action"] = experience.base_action_mask.size(1) - base_right_pad
+
+        for group, keys in COLUMN_GROUPS.items():
+            if group not in lengths:
+                continue
+            for key in keys:
+                value = getattr(experience, key)
+                if value is None:
+                    continue
+                self._append_column(key, unpad_rows(value, starts[group], lengths[group]))
+            self.lengths[group] = (
+                lengths[group] if group not in self.lengths else torch.cat([self.lengths[group], lengths[group]])
+            )
+        for k, v in experience.info.items():
+            v = v.reshape(-1)
+            self.info[k] = v if k not in self.info else torch.cat([self.info[k], v])
+
+        if self.limit > 0:
+            samples_to_remove = len(self) - self.limit
+            if samples_to_remove > 0:
+                self._remove_oldest(samples_to_remove)
+        self._update_offsets()
+
+    def _append_column(self, key: str, value: torch.Tensor) -> None:
+        self.columns[key] = value if key not in self.columns else torch.cat([self.columns[key], value])
+
+    def _remove_oldest(self, num_samples: int) -> None:
+        for group, lengths in self.lengths.items():
+            num_elements = int(lengths[:num_samples].sum())
+            for key in COLUMN_GROUPS[group]:
+                if key in self.columns:
+                    self.columns[key] = self.columns[key][num_elements:]
+            self.lengths[group] = lengths[num_samples:]
+        for k, v in self.info.items():
+            self.info[k] = v[num_samples:]
+
+    def _update_offsets(self) -> None:
+        self.offsets = {group: lengths.cumsum(dim=0) - lengths for group, lengths in self.lengths.items()}
+
+    def clear(self) -> None:
+        self.columns = {}
+        self.lengths = {}
+        self.offsets = {}
+        self.info = {}
+
+    @torch.no_grad()
+    def sample(self) -> Experience:
+        indices = random.sample(range(len(self)), self.sample_batch_size)
+        experience = self.collate_fn(indices)
+        if self.cpu_offload:
+            experience.to_device(self.target_device)
+        return experience
+
+    def __len__(self) -> int:
+        return 0 if "sequence" not in self.lengths else self.lengths["sequence"].numel()
+
+    def __getitem__(self, idx: int) -> int:
+        return idx
+
+    def sequence_lengths(self) -> List[int]:
+        """Unpadded sequence length of each sample"""
+        return [] if "sequence" not in self.lengths else self.lengths["sequence"].tolist()
+
+    def collate_fn(self, batch) -> Experience:
+        indices = torch.as_tensor(batch, dtype=torch.long, device=self.lengths["sequence"].device)
+        kwargs = {}
+        for group, lengths in self.lengths.items():
+            batch_lengths = lengths[indices]
+            batch_offsets = self.offsets[group][indices]
+            if self.packing_samples and group in ("sequence", "base_sequence"):
+                sequences_key, attention_mask_key = COLUMN_GROUPS[group]
+                kwargs[sequences_key], kwargs[attention_mask_key] = pack_sequences(
+                    concat_rows(self.columns[sequences_key], batch_offsets, batch_lengths), batch_lengths
+                )
+                continue
+            for key in COLUMN_GROUPS[group]:
+                if key in self.columns:
+                    kwargs[key] = left_pad_rows(self.columns[key], batch_offsets, batch_lengths)
+        if self.packing_samples:
+            kwargs["packed_seq_lens"] = self.lengths["sequence"][indices].tolist()
+            kwargs["num_actions"] = self.lengths["action"][indices].tolist()
+            if "base_action" in self.lengths:
+                kwargs["base_num_actions"] = self.lengths["base_action"][indices].tolist()
+        kwargs["info"] = {k: v[indices] for k, v in self.info.items()}
+        return Experience(**kwargs)
+
+    def normalize(self, attribute: str, strategy) -> None:
+        assert attribute == "advantages"
+        items_vector = self.columns[attribute].float()
+        action_masks_vector = self.columns["action_mask"]
+
+        # for DP
+        # mean
+        sum_and_count = torch.tensor([items_vector.sum(), action_masks_vector.sum()], device=items_vector.device)
+        all_sum, all_count = strategy.all_reduce(sum_and_count, "sum")
+        mean = all_sum / all_count
+        # std
+        std = ((items_vector - mean).pow(2) * action_masks_vector).sum()
+        all_std = strategy.all_reduce(std, "sum")
+        rstd = (all_std / all_count).clamp(min=1e-8).rsqrt()
+
+        # in place, so that columns backed by files are updated there
+        self.columns[attribute].sub_(mean).mul_(rstd)
+
+
+class MemmapReplayBuffer(ColumnarReplayBuffer):
+    """ColumnarReplayBuffer whose columns live in memory-mapped files in a scratch directory instead of host RAM.
+
+    Each column is a file that grows (by doubling) as experience is appended; the column tensors are views of the
+    maps, so micro-batches are gathered by indexing the maps and only the batch itself is read into memory. Lengths,
+    offsets and info stay in memory. The files are removed by clear().
+
+    Args:
+        sample_batch_size (int): Batch size when sampling.
+        limit (int, optional): Limit of number of experience samples. A number <= 0 means unlimited. Defaults to 0.
+        cpu_offload (bool, optional): Whether to move sampled batches to the GPU in sample(). Defaults to True.
+        packing_samples (bool, optional): Whether to emit packed experiences (see Experience). Defaults to False.
+        scratch_dir (str, optional): Directory for the column files; a temporary directory if None. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        sample_batch_size: int,
+        limit: int = 0,
+        cpu_offload: bool = True,
+        packing_samples: bool = False,
+        scratch_dir: Optional[str] = None,
+    ) -> None:
+        self.scratch_dir = tempfile.mkdtemp(prefix="replay_buffer_", dir=scratch_dir)
+        self.maps = {}
+        super().__init__(sample_batch_size, limit, cpu_offload, packing_samples)
+
+    def _map_file(self, key: str, dtype: torch.dtype, numel: int) -> torch.Tensor:
+        path = os.path.join(self.scratch_dir, f"{key}.bin")
+        # extend the file before mapping it: when torch.from_file extends a file itself, it also writes a zero byte at
+        # the start of the file, which would overwrite the first element
+        num_bytes = numel * torch.empty((), dtype=dtype).element_size()
+        with open(path, "ab") as f:
+            if f.tell() < num_bytes:
+                f.truncate(num_bytes)
+        # shared maps write through to the file
+        return torch.from_file(path, shared=True, size=numel, dtype=dtype)
+
+    def _append_column(self, key: str, value: torch.Tensor) -> None:
+        value = value.cpu()
+        row_numel = math.prod(value.shape[1:])
+        if key in self.columns:
+            # rows [start, end) of the map are live, _remove_oldest moves start forward
+            column = self.columns[key]
+            start = (column.storage_offset() - self.maps[key].storage_offset()) // row_numel
+            end = start + column.size(0)
+        else:
+            start = end = 0
+        flat_map = self.maps.get(key)
+        if flat_map is None or (end + value.size(0)) * row_numel > flat_map.numel():
+            if flat_map is not None and start > 0:
+                # drop the samples removed by the limit before growing the file
+                flat_map[: (end - start) * row_numel] = flat_map[start * row_numel : end * row_numel].clone()
+                end, start = end - start, 0
+            capacity = max(2 * (end + value.size(0)) * row_numel, 1)
+            if flat_map is None or capacity > flat_map.numel():
+                flat_map = self._map_file(key, value.dtype, capacity)
+            self.maps[key] = flat_map
+        rows = flat_map.view(-1, *value.shape[1:])
+        rows[end : end + value.size(0)] = value
+        self.columns[key] = rows[start : end + value.size(0)]
+
+    def clear(self) -> None:
+        super().clear()
+        self.maps = {}
+        for name in os.listdir(self.scratch_dir):
+            os.remove(os.path.join(self.scratch_dir, name))
+
+    def __del__(self):
+        shutil.rmtree(getattr(self, "scratch_dir", ""), ignore_errors=True)
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """Batch sampler that puts samples of similar length in the same micro-batch, to reduce padding.
+
+    Each epoch, the (shuffled) samples are split into mega-batches of megabatch_mult batches, each mega-batch is sorted
+    by length and cut into batches, and the batch order is shuffled again. With group_size > 1, consecutive blocks of
+    group_size samples (the samples_per_prompt rollouts of a prompt) are kept together and in order, with the longest
+    sample of a block as its length.
+
+    Args:
+        lengths (List[int]): Length of each sample.
+        batch_size (int): Number of samples per batch, a multiple of group_size.
+        group_size (int, optional): Size of the blocks of samples kept together. Defaults to 1.
+        shuffle (bool, optional): Whether to shuffle the samples and batches. Defaults to True.
+        drop_last (bool, optional): Whether to drop the last incomplete batch. Defaults to True.
+        megabatch_mult (int, optional): Number of batches per sorted mega-batch. Defaults to 8.
+        seed (int, optional): Seed of the shuffle; the epoch is added to it. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        group_size: int = 1,
+        shuffle: bool = True,
+        drop_last: bool = True,
+        megabatch_mult: int = 8,
+        seed: int = 0,
+    ) -> None:
+        assert batch_size % group_size == 0 and len(lengths) % group_size == 0
+        self.group_size = group_size
+        self.groups_per_batch = batch_size // group_size
+        self.group_lengths = torch.tensor(lengths).view(-1, group_size).max(dim=-1).values
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.megabatch_size = megabatch_mult * self.groups_per_batch
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+
+        num_groups = self.group_lengths.numel()
+        order = torch.randperm(num_groups, generator=generator) if self.shuffle else torch.arange(num_groups)
+        batches = []
+        for start in range(0, num_groups, self.megabatch_size):
+            megabatch = order[start : start + self.megabatch_size]
+            megabatch = megabatch[self.group_lengths[megabatch].argsort(descending=True)]
+            batches.extend(megabatch.split(self.groups_per_batch))
+        if self.drop_last and batches and batches[-1].numel() < self.groups_per_batch:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        offsets = torch.arange(self.group_size)
+        for batch in batches:
+            yield (batch[:, None] * self.group_size + offsets[None, :]).flatten().tolist()
+
+    def __len__(self) -> int:
+        num_groups = self.group_lengths.numel()
+        if self.drop_last:
+            return num_groups // self.groups_per_batch
+        return (num_groups + self.groups_per_batch - 1) // self.groups_per_batch
@@ -0,0 +1,86 @@
+import math
+from typing import Callable, List
+
+import torch
+import torch.nn.functional as F
+
+from .experience_maker import Experience
+
+
+def rollout_ess(log_ratios: torch.Tensor, samples_per_prompt: int) -> float:
+    """ESS fraction of samples drawn from q_sampling as a sample from q_current.
+
+    log_ratios are the per-sample log q_current - log q_sampling, with the samples of each prompt in consecutive
+    blocks of samples_per_prompt. With several samples per prompt, the weights are self-normalized within each prompt
+    and 1 / sum(w^2) / samples_per_prompt is averaged over the prompts. With one sample per prompt there is nothing
+    to normalize over, so the exact weights w = q_current / q_sampling (E_q_sampling[w] = 1 for every prompt) give
+    1 / E[w^2], estimated by averaging w^2 over the prompts. Weights are never normalized across different prompts.
+    """
+    log_ratios = log_ratios.float()
+    if samples_per_prompt > 1:
+        weights = F.softmax(log_ratios.view(-1, samples_per_prompt), dim=-1)
+        return (1 / weights.pow(2).sum(dim=-1) / samples_per_prompt).mean().item()
+    log_mean_squared_weight = torch.logsumexp(2 * log_ratios, dim=0) - math.log(log_ratios.numel())
+    return min(1.0, torch.exp(-log_mean_squared_weight).item())
+
+
+class RolloutReusePool:
+    """Keeps recent rollouts so that their samples can be trained on again in later ppo_train calls.
+
+    The experience is stored as made, on the CPU, including the log q of the proposal that generated it
+    (action_log_probs). Every actor loss divides by that stored log q, which is what corrects old samples for the
+    proposal having moved since: PPO through its clipped ratio q_current / q_sampling, and CTL/SIXO/DPG through the
+    importance weights p phi / q_sampling (and p psi / q_sampling), which are self-normalized within each prompt's
+    samples. Those weights are valid for samples from any proposal as long as all the samples of a prompt come from the
+    same rollout, so rollouts are added whole, in blocks of samples_per_prompt. A rollout is evicted once it has been
+    trained on in max_rollouts calls, or when its effective sample size under the current proposal (rollout_ess)
+    falls below min_ess.
+
+    Args:
+        max_rollouts (int): Number of ppo_train calls each rollout is used in; 1 means no reuse.
+        samples_per_prompt (int): Number of consecutive samples per prompt in each rollout.
+        min_ess (float, optional): Minimum ESS fraction (in (0, 1]) for an old rollout to be reused. Defaults to 0.
+    """
+
+    def __init__(self, max_rollouts: int, samples_per_prompt: int, min_ess: float = 0.0) -> None:
+        assert max_rollouts >= 1
+        self.max_rollouts = max_rollouts
+        self.samples_per_prompt = samples_per_prompt
+        self.min_ess = min_ess
+        self.rollouts: List[Experience] = []
+        self.ages: List[int] = []
+
+    @torch.no_grad()
+    def add(self, experience: Experience) -> None:
+        assert experience.sequences.size(0) % self.samples_per_prompt == 0, "reused in whole prompt groups"
+        # kept for up to max_rollouts ppo_train calls, so off the GPU in the meantime
+        experience.to_device(torch.device("cpu"))
+        self.rollouts.append(experience)
+        self.ages.append(0)
+
+    def reuse(self, get_ess: Callable[[Experience], float]) -> List[float]:
+        """Evicts the old rollouts whose ESS is below min_ess; returns the ESS of every old rollout, evicted or not"""
+        kept_rollouts, kept_ages, ess_list = [], [], []
+        for experience, age in zip(self.rollouts, self.ages):
+            if age > 0:
+                ess = get_ess(experience)
+                ess_list.append(ess)
+                if ess < self.min_ess:
+                    continue
+            kept_rollouts.append(experience)
+            kept_ages.append(age)
+        self.rollouts, self.ages = kept_rollouts, kept_ages
+        return ess_list
+
+    def old_rollouts(self) -> List[Experience]:
+        return [experience for experience, age in zip(self.rollouts, self.ages) if age > 0]
+
+    def step(self) -> None:
+        """Called after each ppo_train; ages the rollouts and evicts those used max_rollouts times"""
+        self.ages = [age + 1 for age in self.ages]
+        kept = [i for i, age in enumerate(self.ages) if age < self.max_rollouts]
+        self.rollouts = [self.rollouts[i] for i in kept]
+        self.ages = [self.ages[i] for i in kept]
+
+    def __len__(self) -> int:
+        return len(self.rollouts)
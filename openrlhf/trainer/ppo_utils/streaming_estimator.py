@@ -0,0 +1,129 @@
+import math
+from typing import Dict, Tuple
+
+import torch
+
+
+class StreamingStats:
+    """Running count, mean, variance and logsumexp of a stream of values fed in chunks, so that estimates over many
+    samples never need all of them at once. Chunks are [*shape, chunk_size]; the leading dims (e.g. seeds) are
+    accumulated separately. Means and variances are merged with the parallel form of Welford's algorithm.
+
+    Args:
+        shape (Tuple[int, ...], optional): The leading dims of the chunks. Defaults to ().
+    """
+
+    def __init__(self, shape: Tuple[int, ...] = ()) -> None:
+        self.count = 0
+        self.mean = torch.zeros(shape, dtype=torch.float64)
+        self.m2 = torch.zeros(shape, dtype=torch.float64)
+        self.log_sum_exp = torch.full(shape, -math.inf, dtype=torch.float64)
+        # logsumexp of 2 * values, for the standard error of log_mean_exp
+        self.log_sum_exp_sq = torch.full(shape, -math.inf, dtype=torch.float64)
+
+    def update(self, values: torch.Tensor) -> None:
+        values = values.detach().to(device="cpu", dtype=torch.float64)
+        n = values.size(-1)
+        if n == 0:
+            return
+        chunk_mean = values.mean(dim=-1)
+        chunk_m2 = (values - chunk_mean.unsqueeze(-1)).square().sum(dim=-1)
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + chunk_m2 + delta.square() * self.count * n / total
+        self.log_sum_exp = torch.logaddexp(self.log_sum_exp, torch.logsumexp(values, dim=-1))
+        self.log_sum_exp_sq = torch.logaddexp(self.log_sum_exp_sq, torch.logsumexp(2 * values, dim=-1))
+        self.count = total
+
+    @property
+    def variance(self) -> torch.Tensor:
+        """Unbiased sample variance"""
+        return self.m2 / (self.count - 1) if self.count > 1 else torch.full_like(self.m2, math.nan)
+
+    @property
+    def std_err(self) -> torch.Tensor:
+        """Standard error of the mean"""
+        return (self.variance / self.count).sqrt()
+
+    @property
+    def log_mean_exp(self) -> torch.Tensor:
+        return self.log_sum_exp - math.log(self.count)
+
+    @property
+    def log_mean_exp_std_err(self) -> torch.Tensor:
+        """Delta method standard error of log_mean_exp, sqrt(Var(w) / (N * mean(w)^2)) with w = exp(values)"""
+        if self.count < 2:
+            return torch.full_like(self.m2, math.nan)
+        relative_variance = (self.log_sum_exp_sq - 2 * self.log_sum_exp).exp() - 1 / self.count
+        return relative_variance.clamp(min=0).sqrt()
+
+
+class StreamingIWAEEstimator:
+    """Streaming F_q, G_q and IWAE bound estimates for n_seeds independent sets of q samples and one set of true
+    posterior samples, each fed in chunks.
+
+    F_q is the mean of the log weights f_q = log tilde sigma - log q of the q samples, and the IWAE lower bound of a
+    seed is the log mean of its importance weights. The IWAE upper bound of seed i swaps one of its q samples (the
+    first one) for posterior sample i, whose log weight is its g_q. Only running accumulators are kept, so the
+    number of samples is not limited by memory.
+
+    Args:
+        n_seeds (int): Number of independent sets of q samples.
+    """
+
+    def __init__(self, n_seeds: int) -> None:
+        self.n_seeds = n_seeds
+        self.f_q = StreamingStats((n_seeds,))
+        self.g_q = StreamingStats()
+        # logsumexp of the log weights of each seed except its first sample, which the upper bound swaps out
+        self.f_q_rest_log_sum_exp = torch.full((n_seeds,), -math.inf, dtype=torch.float64)
+        self.posterior_log_weights = torch.empty((0,), dtype=torch.float64)
+
+    def update_f_q(self, f_qs: torch.Tensor) -> None:
+        """f_qs: [n_seeds, chunk_size]"""
+        f_qs = f_qs.detach().to(device="cpu", dtype=torch.float64)
+        rest = f_qs[:, 1:] if self.f_q.count == 0 else f_qs
+        if rest.size(-1) > 0:
+            self.f_q_rest_log_sum_exp = torch.logaddexp(self.f_q_rest_log_sum_exp, torch.logsumexp(rest, dim=-1))
+        self.f_q.update(f_qs)
+
+    def update_g_q(self, g_qs: torch.Tensor) -> None:
+        """g_qs: [chunk_size], the log weights of the next posterior samples"""
+        g_qs = g_qs.detach().to(device="cpu", dtype=torch.float64)
+        missing = self.n_seeds - self.posterior_log_weights.numel()
+        if missing > 0:
+            self.posterior_log_weights = torch.cat((self.posterior_log_weights, g_qs[:missing]))
+        self.g_q.update(g_qs)
+
+    def converged(self, tolerance: float) -> bool:
+        """Whether the standard errors of F_q and of the IWAE lower bound are within tolerance for every seed"""
+        if self.f_q.count < 2:
+            return False
+        std_err = torch.maximum(self.f_q.std_err, self.f_q.log_mean_exp_std_err)
+        return bool((std_err <= tolerance).all())
+
+    @property
+    def iwae_lower_bound(self) -> torch.Tensor:
+        return self.f_q.log_mean_exp
+
+    @property
+    def iwae_upper_bound(self) -> torch.Tensor:
+        assert (
+            self.posterior_log_weights.numel() == self.n_seeds
+        ), "the upper bound needs one posterior sample per seed"
+        log_sum_exp = torch.logaddexp(self.f_q_rest_log_sum_exp, self.posterior_log_weights)
+        return log_sum_exp - math.log(self.f_q.count)
+
+    def summary(self) -> Dict[str, torch.Tensor]:
+        summary = {
+            "f_q": self.f_q.mean,
+            "f_q_std_err": self.f_q.std_err,
+            "iwae_lb": self.iwae_lower_bound,
+            "iwae_lb_std_err": self.f_q.log_mean_exp_std_err,
+        }
+        if self.g_q.count > 0:
+            summary["g_q"] = self.g_q.mean
+            summary["g_q_std_err"] = self.g_q.std_err
+            summary["iwae_ub"] = self.iwae_upper_bound
+        return {k: v.float() for k, v in summary.items()}
@@ -0,0 +1,105 @@
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+INDEX_FILE = "index.jsonl"
+
+
+def _to_numpy(value) -> np.ndarray:
+    if hasattr(value, "detach"):
+        value = value.detach().cpu()
+        # numpy has no bfloat16; wider floats keep their precision
+        value = (value.float() if value.is_floating_point() and value.element_size() < 4 else value).numpy()
+    return np.asarray(value)
+
+
+def _drop_truncated_index_line(path: str) -> None:
+    # a line left unfinished by a crash would otherwise be merged with the next appended one
+    index_path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return
+    with open(index_path, "rb+") as f:
+        index = f.read()
+        if index and not index.endswith(b"\n"):
+            f.truncate(index.rfind(b"\n") + 1)
+
+
+class EstimatorStore:
+    """Append-only on-disk log of evaluation estimates (e.g. the per-sample F_q estimates and the IWAE bounds of each
+    evaluation during training). Every append writes one .npy file per metric and then one line to index.jsonl, so
+    the results are on disk as soon as each evaluation finishes and a crash loses at most the evaluation in progress.
+    Read the store with EstimatorStoreReader.
+
+    Args:
+        path (str): Directory of the store.
+        append (bool, optional): Continue an existing store instead of starting a new one. Defaults to False.
+    """
+
+    def __init__(self, path: str, append: bool = False) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if not append:
+            for file_name in os.listdir(path):
+                if file_name == INDEX_FILE or file_name.endswith(".npy"):
+                    os.remove(os.path.join(path, file_name))
+        self.num_records = 0
+        if append:
+            self.num_records = len(EstimatorStoreReader(path))
+            _drop_truncated_index_line(path)
+
+    def append(self, **metrics) -> None:
+        record = {"step": self.num_records, "metrics": {}}
+        for name, value in metrics.items():
+            array = _to_numpy(value)
+            file_name = f"{name}_{self.num_records:06d}.npy"
+            tmp_path = os.path.join(self.path, f"{file_name}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, os.path.join(self.path, file_name))
+            record["metrics"][name] = {"file": file_name, "shape": list(array.shape)}
+        # the index line is written last, so that readers only see complete records
+        with open(os.path.join(self.path, INDEX_FILE), "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_records += 1
+
+
+class EstimatorStoreReader:
+    """Lazy reader of an EstimatorStore. Only the index is read up front; the arrays are memory-mapped on access.
+
+    Args:
+        path (str): Directory of the store.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.records: List[Dict] = []
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    # a truncated last line means the run stopped while writing it
+                    if not line.endswith("\n"):
+                        break
+                    self.records.append(json.loads(line))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def metrics(self) -> List[str]:
+        names = []
+        for record in self.records:
+            names.extend(name for name in record["metrics"] if name not in names)
+        return names
+
+    def load(self, metric: str, step: int) -> np.ndarray:
+        file_name = self.records[step]["metrics"][metric]["file"]
+        return np.load(os.path.join(self.path, file_name), mmap_mode="r")
+
+    def load_all(self, metric: str) -> List[np.ndarray]:
+        """The metric of every record that has it, in order"""
+        return [self.load(metric, step) for step, record in enumerate(self.records) if metric in record["metrics"]]
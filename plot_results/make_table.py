@@ -1,9 +1,18 @@
+import os
+import sys
+
 import torch
 import numpy as np
 import matplotlib
 matplotlib.use('PDF')
 import matplotlib.pyplot as plt
 
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+from openrlhf.utils.estimator_store import EstimatorStoreReader
+
 
 load_dir = "../info"
 
@@ -19,10 +28,16 @@ def populate_lists(load_prefixes):
 
         for j in range(len(load_prefixes[i])):
             prefix = load_prefixes[i][j]
-            loaded_data = torch.load(f"{load_dir}/{prefix}")
-
-            for metric in metrics:
-                data_dict[metric][i].append(loaded_data[metrics.index(metric)])
+            if os.path.isdir(f"{load_dir}/{prefix}"):
+                # estimator store written during training; the arrays are memory-mapped
+                estimates = EstimatorStoreReader(f"{load_dir}/{prefix}")
+                for metric in metrics:
+                    data_dict[metric][i].append(estimates.load_all(metric))
+            else:
+                loaded_data = torch.load(f"{load_dir}/{prefix}")
+
+                for metric in metrics:
+                    data_dict[metric][i].append(loaded_data[metrics.index(metric)])
 
     return data_dict
 
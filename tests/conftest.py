@@ -0,0 +1,62 @@
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from openrlhf.models import Actor, get_llm_for_sequence_regression
+from openrlhf.models.actor_custom import ActorCustom
+
+VOCAB_SIZE = 64
+PAD_TOKEN_ID = 0
+EOS_TOKEN_ID = 1
+
+
+def save_tiny_gpt2(path, seed: int) -> str:
+    """Saves a tiny randomly initialized GPT-2 to path, so the models can be loaded the way the trainers load them"""
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=64, n_embd=32, n_layer=2, n_head=2)
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def base_model_path(tmp_path_factory):
+    return save_tiny_gpt2(tmp_path_factory.mktemp("base_model"), seed=0)
+
+
+@pytest.fixture(scope="session")
+def modulation_model_path(tmp_path_factory):
+    return save_tiny_gpt2(tmp_path_factory.mktemp("modulation_model"), seed=1)
+
+
+@pytest.fixture
+def base_actor(base_model_path):
+    return Actor(base_model_path, bf16=False).eval()
+
+
+@pytest.fixture(params=["modulation_model", "modulation_linear_head"])
+def actor_custom(request, base_actor, modulation_model_path):
+    torch.manual_seed(2)
+    return ActorCustom(
+        modulation_model_path, initial_model=base_actor, bf16=False, parameterization=request.param
+    ).eval()
+
+
+@pytest.fixture
+def critic(base_model_path):
+    torch.manual_seed(3)
+    return get_llm_for_sequence_regression(base_model_path, "critic", bf16=False, init_value_head=True).eval()
+
+
+def left_padded_prompts(prompt_lens, samples_per_prompt: int = 1, seed: int = 0):
+    """Random left padded prompts, each repeated samples_per_prompt times in a row like tile_prompts does"""
+    generator = torch.Generator().manual_seed(seed)
+    max_len = max(prompt_lens)
+    input_ids = torch.full((len(prompt_lens), max_len), PAD_TOKEN_ID, dtype=torch.long)
+    attention_mask = torch.zeros((len(prompt_lens), max_len), dtype=torch.long)
+    for i, prompt_len in enumerate(prompt_lens):
+        input_ids[i, max_len - prompt_len :] = torch.randint(2, VOCAB_SIZE, (prompt_len,), generator=generator)
+        attention_mask[i, max_len - prompt_len :] = 1
+    return (
+        input_ids.repeat_interleave(samples_per_prompt, dim=0),
+        attention_mask.repeat_interleave(samples_per_prompt, dim=0),
+    )
@@ -0,0 +1,62 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from openrlhf.models.utils import chunked_log_probs_from_logits, log_probs_from_logits_with_modulation
+
+VOCAB_SIZE = 50
+
+
+def reference_log_probs(logits, labels, modulation=None):
+    # the log_softmax().gather() path, in fp32 so that the bf16 cases have an exact reference
+    z = logits.float() if modulation is None else logits.float() + modulation.float()
+    return F.log_softmax(z, dim=-1).gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+
+
+def random_inputs(length, dtype, with_modulation, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = (torch.randn(3, length, VOCAB_SIZE, generator=generator) * 4).to(dtype).requires_grad_()
+    modulation = None
+    if with_modulation:
+        modulation = torch.randn(3, length, VOCAB_SIZE, generator=generator).to(dtype).requires_grad_()
+    labels = torch.randint(VOCAB_SIZE, (3, length), generator=generator)
+    grad_output = torch.randn(3, length, generator=generator)
+    return logits, modulation, labels, grad_output
+
+
+def grads(output, grad_output, inputs):
+    return torch.autograd.grad(output.float(), [x for x in inputs if x is not None], grad_output)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("length,chunk_size", [(1, 4), (10, 4), (12, 4), (7, 64)])
+@pytest.mark.parametrize("with_modulation", [False, True])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_chunked_log_probs_match_log_softmax(length, chunk_size, with_modulation, dtype):
+    logits, modulation, labels, grad_output = random_inputs(length, dtype, with_modulation)
+    tolerance = {} if dtype == torch.float32 else {"atol": 2e-2, "rtol": 2e-2}
+
+    log_probs = chunked_log_probs_from_logits(logits, labels, chunk_size=chunk_size, modulation=modulation)
+    expected = reference_log_probs(logits, labels, modulation)
+
+    assert log_probs.dtype == dtype
+    torch.testing.assert_close(log_probs.float(), expected, **tolerance)
+    for grad, expected_grad in zip(
+        grads(log_probs, grad_output, (logits, modulation)), grads(expected, grad_output, (logits, modulation))
+    ):
+        assert grad.dtype == dtype
+        torch.testing.assert_close(grad.float(), expected_grad.float(), **tolerance)
+
+
+@pytest.mark.unit
+def test_modulation_log_probs_match_double_log_softmax():
+    logits, modulation, labels, grad_output = random_inputs(9, torch.float32, with_modulation=True)
+    # only the modulation is trained, as for the modulation heads over a frozen base model
+    logits = logits.detach()
+
+    log_probs = log_probs_from_logits_with_modulation(logits, modulation, labels)
+    expected = F.log_softmax(F.log_softmax(logits, dim=-1) + modulation, dim=-1)
+    expected = expected.gather(dim=-1, index=labels.unsqueeze(-1)).squeeze(-1)
+
+    torch.testing.assert_close(log_probs, expected)
+    torch.testing.assert_close(grads(log_probs, grad_output, [modulation]), grads(expected, grad_output, [modulation]))
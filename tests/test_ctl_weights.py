@@ -0,0 +1,75 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from openrlhf.models.loss import get_positive_and_negative_weights_detached_incremental
+
+
+def loop_positive_and_negative_weights(base_action_log_probs, curr_log_probs, final_reward, log_psi):
+    # the per-time-step loop get_positive_and_negative_weights_detached_incremental replaced, indexing the last dim
+    # so that it also covers (prompts, batch, seq_len)
+    log_p_1_to_t_psi_1_to_t = base_action_log_probs.cumsum(dim=-1) + log_psi
+    log_w_t = 0
+    negative_weights = []
+    for i in range(base_action_log_probs.shape[-1]):
+        if i == 0:
+            incremental_w_t = log_p_1_to_t_psi_1_to_t[..., 0] - curr_log_probs[..., 0]
+            log_w_t += incremental_w_t
+        elif i == base_action_log_probs.shape[-1] - 1:
+            incremental_w_t = (
+                base_action_log_probs.cumsum(dim=-1)[..., -1]
+                + final_reward
+                - curr_log_probs[..., i]
+                - log_p_1_to_t_psi_1_to_t[..., i - 1]
+            )
+            positive_total_weight = incremental_w_t + log_w_t
+            log_w_t += log_p_1_to_t_psi_1_to_t[..., i] - curr_log_probs[..., i] - log_p_1_to_t_psi_1_to_t[..., i - 1]
+        else:
+            incremental_w_t = (
+                log_p_1_to_t_psi_1_to_t[..., i] - curr_log_probs[..., i] - log_p_1_to_t_psi_1_to_t[..., i - 1]
+            )
+            log_w_t += incremental_w_t
+        negative_weights.append(log_w_t.clone())
+    return torch.stack(negative_weights, dim=-1), F.softmax(positive_total_weight, dim=-1)
+
+
+def random_inputs(shape, seed, dtype=torch.float64):
+    """Log probs zeroed past each response's EOS, as CTLLoss gets them after masking"""
+    generator = torch.Generator().manual_seed(seed)
+    length = shape[-1]
+    response_lens = torch.randint(1, length + 1, shape[:-1], generator=generator)
+    # one response that stops at its first token and one that uses the full length
+    response_lens.view(-1)[0] = 1
+    response_lens.view(-1)[-1] = length
+    action_mask = torch.arange(length) < response_lens[..., None]
+    base_action_log_probs = -torch.rand(shape, generator=generator, dtype=dtype) * 3 * action_mask
+    curr_log_probs = -torch.rand(shape, generator=generator, dtype=dtype) * 3 * action_mask
+    log_psi = torch.randn(shape, generator=generator, dtype=dtype)
+    final_reward = torch.randn(shape[:-1], generator=generator, dtype=dtype)
+    return base_action_log_probs, curr_log_probs, final_reward, log_psi
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("shape", [(6, 2), (6, 9), (4, 5, 9), (1, 3, 17)])
+def test_vectorized_ctl_weights_match_loop(shape):
+    inputs = random_inputs(shape, seed=len(shape) + shape[-1])
+
+    expected_negative, expected_positive = loop_positive_and_negative_weights(*inputs)
+    negative, positive = get_positive_and_negative_weights_detached_incremental(*inputs)
+
+    torch.testing.assert_close(negative, expected_negative)
+    torch.testing.assert_close(positive, expected_positive)
+    # the positive weights are normalized within each prompt's batch
+    torch.testing.assert_close(positive.sum(-1), torch.ones(shape[:-2], dtype=positive.dtype))
+
+
+@pytest.mark.unit
+def test_ctl_weights_are_detached():
+    base_action_log_probs, curr_log_probs, final_reward, log_psi = random_inputs((4, 6), seed=0)
+    curr_log_probs.requires_grad_()
+    log_psi.requires_grad_()
+
+    negative, positive = get_positive_and_negative_weights_detached_incremental(
+        base_action_log_probs, curr_log_probs, final_reward, log_psi
+    )
+    assert not negative.requires_grad and not positive.requires_grad
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from conftest import EOS_TOKEN_ID, PAD_TOKEN_ID, left_padded_prompts
+
+
+def generate(actor_custom, input_ids, attention_mask, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    return actor_custom.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=12,
+        eos_token_id=EOS_TOKEN_ID,
+        pad_token_id=PAD_TOKEN_ID,
+        return_log_probs=True,
+        **kwargs,
+    )
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", [0, 1])
+def test_kv_cache_matches_full_recompute(actor_custom, seed):
+    input_ids, attention_mask = left_padded_prompts([3, 6, 1, 5], samples_per_prompt=2, seed=seed)
+
+    expected = generate(actor_custom, input_ids, attention_mask, seed=seed, use_kv_cache=False)
+    cached = generate(actor_custom, input_ids, attention_mask, seed=seed, use_kv_cache=True)
+
+    expected_sequences, expected_attention_mask, expected_action_mask, expected_log_probs, expected_entropy = expected
+    sequences, attention_mask, action_mask, log_probs, entropy = cached
+    assert torch.equal(sequences, expected_sequences)
+    assert torch.equal(attention_mask, expected_attention_mask)
+    assert torch.equal(action_mask, expected_action_mask)
+    torch.testing.assert_close(log_probs, expected_log_probs)
+    torch.testing.assert_close(entropy, expected_entropy)
+
+
+@pytest.mark.unit
+def test_kv_cache_log_probs_match_forward(actor_custom):
+    input_ids, attention_mask = left_padded_prompts([4, 2, 5])
+
+    sequences, attention_mask, action_mask, log_probs, _ = generate(
+        actor_custom, input_ids, attention_mask, use_kv_cache=True
+    )
+
+    with torch.no_grad():
+        forward_log_probs = actor_custom(sequences, action_mask.size(1), attention_mask)
+    torch.testing.assert_close(log_probs * action_mask, forward_log_probs * action_mask)
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from conftest import EOS_TOKEN_ID, PAD_TOKEN_ID, left_padded_prompts
+from openrlhf.models.loss import DPGLoss, get_dpg_terms_chunked
+from openrlhf.trainer.ppo_trainer import PPOTrainer
+from openrlhf.trainer.ppo_utils import Experience
+
+NUM_PROMPTS, SAMPLES_PER_PROMPT = 2, 3
+
+
+def trainer_for(actor_custom, base_actor):
+    """Just the state get_dpg_terms_streaming and get_base_log_probs_and_log_psi use"""
+    trainer = PPOTrainer.__new__(PPOTrainer)
+    trainer.experience_maker = SimpleNamespace(actor=actor_custom, initial_model=base_actor)
+    trainer.parameterization = actor_custom.parameterization
+    return trainer
+
+
+def rollout_experience(actor_custom, with_base_hidden_states):
+    input_ids, attention_mask = left_padded_prompts([4, 2], samples_per_prompt=SAMPLES_PER_PROMPT)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        # longer than get_dpg_terms_chunked's default chunk size, so that the last chunk is a partial one
+        sequences, attention_mask, action_mask, action_log_probs, _ = actor_custom.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=20,
+            eos_token_id=EOS_TOKEN_ID,
+            pad_token_id=PAD_TOKEN_ID,
+            return_log_probs=True,
+        )
+        base_hidden_states = None
+        if with_base_hidden_states:
+            base_hidden_states = actor_custom.initial_model.action_hidden_states(
+                sequences, action_mask.size(1), attention_mask
+            )
+    reward = torch.randn(sequences.size(0), generator=torch.Generator().manual_seed(0))
+    return Experience(
+        sequences=sequences,
+        action_log_probs=action_log_probs,
+        values=None,
+        returns=None,
+        advantages=None,
+        attention_mask=attention_mask,
+        action_mask=action_mask,
+        info={"reward": reward},
+        base_action_hidden_states=base_hidden_states,
+    )
+
+
+def dpg_loss(experience, base_action_log_probs, log_psi, **all_vocab_or_expected_log_psi):
+    # grouped by prompt as in the trainer's dpg branch
+    def per_prompt(x):
+        return x.view(NUM_PROMPTS, SAMPLES_PER_PROMPT, *x.shape[1:])
+
+    return DPGLoss()(
+        per_prompt(log_psi),
+        per_prompt(experience.info["reward"]),
+        per_prompt(experience.action_mask),
+        per_prompt(experience.action_log_probs),
+        per_prompt(base_action_log_probs),
+        **{key: per_prompt(value) for key, value in all_vocab_or_expected_log_psi.items()},
+    )
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("with_base_hidden_states", [False, True])
+def test_streaming_dpg_loss_matches_all_vocab(actor_custom, base_actor, with_base_hidden_states):
+    trainer = trainer_for(actor_custom, base_actor)
+    experience = rollout_experience(actor_custom, with_base_hidden_states)
+    num_actions = experience.action_mask.size(1)
+    # the base model is frozen in training, so only the modulation parameters get gradients
+    base_parameters = set(base_actor.parameters())
+    parameters = [p for p in actor_custom.parameters() if p not in base_parameters]
+
+    (base_all_vocab, base_action_log_probs), (log_psi_all_vocab, log_psi) = trainer.get_base_log_probs_and_log_psi(
+        experience, num_actions, return_type="both"
+    )
+    expected_loss = dpg_loss(
+        experience,
+        base_action_log_probs,
+        log_psi,
+        log_psi_all_vocab=log_psi_all_vocab,
+        base_action_log_probs_all_vocab=base_all_vocab,
+    )
+    expected_grads = torch.autograd.grad(expected_loss, parameters)
+
+    expected_log_psi, log_psi, base_action_log_probs = trainer.get_dpg_terms_streaming(experience, num_actions)
+    loss = dpg_loss(experience, base_action_log_probs, log_psi, expected_log_psi=expected_log_psi)
+    grads = torch.autograd.grad(loss, parameters)
+
+    torch.testing.assert_close(loss, expected_loss)
+    for grad, expected_grad in zip(grads, expected_grads):
+        torch.testing.assert_close(grad, expected_grad)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("length,chunk_size", [(10, 3), (10, 10), (4, 16)])
+def test_dpg_terms_chunked_match_unchunked(length, chunk_size):
+    generator = torch.Generator().manual_seed(0)
+    base_head, psi_head = torch.nn.Linear(8, 11), torch.nn.Linear(8, 11)
+    hidden_states = torch.randn(3, length, 8, generator=generator, requires_grad=True)
+    labels = torch.randint(11, (3, length), generator=generator)
+
+    def log_p_and_log_psi(hidden):
+        return torch.log_softmax(base_head(hidden), dim=-1), psi_head(hidden)
+
+    def terms_and_grads(chunk_size):
+        terms = get_dpg_terms_chunked(log_p_and_log_psi, labels, hidden_states, chunk_size=chunk_size)
+        # any combination of the terms, with a gradient through both expected_log_psi and log_psi
+        objective = (terms[0] * torch.arange(length) - terms[1] ** 2).sum()
+        return terms, torch.autograd.grad(objective, [hidden_states, *psi_head.parameters()])
+
+    (terms, grads), (expected_terms, expected_grads) = terms_and_grads(chunk_size), terms_and_grads(length)
+    torch.testing.assert_close(terms, expected_terms)
+    assert not terms[2].requires_grad
+    torch.testing.assert_close(grads, expected_grads)
@@ -0,0 +1,95 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from openrlhf.utils.estimator_store import INDEX_FILE, EstimatorStore, EstimatorStoreReader
+
+
+def evaluation(step):
+    generator = torch.Generator().manual_seed(step)
+    return {
+        "f_q_estimates": torch.randn(12, generator=generator),
+        "iwae_lbs": torch.randn(3, generator=generator, dtype=torch.float64),
+        "samples_used": torch.tensor(4 + step),
+    }
+
+
+def assert_records_equal(reader, evaluations):
+    assert len(reader) == len(evaluations)
+    for step, metrics in enumerate(evaluations):
+        assert reader.records[step]["step"] == step
+        for name, value in metrics.items():
+            loaded = reader.load(name, step)
+            assert loaded.shape == tuple(value.shape)
+            np.testing.assert_array_equal(loaded, value.numpy())
+
+
+@pytest.mark.unit
+def test_round_trip(tmp_path):
+    store = EstimatorStore(str(tmp_path))
+    evaluations = [evaluation(step) for step in range(3)]
+    for metrics in evaluations:
+        store.append(**metrics)
+    # a metric only some evaluations have
+    store.append(g_q_estimates=torch.ones(5, dtype=torch.bfloat16))
+
+    reader = EstimatorStoreReader(str(tmp_path))
+    assert_records_equal(reader, evaluations + [{"g_q_estimates": torch.ones(5)}])
+    assert reader.metrics == ["f_q_estimates", "iwae_lbs", "samples_used", "g_q_estimates"]
+    assert reader.load("iwae_lbs", 1).dtype == np.float64
+    assert reader.load("g_q_estimates", 3).dtype == np.float32
+    assert [int(value) for value in reader.load_all("samples_used")] == [4, 5, 6]
+    assert len(reader.load_all("g_q_estimates")) == 1
+    assert not any(file_name.endswith(".tmp") for file_name in os.listdir(tmp_path))
+
+
+@pytest.mark.unit
+def test_reopening_appends_or_starts_over(tmp_path):
+    evaluations = [evaluation(step) for step in range(4)]
+    store = EstimatorStore(str(tmp_path))
+    for metrics in evaluations[:2]:
+        store.append(**metrics)
+
+    # a resumed run continues the numbering of the existing records
+    store = EstimatorStore(str(tmp_path), append=True)
+    assert store.num_records == 2
+    for metrics in evaluations[2:]:
+        store.append(**metrics)
+    assert_records_equal(EstimatorStoreReader(str(tmp_path)), evaluations)
+
+    # a new run removes the old records but not other files in the directory
+    (tmp_path / "notes.txt").write_text("kept")
+    store = EstimatorStore(str(tmp_path))
+    assert store.num_records == 0 and len(EstimatorStoreReader(str(tmp_path))) == 0
+    assert sorted(os.listdir(tmp_path)) == ["notes.txt"]
+    store.append(**evaluations[0])
+    assert_records_equal(EstimatorStoreReader(str(tmp_path)), evaluations[:1])
+
+
+@pytest.mark.unit
+def test_truncated_index_line_is_ignored(tmp_path):
+    evaluations = [evaluation(step) for step in range(3)]
+    store = EstimatorStore(str(tmp_path))
+    for metrics in evaluations:
+        store.append(**metrics)
+    # the run stopped part of the way through writing the last index line
+    index_path = tmp_path / INDEX_FILE
+    index = index_path.read_text()
+    index_path.write_text(index[: index.rindex("{") + 20])
+
+    assert_records_equal(EstimatorStoreReader(str(tmp_path)), evaluations[:2])
+
+    # resuming rewrites the lost record after the last complete line
+    store = EstimatorStore(str(tmp_path), append=True)
+    assert store.num_records == 2
+    store.append(**evaluations[2])
+    assert_records_equal(EstimatorStoreReader(str(tmp_path)), evaluations)
+
+
+@pytest.mark.unit
+def test_empty_or_missing_store(tmp_path):
+    assert len(EstimatorStoreReader(str(tmp_path / "missing"))) == 0
+    reader = EstimatorStoreReader(str(EstimatorStore(str(tmp_path)).path))
+    assert len(reader) == 0 and reader.metrics == []
@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from openrlhf.models.utils import discounted_reverse_cumsum
+from openrlhf.trainer.ppo_utils.experience_maker import NaiveExperienceMaker
+
+
+def loop_advantages_and_returns(values, rewards, action_mask, gamma, lambd):
+    # the loop get_advantages_and_returns replaced
+    values = action_mask * values
+    rewards = action_mask * rewards
+    response_length = rewards.size(1)
+    lastgaelam = 0
+    advantages_reversed = []
+    for t in reversed(range(response_length)):
+        nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
+        delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        lastgaelam = delta + gamma * lambd * lastgaelam
+        advantages_reversed.append(lastgaelam)
+    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    return advantages, advantages + values
+
+
+def random_batch(batch_size, length, seed, dtype):
+    generator = torch.Generator().manual_seed(seed)
+    values = torch.randn(batch_size, length, generator=generator, dtype=dtype)
+    rewards = torch.randn(batch_size, length, generator=generator, dtype=dtype)
+    # masked tails of random lengths, as for responses that ended before the longest one
+    response_lens = torch.randint(1, length + 1, (batch_size,), generator=generator)
+    action_mask = torch.arange(length)[None, :] < response_lens[:, None]
+    return values, rewards, action_mask
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("length", [1, 7, 128, 129, 300])
+@pytest.mark.parametrize("gamma,lambd", [(1.0, 1.0), (1.0, 0.95), (0.99, 0.95), (0.9, 0.0)])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64])
+def test_vectorized_gae_matches_loop(length, gamma, lambd, dtype):
+    values, rewards, action_mask = random_batch(batch_size=5, length=length, seed=length, dtype=dtype)
+
+    expected_advantages, expected_returns = loop_advantages_and_returns(values, rewards, action_mask, gamma, lambd)
+    advantages, returns = NaiveExperienceMaker.get_advantages_and_returns(
+        None, values, rewards, action_mask, gamma, lambd
+    )
+
+    torch.testing.assert_close(advantages, expected_advantages)
+    torch.testing.assert_close(returns, expected_returns)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("length,chunk_size", [(10, 3), (10, 10), (10, 64), (257, 16)])
+@pytest.mark.parametrize("discount", [1.0, 0.95, 0.0])
+def test_discounted_reverse_cumsum_chunks(length, chunk_size, discount):
+    x = torch.randn(3, 2, length, dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+
+    expected = torch.empty_like(x)
+    carry = torch.zeros_like(x[..., 0])
+    for t in reversed(range(length)):
+        carry = x[..., t] + discount * carry
+        expected[..., t] = carry
+
+    torch.testing.assert_close(discounted_reverse_cumsum(x, discount, chunk_size=chunk_size), expected)
@@ -0,0 +1,80 @@
+import pytest
+import torch
+
+from conftest import EOS_TOKEN_ID, PAD_TOKEN_ID, left_padded_prompts
+from openrlhf.trainer.ppo_utils.experience_maker import NaiveExperienceMaker
+
+
+def generate(actor, input_ids, attention_mask, **kwargs):
+    torch.manual_seed(0)
+    return actor.generate(
+        input_ids,
+        attention_mask=attention_mask,
+        max_new_tokens=12,
+        eos_token_id=EOS_TOKEN_ID,
+        pad_token_id=PAD_TOKEN_ID,
+        return_log_probs=True,
+        **kwargs,
+    )
+
+
+def assert_match_forward(actor, sequences, attention_mask, action_mask, log_probs):
+    with torch.no_grad():
+        forward_log_probs = actor(sequences, action_mask.size(1), attention_mask)
+    torch.testing.assert_close(log_probs, forward_log_probs * action_mask)
+
+
+@pytest.mark.unit
+def test_actor_generation_log_probs_match_forward(base_actor):
+    input_ids, attention_mask = left_padded_prompts([4, 2, 5, 3])
+
+    sequences, attention_mask, action_mask, log_probs, _ = generate(base_actor, input_ids, attention_mask)
+
+    assert_match_forward(base_actor, sequences, attention_mask, action_mask, log_probs)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("use_kv_cache", [False, True])
+def test_actor_custom_generation_log_probs_match_forward(actor_custom, use_kv_cache):
+    input_ids, attention_mask = left_padded_prompts([4, 2, 5, 3])
+
+    sequences, attention_mask, action_mask, log_probs, _ = generate(
+        actor_custom, input_ids, attention_mask, use_kv_cache=use_kv_cache
+    )
+
+    assert_match_forward(actor_custom, sequences, attention_mask, action_mask, log_probs)
+
+
+@pytest.mark.unit
+def test_generation_log_probs_skip_log_q(actor_custom, base_actor, monkeypatch):
+    if not actor_custom.use_modulation_head:
+        pytest.skip("forward_with_base is only defined for the modulation head parameterizations")
+    input_ids, attention_mask = left_padded_prompts([4, 2, 5])
+    sequences, attention_mask, action_mask, log_probs, _ = generate(actor_custom, input_ids, attention_mask)
+
+    experience_maker = NaiveExperienceMaker.__new__(NaiveExperienceMaker)
+    experience_maker.actor = actor_custom
+    experience_maker.initial_model = base_actor
+    experience_maker.share_prompt_prefix = False
+    return_log_q = []
+    forward_with_base = actor_custom.forward_with_base
+
+    def recording_forward_with_base(*args, **kwargs):
+        return_log_q.append(kwargs.get("return_log_q", True))
+        return forward_with_base(*args, **kwargs)
+
+    monkeypatch.setattr(actor_custom, "forward_with_base", recording_forward_with_base)
+    reused_log_probs, base_log_probs = experience_maker.get_action_and_base_log_probs(
+        sequences, action_mask.size(1), attention_mask, log_probs
+    )
+    recomputed_log_probs, recomputed_base_log_probs = experience_maker.get_action_and_base_log_probs(
+        sequences, action_mask.size(1), attention_mask
+    )
+
+    assert return_log_q == [False, True]
+    assert reused_log_probs is log_probs
+    torch.testing.assert_close(reused_log_probs, recomputed_log_probs * action_mask)
+    torch.testing.assert_close(base_log_probs, recomputed_base_log_probs)
+    with torch.no_grad():
+        expected_base_log_probs = base_actor(sequences, action_mask.size(1), attention_mask)
+    torch.testing.assert_close(base_log_probs * action_mask, expected_base_log_probs * action_mask)
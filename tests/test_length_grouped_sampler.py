@@ -0,0 +1,83 @@
+import pytest
+import torch
+
+from openrlhf.trainer.ppo_utils import LengthGroupedBatchSampler
+
+
+def random_lengths(num_samples, seed=0):
+    return torch.randint(1, 500, (num_samples,), generator=torch.Generator().manual_seed(seed)).tolist()
+
+
+def padded_tokens(batches, lengths):
+    return sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("num_samples,batch_size,group_size", [(96, 8, 1), (96, 8, 4), (100, 12, 2), (6, 4, 2)])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_every_index_once_per_epoch(num_samples, batch_size, group_size, shuffle):
+    sampler = LengthGroupedBatchSampler(
+        random_lengths(num_samples), batch_size, group_size=group_size, shuffle=shuffle, drop_last=False
+    )
+
+    for _ in range(3):
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        assert sorted(i for batch in batches for i in batch) == list(range(num_samples))
+        assert sum(len(batch) < batch_size for batch in batches) <= 1
+
+
+@pytest.mark.unit
+def test_drop_last_drops_only_the_incomplete_batch():
+    sampler = LengthGroupedBatchSampler(random_lengths(100), batch_size=12, group_size=2, drop_last=True)
+
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 100 // 12
+    assert all(len(batch) == 12 for batch in batches)
+    indices = [i for batch in batches for i in batch]
+    assert len(set(indices)) == len(indices) == 12 * (100 // 12)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_groups_stay_together_and_in_order(shuffle):
+    group_size = 4
+    sampler = LengthGroupedBatchSampler(random_lengths(64), batch_size=8, group_size=group_size, shuffle=shuffle)
+
+    for batch in sampler:
+        for start in range(0, len(batch), group_size):
+            block = batch[start : start + group_size]
+            assert block[0] % group_size == 0
+            assert block == list(range(block[0], block[0] + group_size))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("group_size", [1, 4])
+def test_batches_are_grouped_by_length(group_size):
+    lengths = random_lengths(256)
+    # a single mega-batch: the batches are consecutive runs of the samples sorted by (block) length
+    sampler = LengthGroupedBatchSampler(lengths, batch_size=8, group_size=group_size, megabatch_mult=32)
+    block_lengths = [max(lengths[i : i + group_size]) for i in range(0, len(lengths), group_size)]
+
+    batch_lengths = sorted(([block_lengths[i // group_size] for i in batch] for batch in sampler), key=max)
+    for shorter, longer in zip(batch_lengths, batch_lengths[1:]):
+        assert max(shorter) <= min(longer)
+
+
+@pytest.mark.unit
+def test_grouping_reduces_padding():
+    lengths = random_lengths(512)
+    sampler = LengthGroupedBatchSampler(lengths, batch_size=8)
+
+    random_batches = torch.randperm(512, generator=torch.Generator().manual_seed(0)).view(-1, 8).tolist()
+    assert padded_tokens(list(sampler), lengths) < 0.8 * padded_tokens(random_batches, lengths)
+
+
+@pytest.mark.unit
+def test_epochs_are_reshuffled_and_reproducible():
+    lengths = random_lengths(64)
+    sampler = LengthGroupedBatchSampler(lengths, batch_size=8, seed=3)
+
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    assert list(LengthGroupedBatchSampler(lengths, batch_size=8, seed=3)) == first
@@ -0,0 +1,112 @@
+import pytest
+import torch
+
+from openrlhf.models.utils import (
+    gather_action_labels,
+    gather_action_outputs,
+    get_packed_seq_lens,
+    packed_action_index,
+    reset_position_ids,
+)
+from openrlhf.trainer.ppo_utils.replay_buffer import pack_sequences
+
+VOCAB_SIZE = 11
+
+
+def loop_reset_position_ids(attention_mask):
+    # the loop reset_position_ids replaced
+    position_ids = torch.zeros_like(attention_mask, dtype=torch.long)
+    for i in range(attention_mask.size(0)):
+        mask = attention_mask[i]
+        seq_num = mask.max().item()
+        for index in range(1, seq_num + 1):
+            sample_mask = mask == index
+            sample_length = sample_mask.sum().item()
+            position_ids[i, sample_mask] = torch.arange(sample_length, device=mask.device)
+    return position_ids
+
+
+def random_samples(seq_lens, seed=0):
+    """Unpadded samples (prompt followed by response) and per-sample outputs over their own positions"""
+    generator = torch.Generator().manual_seed(seed)
+    sequences = [torch.randint(2, VOCAB_SIZE, (seq_len,), generator=generator) for seq_len in seq_lens]
+    logits = [torch.randn(seq_len, VOCAB_SIZE, generator=generator) for seq_len in seq_lens]
+    return sequences, logits
+
+
+def left_pad(rows):
+    max_len = max(row.size(0) for row in rows)
+    padded = torch.zeros(len(rows), max_len, *rows[0].shape[1:], dtype=rows[0].dtype)
+    for i, row in enumerate(rows):
+        padded[i, max_len - row.size(0) :] = row
+    return padded
+
+
+SAMPLE_LAYOUTS = [
+    # seq_lens, num_actions
+    ([5, 9, 3], [2, 6, 1]),
+    ([7, 7, 7, 7], [3, 3, 3, 3]),
+    ([12, 4, 8, 6, 2], [10, 1, 4, 5, 1]),
+]
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seq_lens,num_actions", SAMPLE_LAYOUTS)
+def test_packed_gather_matches_per_sample(seq_lens, num_actions):
+    sequences, logits = random_samples(seq_lens)
+    packed_sequences, attention_mask = pack_sequences(torch.cat(sequences), torch.tensor(seq_lens))
+    # trailing pad position, like the model outputs for the packed row
+    packed_logits = torch.cat(logits + [torch.randn(1, VOCAB_SIZE)]).unsqueeze(0)
+    packed_seq_lens = get_packed_seq_lens(attention_mask)
+    assert packed_seq_lens == seq_lens
+
+    action_logits = gather_action_outputs(packed_logits, num_actions, packed_seq_lens)
+    labels = gather_action_labels(packed_sequences, num_actions, packed_seq_lens)
+
+    # the padded path, sample by sample: values[:, :-1][:, -num_actions:] and sequences[:, -num_actions:]
+    expected_logits = left_pad([gather_action_outputs(x.unsqueeze(0), n)[0] for x, n in zip(logits, num_actions)])
+    expected_labels = left_pad([gather_action_labels(x.unsqueeze(0), n)[0] for x, n in zip(sequences, num_actions)])
+    action_mask = torch.arange(max(num_actions)) >= max(num_actions) - torch.tensor(num_actions)[:, None]
+    assert action_logits.shape == expected_logits.shape
+    assert labels.shape == expected_labels.shape
+    torch.testing.assert_close(action_logits[action_mask], expected_logits[action_mask])
+    assert torch.equal(labels[action_mask], expected_labels[action_mask])
+
+
+@pytest.mark.unit
+def test_packed_action_index_padding_stays_in_the_row():
+    seq_lens, num_actions = [2, 9, 3], [1, 7, 2]
+    index = packed_action_index(seq_lens, num_actions)
+
+    assert index.shape == (3, 7)
+    assert index.min() >= 0 and index.max() + 1 < sum(seq_lens)
+    # the action positions of each sample are the last ones before its end
+    ends = torch.tensor(seq_lens).cumsum(0)
+    for i, n in enumerate(num_actions):
+        assert index[i, -n:].tolist() == list(range(ends[i] - 1 - n, ends[i] - 1))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(5))
+def test_vectorized_reset_position_ids_matches_loop(seed):
+    generator = torch.Generator().manual_seed(seed)
+    rows = []
+    for _ in range(4):
+        seq_lens = torch.randint(1, 8, (int(torch.randint(1, 6, (1,), generator=generator)),), generator=generator)
+        rows.append(pack_sequences(torch.zeros(int(seq_lens.sum()), dtype=torch.long), seq_lens)[1][0])
+    # rows of different lengths, right padded with 0 beyond the trailing pad
+    attention_mask = torch.zeros(len(rows), max(row.numel() for row in rows) + 2, dtype=torch.long)
+    for i, row in enumerate(rows):
+        attention_mask[i, : row.numel()] = row
+
+    assert torch.equal(reset_position_ids(attention_mask), loop_reset_position_ids(attention_mask))
+
+
+@pytest.mark.unit
+def test_reset_position_ids_equal_length_neighbours():
+    # consecutive samples of the same length must still restart their positions
+    attention_mask = torch.tensor([[1, 1, 2, 2, 3, 3, 0], [1, 2, 3, 4, 0, 0, 0]])
+
+    position_ids = reset_position_ids(attention_mask)
+    assert torch.equal(position_ids, loop_reset_position_ids(attention_mask))
+    assert position_ids.tolist() == [[0, 1, 0, 1, 0, 1, 0], [0, 0, 0, 0, 0, 0, 0]]
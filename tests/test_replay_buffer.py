@@ -0,0 +1,277 @@
+import random
+import time
+
+import pytest
+import torch
+
+from openrlhf.trainer.ppo_utils import (
+    BackgroundPrefetcher,
+    ColumnarReplayBuffer,
+    Experience,
+    MemmapReplayBuffer,
+    NaiveReplayBuffer,
+)
+
+EXPERIENCE_FIELDS = (
+    "sequences",
+    "action_log_probs",
+    "values",
+    "returns",
+    "advantages",
+    "attention_mask",
+    "action_mask",
+    "base_action_log_probs",
+    "base_action_hidden_states",
+    "base_sequences",
+    "base_attention_mask",
+    "base_action_mask",
+    "packed_seq_lens",
+    "num_actions",
+    "base_num_actions",
+)
+
+
+class SingleProcessStrategy:
+    """The all_reduce of a one-process DeepspeedStrategy"""
+
+    def all_reduce(self, data, op="mean"):
+        return data
+
+
+@pytest.fixture(autouse=True)
+def cpu_target_device(monkeypatch):
+    # the buffers look up their sample() target device at construction, which needs CUDA
+    monkeypatch.setattr(torch.cuda, "current_device", lambda: 0)
+
+
+def random_padded_rollouts(batch_size, generator, prompt_len=5, num_actions=7):
+    """Left padded prompts followed by right padded responses, as make_experience returns them"""
+    prompt_lens = torch.randint(1, prompt_len + 1, (batch_size,), generator=generator)
+    response_lens = torch.randint(1, num_actions + 1, (batch_size,), generator=generator)
+    positions = torch.arange(prompt_len + num_actions)
+    attention_mask = (positions[None, :] >= prompt_len - prompt_lens[:, None]) & (
+        positions[None, :] < prompt_len + response_lens[:, None]
+    )
+    action_mask = torch.arange(num_actions)[None, :] < response_lens[:, None]
+    sequences = torch.randint(2, 100, (batch_size, prompt_len + num_actions), generator=generator) * attention_mask
+    return sequences, attention_mask.long(), action_mask
+
+
+def random_experience(batch_size, seed, with_base_sample=False):
+    """A padded experience batch, optionally with the base hidden states and a base sample per row"""
+    generator = torch.Generator().manual_seed(seed)
+    sequences, attention_mask, action_mask = random_padded_rollouts(batch_size, generator)
+    num_actions = action_mask.size(1)
+
+    def action_values(*shape):
+        return torch.randn(batch_size, num_actions, *shape, generator=generator) * action_mask.view(
+            batch_size, num_actions, *[1] * len(shape)
+        )
+
+    experience = Experience(
+        sequences=sequences,
+        action_log_probs=action_values(),
+        values=action_values(),
+        returns=action_values(),
+        advantages=action_values(),
+        attention_mask=attention_mask,
+        action_mask=action_mask,
+        info={"reward": torch.randn(batch_size, generator=generator), "response_length": action_mask.sum(-1).float()},
+        base_action_log_probs=action_values(),
+    )
+    if with_base_sample:
+        experience.base_action_hidden_states = action_values(3)
+        # the base samples have their own padding, and lengths unrelated to the main sequences
+        experience.base_sequences, experience.base_attention_mask, experience.base_action_mask = (
+            random_padded_rollouts(batch_size, generator, prompt_len=4, num_actions=9)
+        )
+    return experience
+
+
+def fill_buffers(
+    tmp_path,
+    packing_samples=False,
+    limit=0,
+    num_experiences=6,
+    columnar_cls=MemmapReplayBuffer,
+    with_base_sample=False,
+):
+    """A NaiveReplayBuffer and a columnar one, filled with the same experiences"""
+    naive = NaiveReplayBuffer(4, limit=limit, cpu_offload=False, packing_samples=packing_samples)
+    kwargs = {"scratch_dir": str(tmp_path)} if columnar_cls is MemmapReplayBuffer else {}
+    columnar = columnar_cls(4, limit=limit, cpu_offload=False, packing_samples=packing_samples, **kwargs)
+    for seed in range(num_experiences):
+        # different batch sizes, so that the column files grow at different points
+        naive.append(random_experience(3 + seed % 3, seed, with_base_sample))
+        columnar.append(random_experience(3 + seed % 3, seed, with_base_sample))
+    return naive, columnar
+
+
+def assert_same_experience(experience, expected):
+    for key in EXPERIENCE_FIELDS:
+        value, expected_value = getattr(experience, key), getattr(expected, key)
+        if isinstance(expected_value, torch.Tensor):
+            torch.testing.assert_close(value, expected_value, msg=key)
+        else:
+            assert value == expected_value, key
+    assert experience.info.keys() == expected.info.keys()
+    for key in expected.info:
+        torch.testing.assert_close(experience.info[key], expected.info[key])
+
+
+def assert_same_batches(naive, columnar, indices):
+    assert len(columnar) == len(naive)
+    assert columnar.sequence_lengths() == naive.sequence_lengths()
+    assert_same_experience(
+        columnar.collate_fn([columnar[i] for i in indices]), naive.collate_fn([naive[i] for i in indices])
+    )
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("packing_samples", [False, True])
+@pytest.mark.parametrize("with_base_sample", [False, True])
+@pytest.mark.parametrize("limit,num_experiences", [(0, 6), (7, 12)])
+def test_columnar_matches_naive(tmp_path, packing_samples, with_base_sample, limit, num_experiences):
+    naive, columnar = fill_buffers(
+        tmp_path,
+        packing_samples=packing_samples,
+        limit=limit,
+        num_experiences=num_experiences,
+        columnar_cls=ColumnarReplayBuffer,
+        with_base_sample=with_base_sample,
+    )
+
+    assert_same_batches(naive, columnar, list(range(len(naive))))
+    assert_same_batches(naive, columnar, [6, 0, 2, 3])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("packing_samples", [False, True])
+def test_columnar_sample_matches_naive(tmp_path, packing_samples):
+    naive, columnar = fill_buffers(
+        tmp_path, packing_samples=packing_samples, columnar_cls=ColumnarReplayBuffer, with_base_sample=True
+    )
+
+    for seed in range(3):
+        # both draw the sample indices with random.sample over len(buffer) elements
+        random.seed(seed)
+        expected = naive.sample()
+        random.seed(seed)
+        assert_same_experience(columnar.sample(), expected)
+
+
+@pytest.mark.unit
+def test_columnar_normalize(tmp_path):
+    naive, columnar = fill_buffers(tmp_path, limit=7, num_experiences=8, columnar_cls=ColumnarReplayBuffer)
+
+    naive.normalize("advantages", SingleProcessStrategy())
+    columnar.normalize("advantages", SingleProcessStrategy())
+
+    assert_same_batches(naive, columnar, list(range(len(naive))))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("packing_samples", [False, True])
+@pytest.mark.parametrize("with_base_sample", [False, True])
+def test_memmap_round_trip(tmp_path, packing_samples, with_base_sample):
+    naive, memmap = fill_buffers(tmp_path, packing_samples=packing_samples, with_base_sample=with_base_sample)
+
+    assert_same_batches(naive, memmap, list(range(len(naive))))
+    assert_same_batches(naive, memmap, [7, 0, 12, 3])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("packing_samples", [False, True])
+def test_memmap_round_trip_with_limit(tmp_path, packing_samples):
+    # the limit drops the oldest samples, and the files are compacted when they next have to grow
+    naive, memmap = fill_buffers(tmp_path, packing_samples=packing_samples, limit=7, num_experiences=12)
+
+    assert len(naive) == 7
+    assert_same_batches(naive, memmap, list(range(len(naive))))
+    assert_same_batches(naive, memmap, [6, 2, 4])
+
+
+@pytest.mark.unit
+def test_memmap_columns_are_file_backed(tmp_path):
+    (tmp_path / "limited").mkdir()
+    (tmp_path / "unlimited").mkdir()
+    _, memmap = fill_buffers(tmp_path / "limited", limit=7, num_experiences=12)
+    _, unlimited = fill_buffers(tmp_path / "unlimited", num_experiences=12)
+
+    for key, column in memmap.columns.items():
+        flat_map = memmap.maps[key]
+        assert column.untyped_storage().data_ptr() == flat_map.untyped_storage().data_ptr()
+        # the samples dropped by the limit were compacted away instead of growing the files further
+        assert flat_map.numel() < unlimited.maps[key].numel()
+
+
+@pytest.mark.unit
+def test_memmap_normalize(tmp_path):
+    naive, memmap = fill_buffers(tmp_path, limit=7, num_experiences=8)
+
+    naive.normalize("advantages", SingleProcessStrategy())
+    memmap.normalize("advantages", SingleProcessStrategy())
+
+    assert_same_batches(naive, memmap, list(range(len(naive))))
+    # the normalized advantages were written to the file
+    advantages = memmap.columns["advantages"]
+    reloaded = torch.from_file(
+        f"{memmap.scratch_dir}/advantages.bin", size=memmap.maps["advantages"].numel(), dtype=torch.float32
+    )
+    start = advantages.storage_offset()
+    torch.testing.assert_close(reloaded[start : start + advantages.numel()], advantages)
+
+
+@pytest.mark.unit
+def test_memmap_clear(tmp_path):
+    _, memmap = fill_buffers(tmp_path)
+
+    memmap.clear()
+    assert len(memmap) == 0
+    assert memmap.columns == {}
+    memmap.append(random_experience(3, seed=0))
+    naive = NaiveReplayBuffer(4, cpu_offload=False)
+    naive.append(random_experience(3, seed=0))
+    assert_same_batches(naive, memmap, [0, 1, 2])
+
+
+@pytest.mark.unit
+def test_background_prefetcher_keeps_order():
+    loader = BackgroundPrefetcher(range(100), num_prefetch=3)
+
+    assert len(loader) == 100
+    assert list(loader) == list(range(100))
+    # can be iterated again, e.g. once per epoch
+    assert list(loader) == list(range(100))
+
+
+@pytest.mark.unit
+def test_background_prefetcher_reraises_errors():
+    def items():
+        yield 0
+        yield 1
+        raise ValueError("collate failed")
+
+    seen = []
+    with pytest.raises(ValueError, match="collate failed"):
+        for item in BackgroundPrefetcher(items()):
+            seen.append(item)
+    assert seen == [0, 1]
+
+
+@pytest.mark.unit
+def test_background_prefetcher_stops_producer_on_early_exit():
+    produced = []
+
+    def items():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    for item in BackgroundPrefetcher(items(), num_prefetch=2):
+        if item == 3:
+            break
+    # the producer thread was stopped and joined, so nothing is produced after the consumer stopped
+    num_produced = len(produced)
+    time.sleep(0.1)
+    assert len(produced) == num_produced < 1000
@@ -0,0 +1,95 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from openrlhf.trainer.ppo_utils import Experience, RolloutReusePool, rollout_ess
+
+
+def rollout(rollout_id, batch_size=4):
+    return Experience(
+        sequences=torch.full((batch_size, 6), rollout_id),
+        action_log_probs=torch.zeros(batch_size, 3),
+        values=torch.zeros(batch_size, 3),
+        returns=torch.zeros(batch_size, 3),
+        advantages=torch.zeros(batch_size, 3),
+        attention_mask=torch.ones(batch_size, 6, dtype=torch.long),
+        action_mask=torch.ones(batch_size, 3, dtype=torch.bool),
+        info={},
+    )
+
+
+def rollout_ids(experiences):
+    return [int(experience.sequences[0, 0]) for experience in experiences]
+
+
+@pytest.mark.unit
+def test_rollouts_are_evicted_after_max_rollouts_calls():
+    pool = RolloutReusePool(max_rollouts=3, samples_per_prompt=2)
+    ess_calls = []
+
+    def get_ess(experience):
+        ess_calls.append(rollout_ids([experience])[0])
+        return 1.0
+
+    reused = []
+    for rollout_id in range(5):
+        # as in fit: the new rollout is added, the old ones are reused, then ppo_train and step
+        pool.add(rollout(rollout_id))
+        assert pool.reuse(get_ess) == [1.0] * len(pool.old_rollouts())
+        reused.append(rollout_ids(pool.old_rollouts()))
+        pool.step()
+
+    assert reused == [[], [0], [0, 1], [1, 2], [2, 3]]
+    # the ESS is only computed for the old rollouts
+    assert ess_calls == [0, 0, 1, 1, 2, 2, 3]
+    assert rollout_ids(pool.rollouts) == [3, 4] and pool.ages == [2, 1]
+
+
+@pytest.mark.unit
+def test_rollouts_below_min_ess_are_evicted():
+    pool = RolloutReusePool(max_rollouts=4, samples_per_prompt=2, min_ess=0.5)
+    ess = {0: 0.9, 1: 0.2}
+    for rollout_id in range(2):
+        pool.add(rollout(rollout_id))
+        pool.step()
+    pool.add(rollout(2))
+
+    assert pool.reuse(lambda experience: ess[rollout_ids([experience])[0]]) == [0.9, 0.2]
+    assert rollout_ids(pool.old_rollouts()) == [0]
+    assert rollout_ids(pool.rollouts) == [0, 2]
+    assert pool.ages == [2, 0]
+
+
+@pytest.mark.unit
+def test_pooled_rollouts_are_kept_on_the_cpu_in_whole_prompt_groups():
+    pool = RolloutReusePool(max_rollouts=2, samples_per_prompt=4)
+    pool.add(rollout(0, batch_size=8))
+    assert all(tensor.device.type == "cpu" for tensor in (pool.rollouts[0].sequences, pool.rollouts[0].action_mask))
+
+    with pytest.raises(AssertionError):
+        pool.add(rollout(1, batch_size=6))
+
+
+@pytest.mark.unit
+def test_rollout_ess_is_normalized_within_each_prompt():
+    log_ratios = torch.randn(3, 5, generator=torch.Generator().manual_seed(0))
+    # shifting a prompt's log ratios by a constant changes nothing within that prompt
+    shifted = log_ratios + torch.tensor([[0.0], [20.0], [-20.0]])
+
+    weights = F.softmax(log_ratios, dim=-1)
+    expected = (1 / weights.pow(2).sum(-1) / 5).mean().item()
+    assert rollout_ess(log_ratios.flatten(), samples_per_prompt=5) == pytest.approx(expected)
+    assert rollout_ess(shifted.flatten(), samples_per_prompt=5) == pytest.approx(expected)
+    assert rollout_ess(torch.zeros(15), samples_per_prompt=5) == pytest.approx(1.0)
+
+
+@pytest.mark.unit
+def test_rollout_ess_with_one_sample_per_prompt():
+    # on-policy rollouts have an ESS of 1
+    assert rollout_ess(torch.zeros(8), samples_per_prompt=1) == pytest.approx(1.0)
+    # weights w are unnormalized and 1 / mean(w^2) is estimated across the prompts, rather than self-normalizing the
+    # weights of different prompts against each other
+    log_ratios = torch.tensor([0.5, -0.5, 1.0, -2.0])
+    assert rollout_ess(log_ratios, samples_per_prompt=1) == pytest.approx(1 / log_ratios.mul(2).exp().mean().item())
+    # one very unlikely sample under the current proposal degrades the ESS
+    assert rollout_ess(torch.tensor([0.0, 0.0, 0.0, 3.0]), samples_per_prompt=1) < 0.01
@@ -0,0 +1,116 @@
+import pytest
+import torch
+
+from conftest import EOS_TOKEN_ID, PAD_TOKEN_ID, VOCAB_SIZE, left_padded_prompts
+from openrlhf.models.utils import unique_prompt_rows
+
+NUM_ACTIONS = 6
+
+
+def rollouts(prompt_lens=(3, 5, 2), samples_per_prompt=3, seed=0):
+    """Duplicated prompts followed by random responses, some of them ending early with EOS and right padding"""
+    input_ids, prompt_attention_mask = left_padded_prompts(prompt_lens, samples_per_prompt, seed=seed)
+    generator = torch.Generator().manual_seed(seed)
+    actions = torch.randint(2, VOCAB_SIZE, (input_ids.size(0), NUM_ACTIONS), generator=generator)
+    action_attention_mask = torch.ones_like(actions)
+    for i, response_len in enumerate(torch.randint(1, NUM_ACTIONS + 1, (input_ids.size(0),), generator=generator)):
+        if response_len < NUM_ACTIONS:
+            actions[i, response_len - 1] = EOS_TOKEN_ID
+            actions[i, response_len:] = PAD_TOKEN_ID
+            action_attention_mask[i, response_len:] = 0
+    sequences = torch.cat([input_ids, actions], dim=1)
+    attention_mask = torch.cat([prompt_attention_mask, action_attention_mask], dim=1)
+    # as in process_sequences
+    state_seq = sequences[:, input_ids.size(1) - 1 : -1]
+    action_mask = state_seq.ne(EOS_TOKEN_ID) & state_seq.ne(PAD_TOKEN_ID)
+    action_mask[:, 0] = 1
+    return sequences, attention_mask, action_mask
+
+
+@pytest.mark.unit
+def test_unique_prompt_rows():
+    input_ids, attention_mask = left_padded_prompts([3, 5, 3], samples_per_prompt=2)
+    first_indices, inverse = unique_prompt_rows(input_ids, attention_mask)
+
+    assert first_indices.numel() == 3
+    assert torch.equal(input_ids[first_indices][inverse], input_ids)
+    assert torch.equal(attention_mask[first_indices][inverse], attention_mask)
+    assert torch.equal(first_indices.sort().values, torch.tensor([0, 2, 4]))
+
+
+@pytest.mark.unit
+def test_generation_matches_unshared(actor_custom):
+    input_ids, attention_mask = left_padded_prompts([3, 6, 2], samples_per_prompt=3)
+
+    def generate(share_prompt_prefix):
+        torch.manual_seed(0)
+        return actor_custom.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=10,
+            eos_token_id=EOS_TOKEN_ID,
+            pad_token_id=PAD_TOKEN_ID,
+            use_kv_cache=True,
+            share_prompt_prefix=share_prompt_prefix,
+            return_log_probs=True,
+        )
+
+    expected_sequences, expected_attention_mask, expected_action_mask, expected_log_probs, _ = generate(False)
+    sequences, attention_mask, action_mask, log_probs, _ = generate(True)
+    assert torch.equal(sequences, expected_sequences)
+    assert torch.equal(attention_mask, expected_attention_mask)
+    assert torch.equal(action_mask, expected_action_mask)
+    torch.testing.assert_close(log_probs, expected_log_probs)
+
+
+@pytest.mark.unit
+def test_base_actor_scoring_matches_unshared(base_actor):
+    sequences, attention_mask, action_mask = rollouts()
+
+    with torch.no_grad():
+        expected = base_actor(sequences, NUM_ACTIONS, attention_mask)
+        shared = base_actor(sequences, NUM_ACTIONS, attention_mask, share_prompt_prefix=True)
+    torch.testing.assert_close(shared * action_mask, expected * action_mask)
+
+
+@pytest.mark.unit
+def test_actor_custom_scoring_matches_unshared(actor_custom):
+    sequences, attention_mask, action_mask = rollouts()
+
+    with torch.no_grad():
+        expected = actor_custom(sequences, NUM_ACTIONS, attention_mask)
+        shared = actor_custom(sequences, NUM_ACTIONS, attention_mask, share_prompt_prefix=True)
+    torch.testing.assert_close(shared * action_mask, expected * action_mask)
+
+
+@pytest.mark.unit
+def test_forward_with_base_matches_unshared(actor_custom):
+    if not actor_custom.use_modulation_head:
+        pytest.skip("forward_with_base is only defined for the modulation head parameterizations")
+    sequences, attention_mask, action_mask = rollouts()
+
+    with torch.no_grad():
+        expected = actor_custom.forward_with_base(sequences, NUM_ACTIONS, attention_mask)
+        shared = actor_custom.forward_with_base(sequences, NUM_ACTIONS, attention_mask, share_prompt_prefix=True)
+    for shared_log_probs, expected_log_probs in zip(shared, expected):
+        torch.testing.assert_close(shared_log_probs * action_mask, expected_log_probs * action_mask)
+
+
+@pytest.mark.unit
+def test_critic_matches_unshared(critic):
+    sequences, attention_mask, action_mask = rollouts()
+
+    with torch.no_grad():
+        expected = critic(sequences, action_mask, attention_mask)
+        shared = critic(sequences, action_mask, attention_mask, share_prompt_prefix=True)
+    torch.testing.assert_close(shared * action_mask, expected * action_mask)
+
+
+@pytest.mark.unit
+def test_distinct_prompts_fall_back_to_a_single_pass(base_actor):
+    sequences, attention_mask, action_mask = rollouts(samples_per_prompt=1)
+
+    with torch.no_grad():
+        expected = base_actor(sequences, NUM_ACTIONS, attention_mask)
+        shared = base_actor(sequences, NUM_ACTIONS, attention_mask, share_prompt_prefix=True)
+    torch.testing.assert_close(shared * action_mask, expected * action_mask)
@@ -0,0 +1,213 @@
+import math
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from openrlhf.trainer.ppo_trainer import PPOTrainer
+from openrlhf.trainer.ppo_utils import StreamingIWAEEstimator, StreamingStats
+
+CHUNK_SIZES = [3, 1, 0, 7, 2, 11]
+
+
+def random_values(shape, num_samples, seed=0, scale=2.0, offset=0.0):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(*shape, num_samples, generator=generator, dtype=torch.float64) * scale + offset
+
+
+def chunks(values, chunk_sizes=CHUNK_SIZES):
+    start = 0
+    for chunk_size in chunk_sizes:
+        yield values[..., start : start + chunk_size]
+        start += chunk_size
+    assert start == values.size(-1)
+
+
+def batch_log_mean_exp_std_err(values):
+    # delta method on w = exp(values) with the population variance: sqrt(Var(w) / (N * mean(w)^2))
+    weights = np.exp(values - values.max(axis=-1, keepdims=True))
+    return np.sqrt(weights.var(axis=-1) / (values.shape[-1] * weights.mean(axis=-1) ** 2))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("shape", [(), (4,), (2, 3)])
+@pytest.mark.parametrize("offset", [0.0, 500.0, -500.0])
+def test_streaming_stats_match_batch_estimates(shape, offset):
+    values = random_values(shape, sum(CHUNK_SIZES), offset=offset)
+    stats = StreamingStats(shape)
+    for chunk in chunks(values):
+        stats.update(chunk)
+
+    batch = values.numpy()
+    num_samples = batch.shape[-1]
+    assert stats.count == num_samples
+    np.testing.assert_allclose(stats.mean.numpy(), batch.mean(axis=-1), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(stats.variance.numpy(), batch.var(axis=-1, ddof=1), rtol=1e-10)
+    np.testing.assert_allclose(stats.std_err.numpy(), batch.std(axis=-1, ddof=1) / math.sqrt(num_samples), rtol=1e-10)
+    # exp(values) over/underflows at these offsets; the running logsumexp must not
+    log_mean_exp = torch.logsumexp(values, dim=-1) - math.log(num_samples)
+    np.testing.assert_allclose(stats.log_mean_exp.numpy(), log_mean_exp.numpy(), rtol=1e-12)
+    np.testing.assert_allclose(stats.log_mean_exp_std_err.numpy(), batch_log_mean_exp_std_err(batch), rtol=1e-8)
+
+
+@pytest.mark.unit
+def test_streaming_stats_accept_any_dtype_and_device_and_do_not_keep_the_graph():
+    values = torch.randn(2, 8, requires_grad=True)
+    stats = StreamingStats((2,))
+    stats.update(values.bfloat16())
+    stats.update(values[:, :3])
+
+    assert stats.count == 11
+    assert stats.mean.dtype == torch.float64 and stats.mean.device.type == "cpu"
+    assert not stats.mean.requires_grad and not stats.log_sum_exp.requires_grad
+
+
+@pytest.mark.unit
+def test_streaming_stats_with_too_few_samples():
+    stats = StreamingStats((3,))
+    stats.update(torch.zeros(3, 0))
+    assert stats.count == 0
+
+    stats.update(torch.tensor([[1.0], [2.0], [3.0]]))
+    assert stats.mean.tolist() == [1.0, 2.0, 3.0]
+    assert stats.log_mean_exp.tolist() == [1.0, 2.0, 3.0]
+    assert stats.variance.isnan().all() and stats.std_err.isnan().all()
+    assert stats.log_mean_exp_std_err.isnan().all()
+
+    # identical weights: the standard error is clamped at 0 rather than a NaN from rounding
+    stats.update(torch.tensor([[1.0], [2.0], [3.0]]))
+    assert stats.variance.tolist() == [0.0, 0.0, 0.0]
+    assert (stats.log_mean_exp_std_err.abs() < 1e-6).all()
+
+
+def fill_estimator(n_seeds, f_qs, g_qs, f_q_chunk_sizes=CHUNK_SIZES, g_q_chunk_sizes=(1, 0, 2, 5)):
+    estimator = StreamingIWAEEstimator(n_seeds)
+    for chunk in chunks(f_qs, f_q_chunk_sizes):
+        estimator.update_f_q(chunk)
+    for chunk in chunks(g_qs, g_q_chunk_sizes):
+        estimator.update_g_q(chunk)
+    return estimator
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("f_q_chunk_sizes", [CHUNK_SIZES, [0, 1, 23], [24]])
+def test_iwae_bounds_match_batch_estimates(f_q_chunk_sizes):
+    n_seeds = 3
+    f_qs = random_values((n_seeds,), 24, seed=1, offset=-50.0)
+    g_qs = random_values((), 8, seed=2, offset=-48.0)
+    estimator = fill_estimator(n_seeds, f_qs, g_qs, f_q_chunk_sizes)
+
+    torch.testing.assert_close(estimator.iwae_lower_bound, torch.logsumexp(f_qs, dim=-1) - math.log(24))
+    # seed i swaps its first q sample for posterior sample i
+    swapped = f_qs.clone()
+    swapped[:, 0] = g_qs[:n_seeds]
+    torch.testing.assert_close(estimator.iwae_upper_bound, torch.logsumexp(swapped, dim=-1) - math.log(24))
+
+    summary = estimator.summary()
+    assert all(value.dtype == torch.float32 for value in summary.values())
+    torch.testing.assert_close(summary["f_q"], f_qs.mean(dim=-1).float())
+    torch.testing.assert_close(summary["f_q_std_err"], (f_qs.std(dim=-1) / math.sqrt(24)).float())
+    torch.testing.assert_close(
+        summary["iwae_lb_std_err"], torch.from_numpy(batch_log_mean_exp_std_err(f_qs.numpy())).float()
+    )
+    torch.testing.assert_close(summary["g_q"], g_qs.mean().float())
+    torch.testing.assert_close(summary["g_q_std_err"], (g_qs.std() / math.sqrt(8)).float())
+
+
+@pytest.mark.unit
+def test_iwae_upper_bound_needs_a_posterior_sample_per_seed():
+    estimator = StreamingIWAEEstimator(3)
+    estimator.update_f_q(torch.randn(3, 4))
+    assert set(estimator.summary()) == {"f_q", "f_q_std_err", "iwae_lb", "iwae_lb_std_err"}
+
+    estimator.update_g_q(torch.randn(2))
+    with pytest.raises(AssertionError):
+        estimator.iwae_upper_bound
+
+
+def batch_converged(f_qs, tolerance):
+    num_samples = f_qs.size(-1)
+    std_err = f_qs.std(dim=-1).numpy() / math.sqrt(num_samples)
+    return bool((np.maximum(std_err, batch_log_mean_exp_std_err(f_qs.numpy())) <= tolerance).all())
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("tolerance", [0.05, 0.1, 0.3])
+def test_converged_matches_the_batch_criterion_after_every_chunk(tolerance):
+    f_qs = random_values((3,), 400, seed=3, scale=1.0)
+    estimator = StreamingIWAEEstimator(3)
+
+    decisions = []
+    for chunk in chunks(f_qs, [1] + [3] * 133):
+        estimator.update_f_q(chunk)
+        prefix = f_qs[:, : estimator.f_q.count]
+        # a single sample has no standard error
+        expected = estimator.f_q.count >= 2 and batch_converged(prefix, tolerance)
+        assert estimator.converged(tolerance) == expected
+        decisions.append(expected)
+    # the tolerances are reached part of the way through the stream
+    assert not decisions[0] and decisions[-1] == (tolerance > 0.05)
+
+
+@pytest.mark.unit
+def test_converged_needs_every_seed():
+    estimator = StreamingIWAEEstimator(2)
+    # the first seed has identical weights, the second a spread of them
+    estimator.update_f_q(torch.tensor([[0.0, 0.0, 0.0, 0.0], [-3.0, 0.0, 3.0, 0.0]]))
+
+    assert not estimator.converged(1.0)
+    assert estimator.converged(10.0)
+
+
+def adaptive_trainer(f_qs, monkeypatch):
+    """A PPOTrainer whose f_q rollouts are the next columns of f_qs, with fixed log weights for 3 posterior samples"""
+    trainer = PPOTrainer.__new__(PPOTrainer)
+    trainer.n_seeds_f_q = f_qs.size(0)
+    trainer.generate_kwargs = {"eos_token_id": 1, "pad_token_id": 0}
+    trainer._wandb = None
+    trainer.requested_chunk_sizes = []
+
+    def batched_f_q_estimates(args, prompts, n_seeds):
+        start = sum(trainer.requested_chunk_sizes)
+        trainer.requested_chunk_sizes.append(len(prompts))
+        return {"f_qs": f_qs[:, start : start + len(prompts)].float()}, None, 4
+
+    log_tilde_sigma = torch.tensor([-1.0, 0.5, 0.0])
+    monkeypatch.setattr(trainer, "batched_f_q_estimates", batched_f_q_estimates)
+    monkeypatch.setattr(trainer, "get_true_posterior_log_tilde_sigma", lambda *args: (4, log_tilde_sigma))
+    monkeypatch.setattr(trainer, "g_q_estimate", lambda *args, log_tilde_sigma: log_tilde_sigma)
+    return trainer
+
+
+class RecordingStore:
+    def __init__(self):
+        self.records = []
+
+    def append(self, **estimates):
+        self.records.append(estimates)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("tolerance,expected_samples", [(0.25, None), (1e-3, 60)])
+def test_adaptive_evaluation_stops_at_the_first_converged_chunk(tolerance, expected_samples, monkeypatch):
+    f_qs = random_values((3,), 60, seed=4, scale=1.0)
+    trainer = adaptive_trainer(f_qs, monkeypatch)
+    args = SimpleNamespace(
+        n_samples_for_f_q=20,
+        duplicate_rollout_batch_by=1,
+        f_q_eval_tolerance=tolerance,
+        f_q_eval_max_samples=60,
+        f_q_eval_adaptive_chunk_size=None,
+    )
+    store = RecordingStore()
+    trainer.f_q_g_q_evaluation(args, store, "prompt", torch.zeros(3, 8, dtype=torch.long))
+
+    if expected_samples is None:
+        # n_samples_for_f_q // 10 samples per check, stopping at the first prefix within the tolerance
+        expected_samples = next(n for n in range(2, 61, 2) if batch_converged(f_qs[:, :n], tolerance))
+        assert 2 < expected_samples < 60
+    samples_used = int(store.records[0]["samples_used"])
+    assert samples_used == expected_samples
+    assert trainer.requested_chunk_sizes == [2] * (expected_samples // 2)
+    torch.testing.assert_close(store.records[0]["f_q_estimates"], f_qs[:, :samples_used].float().flatten())
@@ -0,0 +1,123 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from conftest import EOS_TOKEN_ID, PAD_TOKEN_ID, VOCAB_SIZE
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import WhitespaceSplit
+from transformers import PreTrainedTokenizerFast
+
+from openrlhf.trainer.ppo_trainer import PPOTrainer
+from openrlhf.trainer.ppo_utils.experience_maker import NaiveExperienceMaker
+
+PROMPT_TEXT = "w5 w6 w7"
+NUM_ACTIONS = 8
+N_SEEDS = 2
+
+
+def word_tokenizer():
+    """A tokenizer over the tiny GPT-2 vocab, token i being the word wi"""
+    tokenizer = Tokenizer(WordLevel({f"w{i}": i for i in range(VOCAB_SIZE)}, unk_token="w2"))
+    tokenizer.pre_tokenizer = WhitespaceSplit()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token=f"w{PAD_TOKEN_ID}", eos_token=f"w{EOS_TOKEN_ID}"
+    )
+
+
+def posterior_samples(num_samples=4, seed=0):
+    """The prompt followed by NUM_ACTIONS response tokens, some of the responses ending early"""
+    generator = torch.Generator().manual_seed(seed)
+    responses = torch.randint(2, VOCAB_SIZE, (num_samples, NUM_ACTIONS), generator=generator)
+    responses[0, 2], responses[0, 3:] = EOS_TOKEN_ID, PAD_TOKEN_ID
+    responses[1, 5], responses[1, 6:] = EOS_TOKEN_ID, PAD_TOKEN_ID
+    prompt = torch.tensor([5, 6, 7]).expand(num_samples, -1)
+    return torch.cat([prompt, responses], dim=1)
+
+
+def log_phi(sequences):
+    # a deterministic stand-in for the reward model's log phi
+    return -sequences.float().sum(dim=-1) / 100
+
+
+class RecordingStore:
+    def __init__(self):
+        self.records = []
+
+    def append(self, **estimates):
+        self.records.append(estimates)
+
+
+@pytest.fixture
+def trainer(base_actor, actor_custom, monkeypatch):
+    experience_maker = NaiveExperienceMaker.__new__(NaiveExperienceMaker)
+    experience_maker.tokenizer = word_tokenizer()
+    experience_maker.actor = actor_custom
+    experience_maker.initial_model = base_actor
+    experience_maker.critic = None
+    experience_maker.reward_model = None
+    reward_calls = []
+
+    def compute_reward_no_kl(sequences, attention_mask, multiply_by_beta=True):
+        reward_calls.append(sequences)
+        return log_phi(sequences)
+
+    monkeypatch.setattr(experience_maker, "compute_reward_no_kl", compute_reward_no_kl)
+
+    trainer = PPOTrainer.__new__(PPOTrainer)
+    trainer.experience_maker = experience_maker
+    trainer.generate_kwargs = {"eos_token_id": EOS_TOKEN_ID, "pad_token_id": PAD_TOKEN_ID}
+    trainer.prompt_max_len = 16
+    trainer.n_seeds_f_q = N_SEEDS
+    trainer.shared_actorcritic = False
+    trainer.true_posterior_log_tilde_sigma = None
+    trainer._wandb = None
+    trainer.reward_calls = reward_calls
+    return trainer
+
+
+def evaluate(trainer, monkeypatch, f_q_num_actions, true_posterior_samples):
+    """f_q_g_q_evaluation with f_q rollouts whose generation stopped after f_q_num_actions tokens"""
+    f_qs = torch.randn(N_SEEDS, 4, generator=torch.Generator().manual_seed(f_q_num_actions))
+    monkeypatch.setattr(
+        trainer, "batched_f_q_estimates", lambda args, prompts, n_seeds: ({"f_qs": f_qs}, None, f_q_num_actions)
+    )
+    args = SimpleNamespace(n_samples_for_f_q=4, duplicate_rollout_batch_by=1)
+    store = RecordingStore()
+    trainer.f_q_g_q_evaluation(args, store, PROMPT_TEXT, true_posterior_samples)
+    return store.records[0]
+
+
+@pytest.mark.unit
+def test_g_q_does_not_depend_on_the_f_q_generation_length(trainer, base_actor, actor_custom, monkeypatch):
+    samples = posterior_samples()
+
+    first = evaluate(trainer, monkeypatch, 3, samples)
+    second = evaluate(trainer, monkeypatch, 7, samples)
+
+    torch.testing.assert_close(first["g_q_estimates"], second["g_q_estimates"])
+    # log p + log phi was computed once, over all the response tokens of the posterior samples
+    assert len(trainer.reward_calls) == 1
+    assert trainer.true_posterior_log_tilde_sigma[1] == NUM_ACTIONS
+    attention_mask = (samples.ne(EOS_TOKEN_ID) & samples.ne(PAD_TOKEN_ID)).long()
+    action_mask = trainer.get_sigma_samples_action_mask(samples, NUM_ACTIONS)
+    with torch.no_grad():
+        log_p = (base_actor(samples, NUM_ACTIONS, attention_mask) * action_mask).sum(-1)
+        log_q = (actor_custom(samples, NUM_ACTIONS, attention_mask) * action_mask).sum(-1)
+    torch.testing.assert_close(first["g_q_estimates"], log_p + log_phi(samples) - log_q)
+
+
+@pytest.mark.unit
+def test_log_tilde_sigma_is_cached_per_num_actions(trainer):
+    args = SimpleNamespace(n_samples_for_f_q=3)
+    samples = posterior_samples()
+
+    num_actions, log_tilde_sigma = trainer.get_true_posterior_log_tilde_sigma(args, samples, PROMPT_TEXT)
+    assert num_actions == NUM_ACTIONS
+    assert trainer.get_true_posterior_log_tilde_sigma(args, samples, PROMPT_TEXT)[1] is log_tilde_sigma
+    assert len(trainer.reward_calls) == 2  # two chunks of n_samples_for_f_q
+
+    # a shorter prompt leaves more action tokens in the same samples
+    num_actions, _ = trainer.get_true_posterior_log_tilde_sigma(args, samples, "w5 w6")
+    assert num_actions == NUM_ACTIONS + 1
+    assert len(trainer.reward_calls) == 4